@@ -1,6 +1,11 @@
 from __future__ import annotations
+import time
 from dataclasses import dataclass
-from typing import Any, Callable, Generic, Optional, Sequence, Type, TypeVar
+from typing import Any, Callable, Dict, Generic, Optional, Sequence, Type, TypeVar
+
+from api.openai_client import with_operation_timeout
+from api.scheduler import CallStats, estimate_request_tokens, get_scheduler
+from api.usage import UsageRecord, get_ledger, usage_from_response
 
 T = TypeVar("T")
 
@@ -30,3 +35,89 @@ class Agent(Generic[T]):
 
     def __repr__(self) -> str:
         return f"Agent(name={self.name}, model={self.model})"
+
+def record_usage(
+    operation: str,
+    model: str,
+    resp: Any = None,
+    latency_s: float = 0.0,
+    stats: Optional[CallStats] = None,
+    cache_hit: bool = False,
+    streamed: bool = False,
+) -> UsageRecord:
+    """
+    Registra uma chamada (ou um acerto de cache local) no ledger de uso do processo.
+    """
+    usage = usage_from_response(resp) if resp is not None else {}
+    return get_ledger().record(
+        UsageRecord(
+            operation=operation,
+            model=model,
+            latency_s=round(latency_s, 3),
+            retries=max(0, stats.attempts - 1) if stats is not None else 0,
+            cache_hit=cache_hit,
+            streamed=streamed,
+            **usage,
+        )
+    )
+
+def create_response(
+    client: Any,
+    use_responses: bool,
+    call_kwargs: Dict[str, Any],
+    operation: str,
+    stats: Optional[CallStats] = None,
+    stream: bool = False,
+) -> Any:
+    """
+    Envia a requisição (Responses ou Chat Completions) pelo agendador compartilhado:
+    respeita limites RPM/TPM, timeout da operação e retry apenas para erros transitórios.
+    Chamadas sem streaming são registradas no ledger de uso (tokens, latência, retentativas);
+    em streaming, o registro é feito por quem consome o stream, ao final.
+    """
+    api = with_operation_timeout(client, operation)
+    endpoint = api.responses if use_responses else api.chat.completions
+    extra: Dict[str, Any] = {}
+    if stream:
+        extra["stream"] = True
+        if not use_responses:
+            extra["stream_options"] = {"include_usage": True}
+    stats = stats if stats is not None else CallStats()
+    t0 = time.perf_counter()
+    resp = get_scheduler().call(
+        lambda: endpoint.create(**call_kwargs, **extra),
+        estimated_tokens=estimate_request_tokens(call_kwargs),
+        stats=stats,
+    )
+    if not stream:
+        record_usage(operation, call_kwargs["model"], resp, time.perf_counter() - t0, stats)
+    return resp
+
+async def create_response_async(
+    client: Any,
+    use_responses: bool,
+    call_kwargs: Dict[str, Any],
+    operation: str,
+    stats: Optional[CallStats] = None,
+    stream: bool = False,
+) -> Any:
+    """
+    Versão assíncrona de `create_response` (cliente AsyncOpenAI).
+    """
+    api = with_operation_timeout(client, operation)
+    endpoint = api.responses if use_responses else api.chat.completions
+    extra: Dict[str, Any] = {}
+    if stream:
+        extra["stream"] = True
+        if not use_responses:
+            extra["stream_options"] = {"include_usage": True}
+    stats = stats if stats is not None else CallStats()
+    t0 = time.perf_counter()
+    resp = await get_scheduler().acall(
+        lambda: endpoint.create(**call_kwargs, **extra),
+        estimated_tokens=estimate_request_tokens(call_kwargs),
+        stats=stats,
+    )
+    if not stream:
+        record_usage(operation, call_kwargs["model"], resp, time.perf_counter() - t0, stats)
+    return resp
@@ -0,0 +1,140 @@
+from __future__ import annotations
+import hashlib
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from openai import OpenAI
+from agents.qa_agent import answer_with_ebook
+from api.scheduler import get_scheduler
+from models.qa_models import QARequest
+from utils.retrieval import ContextSelector
+from utils.semantic_cache import SemanticAnswerCache
+
+
+def question_id(question: str) -> str:
+    """
+    Identificador estável da pergunta (usado para retomar execuções interrompidas).
+    """
+    return hashlib.sha1(" ".join(question.split()).encode("utf-8")).hexdigest()[:12]
+
+
+def load_questions(source: str) -> List[Tuple[str, str]]:
+    """
+    Lê perguntas de um arquivo (ou '-' para stdin) e retorna [(id, pergunta)].
+    - .jsonl: uma linha JSON por pergunta, com "question" e opcionalmente "id"
+      (linhas inválidas são puladas com aviso no stderr, indicando o número da linha).
+    - outros: uma pergunta por linha (linhas vazias e iniciadas por '#' são ignoradas).
+    """
+    if source == "-":
+        lines = sys.stdin.read().splitlines()
+        is_jsonl = False
+    else:
+        p = Path(source).expanduser().resolve()
+        if not p.is_file():
+            raise FileNotFoundError(f"Arquivo de perguntas não encontrado: {p}")
+        lines = p.read_text(encoding="utf-8", errors="ignore").splitlines()
+        is_jsonl = p.suffix.lower() == ".jsonl"
+
+    out: List[Tuple[str, str]] = []
+    seen: Set[str] = set()
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or (not is_jsonl and line.startswith("#")):
+            continue
+        if is_jsonl:
+            try:
+                obj = json.loads(line)
+                if not isinstance(obj, dict):
+                    raise ValueError("esperado um objeto JSON")
+            except ValueError as e:
+                print(f"[AVISO] {source}:{lineno}: linha ignorada (JSON inválido: {e})", file=sys.stderr)
+                continue
+            q = str(obj.get("question", "")).strip()
+            qid = str(obj.get("id") or question_id(q))
+        else:
+            q = line
+            qid = question_id(q)
+        if q and qid not in seen:
+            seen.add(qid)
+            out.append((qid, q))
+    return out
+
+
+def answered_ids(out_path: Path) -> Set[str]:
+    """
+    Ids já respondidos com sucesso no JSONL de saída (linhas com erro serão refeitas).
+    """
+    done: Set[str] = set()
+    if not out_path.exists():
+        return done
+    for line in out_path.read_text(encoding="utf-8", errors="ignore").splitlines():
+        try:
+            rec = json.loads(line)
+        except ValueError:
+            continue  # linha parcial de uma execução interrompida
+        if rec.get("id") and not rec.get("error"):
+            done.add(rec["id"])
+    return done
+
+
+def run_batch_qa(
+    client: OpenAI,
+    ebook_text: str,
+    questions: Iterable[Tuple[str, str]],
+    out_path: str | Path,
+    workers: int = 4,
+    rpm: Optional[float] = None,
+    tpm: Optional[float] = None,
+    retriever: Optional[ContextSelector] = None,
+    on_result: Optional[Callable[[Dict[str, Any]], None]] = None,
+    semantic_cache: Optional[SemanticAnswerCache] = None,
+) -> Dict[str, int]:
+    """
+    Responde as perguntas em paralelo (até `workers` simultâneas, limitadas a `rpm`/`tpm` por minuto)
+    e grava cada resultado no JSONL assim que termina. Perguntas já presentes na saída são puladas.
+    Com `semantic_cache`, perguntas equivalentes a outras já respondidas não chamam a API (`cache_hit` no registro).
+    """
+    out = Path(out_path).expanduser().resolve()
+    out.parent.mkdir(parents=True, exist_ok=True)
+    done = answered_ids(out)
+    pending = [(qid, q) for qid, q in questions if qid not in done]
+    summary = {"total": len(pending) + len(done), "skipped": len(done), "answered": 0, "failed": 0}
+    if not pending:
+        return summary
+
+    if rpm or tpm:
+        # O limite vale para o agendador compartilhado por todas as chamadas do processo
+        get_scheduler().set_limits(rpm=rpm, tpm=tpm)
+    # Linha incompleta deixada por uma execução interrompida: começa em linha nova
+    needs_newline = out.exists() and out.stat().st_size > 0 and not out.read_bytes().endswith(b"\n")
+
+    def _answer(qid: str, question: str) -> Dict[str, Any]:
+        t0 = time.perf_counter()
+        rec: Dict[str, Any] = {"id": qid, "question": question}
+        try:
+            res = answer_with_ebook(
+                client, QARequest(ebook_text=ebook_text, question=question), retriever=retriever, semantic_cache=semantic_cache
+            )
+            rec.update(answer=res.answer, has_content=res.has_content, tokens_used=res.tokens_used, cache_hit=res.cache_hit)
+        except Exception as e:
+            rec.update(answer=None, has_content=False, tokens_used=None, error=str(e))
+        rec["latency_s"] = round(time.perf_counter() - t0, 3)
+        return rec
+
+    with out.open("a", encoding="utf-8") as fh, ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        if needs_newline:
+            fh.write("\n")
+        futures = [pool.submit(_answer, qid, q) for qid, q in pending]
+        for fut in as_completed(futures):
+            rec = fut.result()
+            # Gravação só na thread principal: cada linha sai inteira e imediatamente
+            fh.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            fh.flush()
+            summary["failed" if rec.get("error") else "answered"] += 1
+            if on_result is not None:
+                on_result(rec)
+    return summary
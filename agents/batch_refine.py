@@ -0,0 +1,293 @@
+from __future__ import annotations
+import json
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Protocol, Sequence, Tuple
+
+from openai import OpenAI
+from agents.refiner_agent import DEFAULT_REFINER_MODEL, refine_call_specs, stitch_refined_segments
+from api.usage import UsageRecord, get_ledger, usage_from_response
+from models.refiner_models import RefinerRequest
+from utils.io_utils import read_uploaded_text_or_pdf
+from utils.job_manifest import atomic_write_text
+from utils.pdf_extract import file_sha256
+from utils.response_cache import get_response_cache
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+COMPLETION_WINDOW = "24h"
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+SUPPORTED_SUFFIXES = (".txt", ".pdf")
+
+
+class BatchTransport(Protocol):
+    """
+    Envio e acompanhamento de um lote. A implementação padrão usa a Batch API da OpenAI;
+    um substituto local pode servir resultados prontos (mesmo formato JSONL de saída).
+    """
+
+    def submit(self, jsonl_path: Path, endpoint: str, metadata: Dict[str, str]) -> str: ...
+
+    def status(self, batch_id: str) -> Dict[str, Any]: ...
+
+    def fetch(self, file_id: str) -> str: ...
+
+
+class OpenAIBatchTransport:
+    def __init__(self, client: OpenAI) -> None:
+        self.client = client
+
+    def submit(self, jsonl_path: Path, endpoint: str, metadata: Dict[str, str]) -> str:
+        with open(jsonl_path, "rb") as fh:
+            uploaded = self.client.files.create(file=fh, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint=endpoint,
+            completion_window=COMPLETION_WINDOW,
+            metadata=metadata,
+        )
+        return batch.id
+
+    def status(self, batch_id: str) -> Dict[str, Any]:
+        return self.client.batches.retrieve(batch_id).model_dump()
+
+    def fetch(self, file_id: str) -> str:
+        return self.client.files.content(file_id).text
+
+
+class LocalBatchTransport:
+    """
+    Substituto local (sem rede): responde cada requisição do JSONL com `responder(custom_id, body)`
+    e devolve a saída no formato da Batch API. Útil para testar o fluxo completo.
+    """
+
+    def __init__(self, responder: Callable[[str, Dict[str, Any]], str]) -> None:
+        self.responder = responder
+        self._files: Dict[str, str] = {}
+        self._batches: Dict[str, Dict[str, Any]] = {}
+
+    def submit(self, jsonl_path: Path, endpoint: str, metadata: Dict[str, str]) -> str:
+        lines = []
+        for line in Path(jsonl_path).read_text(encoding="utf-8").splitlines():
+            req = json.loads(line)
+            text = self.responder(req["custom_id"], req["body"])
+            body = {
+                "model": req["body"].get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0},
+            }
+            lines.append(json.dumps({"custom_id": req["custom_id"], "response": {"status_code": 200, "body": body}, "error": None}))
+        batch_id = f"local_batch_{len(self._batches) + 1}"
+        self._files[f"{batch_id}_out"] = "\n".join(lines) + "\n"
+        self._batches[batch_id] = {"id": batch_id, "status": "completed", "output_file_id": f"{batch_id}_out", "error_file_id": None}
+        return batch_id
+
+    def status(self, batch_id: str) -> Dict[str, Any]:
+        return dict(self._batches[batch_id])
+
+    def fetch(self, file_id: str) -> str:
+        return self._files[file_id]
+
+
+@dataclass
+class BatchPlan:
+    """
+    Plano do lote (gravado ao lado do JSONL): de onde veio cada custom_id e onde salvar o resultado.
+    """
+
+    jsonl_path: Path
+    materials: Dict[str, Dict[str, Any]] = field(default_factory=dict)  # hash -> {source, stem, parts, output}
+    cache_keys: Dict[str, str] = field(default_factory=dict)  # custom_id -> chave do cache de respostas
+    batch_id: Optional[str] = None
+
+    @property
+    def plan_path(self) -> Path:
+        return self.jsonl_path.with_suffix(".plan.json")
+
+    def save(self) -> Path:
+        payload = {
+            "jsonl": str(self.jsonl_path),
+            "batch_id": self.batch_id,
+            "materials": self.materials,
+            "cache_keys": self.cache_keys,
+        }
+        return atomic_write_text(self.plan_path, json.dumps(payload, ensure_ascii=False, indent=2))
+
+    @classmethod
+    def load(cls, plan_path: str | Path) -> "BatchPlan":
+        data = json.loads(Path(plan_path).expanduser().read_text(encoding="utf-8"))
+        materials = data.get("materials", {})
+        if any("output" not in info for info in materials.values()):
+            _assign_outputs(materials)  # plano gravado antes de `output`: nomes-base repetidos se sobrescreviam
+        return cls(
+            jsonl_path=Path(data["jsonl"]),
+            materials=materials,
+            cache_keys=data.get("cache_keys", {}),
+            batch_id=data.get("batch_id"),
+        )
+
+
+def _custom_id(digest: str, part: int, total: int) -> str:
+    return f"{digest[:16]}:{part}/{total}"
+
+
+def output_name(info: Dict[str, Any]) -> str:
+    """
+    Nome do arquivo refinado de um material do plano (planos antigos não gravavam `output`).
+    """
+    return info.get("output") or f"{info['stem']}_refinado.txt"
+
+
+def _assign_outputs(materials: Dict[str, Dict[str, Any]]) -> None:
+    # `aula.txt` e `aula.pdf` gerariam o mesmo <stem>_refinado.txt: quem colide ganha a extensão no nome
+    # e, se ainda colidir (mesmo nome em pastas diferentes), o início do hash. Comparação sem caixa (Windows)
+    stems: Dict[str, int] = {}
+    for info in materials.values():
+        stems[info["stem"].lower()] = stems.get(info["stem"].lower(), 0) + 1
+    names: Dict[str, str] = {}
+    for digest, info in materials.items():
+        base = info["stem"]
+        if stems[base.lower()] > 1:
+            base = f"{base}_{Path(info['source']).suffix.lstrip('.').lower() or 'sem-extensao'}"
+        names[digest] = base
+    counts: Dict[str, int] = {}
+    for base in names.values():
+        counts[base.lower()] = counts.get(base.lower(), 0) + 1
+    for digest, base in names.items():
+        if counts[base.lower()] > 1:
+            base = f"{base}_{digest[:8]}"
+        materials[digest]["output"] = f"{base}_refinado.txt"
+
+
+def find_transcripts(folder: str | Path) -> List[Path]:
+    """
+    Arquivos .txt/.pdf da pasta (não recursivo), em ordem alfabética.
+    """
+    base = Path(folder).expanduser().resolve()
+    if not base.is_dir():
+        raise FileNotFoundError(f"Pasta não encontrada: {base}")
+    return sorted(p for p in base.iterdir() if p.is_file() and p.suffix.lower() in SUPPORTED_SUFFIXES)
+
+
+def build_refine_batch(
+    inputs: Sequence[Path],
+    jsonl_path: str | Path,
+    max_segment_tokens: int = 4000,
+    overlap_tokens: int = 150,
+) -> BatchPlan:
+    """
+    Gera o JSONL da Batch API com uma requisição por segmento de cada transcrição,
+    usando exatamente os prompts do refino interativo (`refine_transcript_segmented`).
+    Arquivos idênticos (mesmo SHA-256) entram uma única vez; materiais com o mesmo nome-base
+    recebem nomes de saída distintos (ver `output_name`).
+    """
+    plan = BatchPlan(jsonl_path=Path(jsonl_path).expanduser().resolve())
+    lines: List[str] = []
+    for path in inputs:
+        digest = file_sha256(path)
+        if digest in plan.materials:
+            continue
+        text = RefinerRequest(transcript_text=read_uploaded_text_or_pdf(path, path.name)).transcript_text
+        specs = refine_call_specs(text, max_segment_tokens=max_segment_tokens, overlap_tokens=overlap_tokens)
+        plan.materials[digest] = {"source": str(path), "stem": path.stem, "parts": len(specs)}
+        for k, (call_kwargs, cache_key) in enumerate(specs, 1):
+            cid = _custom_id(digest, k, len(specs))
+            plan.cache_keys[cid] = cache_key
+            lines.append(json.dumps({"custom_id": cid, "method": "POST", "url": BATCH_ENDPOINT, "body": call_kwargs}, ensure_ascii=False))
+    _assign_outputs(plan.materials)
+    atomic_write_text(plan.jsonl_path, "\n".join(lines) + ("\n" if lines else ""))
+    plan.save()
+    return plan
+
+
+def submit_batch(transport: BatchTransport, plan: BatchPlan) -> str:
+    plan.batch_id = transport.submit(plan.jsonl_path, BATCH_ENDPOINT, {"job": "ebookqa-refine"})
+    plan.save()
+    return plan.batch_id
+
+
+def poll_batch(
+    transport: BatchTransport,
+    batch_id: str,
+    interval_s: float = 60.0,
+    timeout_s: Optional[float] = None,
+    on_status: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> Dict[str, Any]:
+    """
+    Consulta o lote a cada `interval_s` até um estado final (ou `timeout_s`, que lança TimeoutError).
+    """
+    t0 = time.monotonic()
+    while True:
+        status = transport.status(batch_id)
+        if on_status is not None:
+            on_status(status)
+        if status.get("status") in TERMINAL_STATUSES:
+            return status
+        if timeout_s is not None and time.monotonic() - t0 > timeout_s:
+            raise TimeoutError(f"Lote {batch_id} não terminou em {timeout_s:.0f}s (status: {status.get('status')}).")
+        time.sleep(interval_s)
+
+
+def _parse_output_line(line: str) -> Tuple[str, Optional[str], Optional[Dict[str, Any]], Optional[str]]:
+    rec = json.loads(line)
+    cid = rec.get("custom_id", "")
+    resp = rec.get("response") or {}
+    if rec.get("error") or resp.get("status_code") != 200:
+        err = rec.get("error") or (resp.get("body") or {}).get("error") or f"HTTP {resp.get('status_code')}"
+        return cid, None, None, str(err)
+    body = resp.get("body") or {}
+    choices = body.get("choices") or []
+    text = ((choices[0].get("message") or {}).get("content") if choices else None) or ""
+    return cid, text.strip(), body, None
+
+
+def collect_batch_results(
+    transport: BatchTransport,
+    plan: BatchPlan,
+    status: Dict[str, Any],
+    out_dir: str | Path,
+) -> Tuple[List[Path], Dict[str, str]]:
+    """
+    Baixa a saída do lote, agrupa as partes por custom_id, costura cada material na ordem
+    e grava o arquivo de cada um (`output_name`, em geral `<stem>_refinado.txt`) em `out_dir`. Cada parte também vai para o cache de respostas,
+    de modo que o refino interativo do mesmo material não paga de novo.
+    Retorna (arquivos gravados, {fonte: motivo} dos materiais com partes faltando ou com erro).
+    """
+    out_dir = Path(out_dir).expanduser().resolve()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    parts: Dict[str, str] = {}
+    errors: Dict[str, str] = {}
+    if status.get("output_file_id"):
+        for line in transport.fetch(status["output_file_id"]).splitlines():
+            if not line.strip():
+                continue
+            cid, text, body, err = _parse_output_line(line)
+            if err is not None or not text:
+                errors[cid] = err or "resposta vazia"
+                continue
+            parts[cid] = text
+            usage = usage_from_response(body)
+            get_ledger().record(UsageRecord(operation="refine_batch", model=body.get("model") or DEFAULT_REFINER_MODEL, **usage))
+            cache_key = plan.cache_keys.get(cid)
+            if cache_key:
+                payload = {"ebook_text": text, "tokens_used": usage["input_tokens"] + usage["output_tokens"], "had_redactions": None}
+                get_response_cache().set(cache_key, json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+    if status.get("error_file_id"):
+        for line in transport.fetch(status["error_file_id"]).splitlines():
+            if line.strip():
+                cid, _text, _body, err = _parse_output_line(line)
+                errors[cid] = err or "erro"
+
+    written: List[Path] = []
+    failed: Dict[str, str] = {}
+    for digest, info in plan.materials.items():
+        total = int(info["parts"])
+        ids = [_custom_id(digest, k, total) for k in range(1, total + 1)]
+        missing = [cid for cid in ids if cid not in parts]
+        if missing:
+            reasons = {errors.get(cid, "sem resultado") for cid in missing}
+            failed[info["source"]] = f"{len(missing)}/{total} parte(s) sem resultado: " + "; ".join(sorted(reasons))
+            continue
+        text = stitch_refined_segments([parts[cid] for cid in ids])
+        written.append(atomic_write_text(out_dir / output_name(info), text))
+    return written, failed
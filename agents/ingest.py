@@ -0,0 +1,155 @@
+from __future__ import annotations
+import concurrent.futures as cf
+import os
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, Iterator, Optional, Sequence, Tuple
+
+from openai import OpenAI
+from agents.refiner_agent import refine_transcript_segmented
+from models.refiner_models import RefinerRequest
+from utils.text_utils import estimate_tokens
+
+# (caminho, hash) -> texto; precisa ser uma função de módulo para ir ao pool de processos
+ReadFn = Callable[[Path, Optional[str]], str]
+
+
+@dataclass
+class IngestResult:
+    index: int  # posição na seleção (0-based)
+    path: Path
+    text: str = ""  # texto final (refinado ou original); vazio = material ignorado
+    refined: bool = False
+    tokens_used: int = 0
+    error: Optional[str] = None  # falha de leitura (material ignorado)
+    warning: Optional[str] = None  # falha no refino (texto original usado)
+    seconds: float = 0.0
+
+
+@dataclass
+class IngestProgress:
+    done: int
+    total: int
+    tokens: int
+    elapsed_s: float
+
+    @property
+    def tokens_per_s(self) -> float:
+        return self.tokens / self.elapsed_s if self.elapsed_s > 0 else 0.0
+
+    @property
+    def eta_s(self) -> Optional[float]:
+        if not self.done:
+            return None
+        return self.elapsed_s / self.done * (self.total - self.done)
+
+    def format(self) -> str:
+        eta = "--:--" if self.eta_s is None else f"{int(self.eta_s) // 60:02d}:{int(self.eta_s) % 60:02d}"
+        return f"[{self.done}/{self.total}] {self.tokens_per_s:,.0f} tokens/s | ETA {eta}"
+
+
+def _init_extract_worker() -> None:
+    # Cada arquivo já ocupa um processo: sem pool de páginas aninhado dentro do worker
+    os.environ["EBOOKQA_PDF_WORKERS"] = "1"
+
+
+def _extract(read_fn: ReadFn, path: Path, digest: Optional[str]) -> Tuple[str, float]:
+    t0 = time.perf_counter()
+    return read_fn(path, digest), time.perf_counter() - t0
+
+
+def _refine(client: OpenAI, text: str) -> Tuple[str, int, float]:
+    t0 = time.perf_counter()
+    out = refine_transcript_segmented(client, RefinerRequest(transcript_text=text))
+    return (out.ebook_text or "").strip(), int(out.tokens_used or 0), time.perf_counter() - t0
+
+
+def run_ingest_pipeline(
+    materials: Sequence[Tuple[Path, Optional[str]]],
+    read_fn: ReadFn,
+    client: Optional[OpenAI] = None,
+    refine: bool = False,
+    extract_workers: Optional[int] = None,
+    refine_workers: int = 3,
+    on_progress: Optional[Callable[[IngestProgress], None]] = None,
+) -> Iterator[IngestResult]:
+    """
+    Ingestão em pipeline de vários arquivos:
+    - extração (CPU) num pool de processos, um arquivo por worker;
+    - refino (rede) num pool de threads com `refine_workers` materiais simultâneos;
+    - os resultados são entregues (para salvar) na ordem da seleção, assim que o próximo fica pronto.
+    Falha em um arquivo vira um IngestResult com `error`/`warning`, sem travar os demais.
+    Com um único arquivo a extração roda no próprio processo (o PDF usa o pool de páginas).
+    """
+    total = len(materials)
+    if refine and client is None:
+        raise ValueError("client é obrigatório quando refine=True.")
+    workers = extract_workers or min(total, os.cpu_count() or 1)
+    if workers > 1:
+        extract_pool: cf.Executor = cf.ProcessPoolExecutor(max_workers=workers, initializer=_init_extract_worker)
+    else:
+        extract_pool = cf.ThreadPoolExecutor(max_workers=1)
+    refine_pool = cf.ThreadPoolExecutor(max_workers=max(1, refine_workers))
+
+    t0 = time.perf_counter()
+    tokens = 0
+    ready: Dict[int, IngestResult] = {}
+    stage: Dict[cf.Future, Tuple[str, int]] = {}
+    raw: Dict[int, str] = {}
+    seconds: Dict[int, float] = {}
+    next_index = 0
+    try:
+        for i, (path, digest) in enumerate(materials):
+            stage[extract_pool.submit(_extract, read_fn, path, digest)] = ("extract", i)
+        pending = set(stage)
+        while pending:
+            finished, pending = cf.wait(pending, return_when=cf.FIRST_COMPLETED)
+            for fut in finished:
+                kind, i = stage.pop(fut)
+                path = materials[i][0]
+                if kind == "extract":
+                    try:
+                        text, secs = fut.result()
+                    except Exception as e:
+                        ready[i] = IngestResult(i, path, error=f"Falha na leitura de {path.name}: {e}")
+                        continue
+                    seconds[i] = secs
+                    if not text.strip():
+                        ready[i] = IngestResult(i, path, error=f"Texto vazio em {path.name}; material ignorado.", seconds=secs)
+                    elif refine:
+                        raw[i] = text
+                        nxt = refine_pool.submit(_refine, client, text)
+                        stage[nxt] = ("refine", i)
+                        pending.add(nxt)
+                    else:
+                        tokens += estimate_tokens(text)
+                        ready[i] = IngestResult(i, path, text=text.strip(), seconds=secs)
+                else:
+                    original = raw.pop(i)
+                    try:
+                        text, used, secs = fut.result()
+                    except Exception as e:
+                        ready[i] = IngestResult(
+                            i, path, text=original.strip(), warning=f"Falha no tratamento de {path.name} ({e}); usando original.",
+                            seconds=seconds[i],
+                        )
+                        continue
+                    tokens += used
+                    if not text:
+                        ready[i] = IngestResult(
+                            i, path, text=original.strip(), tokens_used=used, seconds=seconds[i] + secs,
+                            warning=f"Agente não retornou texto para {path.name}; usando original.",
+                        )
+                    else:
+                        ready[i] = IngestResult(i, path, text=text, refined=True, tokens_used=used, seconds=seconds[i] + secs)
+
+            if on_progress is not None:
+                on_progress(IngestProgress(next_index + len(ready), total, tokens, time.perf_counter() - t0))
+            # Etapa de saída: entrega em ordem tudo o que já está pronto
+            while next_index in ready:
+                yield ready.pop(next_index)
+                next_index += 1
+    finally:
+        extract_pool.shutdown(wait=False, cancel_futures=True)
+        refine_pool.shutdown(wait=False, cancel_futures=True)
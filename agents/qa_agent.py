@@ -1,9 +1,43 @@
 from __future__ import annotations
-from typing import Optional
-from openai import OpenAI
+import asyncio
+import re
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+import openai
+from openai import AsyncOpenAI, OpenAI
+from api.concurrency import get_async_semaphore
+from api.scheduler import CallStats
+from api.usage import total_tokens, usage_from_response
+from agents.base import create_response, create_response_async, record_usage
+from agents.streaming import TextStream, aiter_text_deltas, iter_text_deltas
 from models.qa_models import QARequest, QAOutput
+from utils.doc_router import DEFAULT_ROUTE_DOCS, DEFAULT_ROUTE_STEP, DocumentProfile, DocumentRouter
+from utils.retrieval import BM25Index, ContextSelector, DEFAULT_TOKEN_BUDGET, DEFAULT_TOP_K
+from utils.response_cache import get_response_cache, response_cache_key
+from utils.semantic_cache import SemanticAnswerCache
+from utils.text_utils import estimate_tokens, split_segments
 
 DEFAULT_QA_MODEL = "gpt-4.1-mini"
+_CHAT_QA_MODEL = "gpt-4o-mini"  # rota Chat Completions (SDKs sem a API Responses)
+
+# Sessões: ebook até este tamanho vai uma única vez como prefixo estável; acima disso, recuperação por pergunta.
+# É um teto de custo: o limite efetivo também respeita a janela de contexto do modelo (session_prefix_limit)
+DEFAULT_SESSION_PREFIX_TOKENS = 100_000
+DEFAULT_HISTORY_TURNS = 6
+CONTEXT_WINDOWS = {"gpt-4o-mini": 128_000, "gpt-4.1-mini": 1_047_576}
+DEFAULT_CONTEXT_WINDOW = 128_000
+SESSION_OUTPUT_TOKENS = 4_096  # reservados para a resposta
+SESSION_TURN_TOKENS = 1_500  # pergunta + resposta de cada turno do histórico
+SESSION_OVERHEAD_TOKENS = 1_000  # instruções do sistema e da pergunta
+SESSION_SAFETY_MARGIN = 0.10  # fração da janela mantida livre
+SESSION_TOKEN_FACTOR = 1.3  # estimate_tokens (~4 caracteres/token) subestima o português
+DOCUMENT_SEPARATOR = "\n\n" + ("-" * 80) + "\n"  # entre ebooks de uma mesma base
+
+# Map-reduce (materiais muito longos): fatias do tamanho de uma janela, respondidas em paralelo
+DEFAULT_SLICE_TOKENS = 16_000
+DEFAULT_SLICE_OVERLAP = 200
+DEFAULT_ENOUGH_SLICES = 2  # respostas de alta confiança que encerram a varredura
+DEFAULT_MAX_PARTIALS = 12  # respostas parciais levadas à etapa de redução
 
 _QA_SYSTEM = (
     "Você é um assistente acadêmico. Responda exclusivamente com base no ebook ou no material da base de dados recebida. "
@@ -36,54 +70,839 @@ def _normalize_answer(txt: str) -> str:
         return _INSUFF_PHRASE
     return txt.strip()
 
+def _build_user_prompt(context: str, question: str) -> str:
+    return (
+        "Use exclusivamente o conteúdo-base abaixo para responder à pergunta. "
+        "Se a resposta não puder ser fundamentada apenas no conteúdo-base, "
+        f"responda exatamente: \"{_INSUFF_PHRASE}\"\n\n"
+        "Conteúdo-base (ebook):\n----- INÍCIO -----\n"
+        f"{context}\n"
+        "----- FIM -----\n\n"
+        "Pergunta do usuário:\n"
+        f"{question}\n\n"
+        "Instruções finais:\n"
+        f"- Responda somente com base no conteúdo-base, procure exaustivamente a informação.\n"
+        f"- Se não houver base suficiente, responda exatamente: \"{_INSUFF_PHRASE}\""
+    )
+
+def _insufficient_output(req: QARequest) -> QAOutput:
+    if req.fallback_on_insufficient == "none":
+        return QAOutput(answer="", has_content=False)
+    return QAOutput(answer=_INSUFF_PHRASE, has_content=False)
+
+def _resolve_context(
+    req: QARequest,
+    retriever: Optional[ContextSelector],
+    top_k: int,
+    token_budget: int,
+) -> Optional[str]:
+    if retriever is not None and estimate_tokens(req.ebook_text) > token_budget:
+        return retriever.select_context(req.question, top_k=top_k, token_budget=token_budget)
+    return req.ebook_text
+
+def _call_spec(use_responses: bool, model: str, user_prompt: str) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Monta os argumentos da chamada (Responses ou Chat Completions) e as configurações usadas na chave do cache.
+    """
+    messages = [
+        {"role": "system", "content": _QA_SYSTEM},
+        {"role": "user", "content": user_prompt},
+    ]
+    if use_responses:
+        return {"model": model, "input": messages}, {"api": "responses"}
+    # Fallback: Chat Completions (compatível com qualquer 1.x)
+    # ajuste aqui se desejar manter o mesmo modelo na rota antiga
+    kwargs = {"model": _CHAT_QA_MODEL, "messages": messages, "temperature": 0.0}
+    return kwargs, {"api": "chat", "temperature": 0.0}
+
+def _parse_response(resp, use_responses: bool) -> str:
+    if use_responses:
+        return _normalize_answer(_extract_text_from_responses(resp) or "")
+    return _normalize_answer(resp.choices[0].message.content if resp.choices else "")
+
+def _finish(answer_text: str, req: QARequest, tokens_used: Optional[int] = None) -> QAOutput:
+    if answer_text == _INSUFF_PHRASE:
+        return _insufficient_output(req).model_copy(update={"tokens_used": tokens_used})
+    return QAOutput(answer=answer_text, has_content=True, tokens_used=tokens_used)
+
+def _cache_lookup(cache_key: Optional[str], model: str) -> Optional[QAOutput]:
+    if cache_key is None:
+        return None
+    cached = get_response_cache().get(cache_key)
+    if cached is None:
+        return None
+    record_usage("qa", model, cache_hit=True)
+    # Acerto no cache não consome tokens
+    return QAOutput.model_validate_json(cached).model_copy(update={"tokens_used": 0, "cache_hit": True})
+
+def _semantic_lookup(cache: Optional[SemanticAnswerCache], req: QARequest, model: str) -> Optional[QAOutput]:
+    """
+    Resposta de uma pergunta equivalente já feita sobre o mesmo ebook (ver SemanticAnswerCache).
+    """
+    if cache is None or not cache.covers(req.ebook_text):
+        return None
+    hit = cache.lookup(req.question)
+    if hit is None:
+        return None
+    record_usage("qa", model, cache_hit=True)
+    return QAOutput.model_validate_json(hit.payload).model_copy(
+        update={"tokens_used": 0, "cached_tokens": None, "cache_hit": True}
+    )
+
+def _semantic_store(cache: Optional[SemanticAnswerCache], req: QARequest, out: QAOutput) -> None:
+    # Só respostas fundamentadas: uma reformulação da pergunta ainda pode encontrar base no material
+    if cache is not None and out.has_content and not out.cache_hit and cache.covers(req.ebook_text):
+        cache.add(req.question, out.model_dump_json(include={"answer", "has_content"}))
+
+def _cache_key(req: QARequest, call_kwargs: Dict[str, Any], settings: Dict[str, Any], user_prompt: str) -> str:
+    settings = dict(settings, fallback_on_insufficient=req.fallback_on_insufficient)
+    return response_cache_key("qa", call_kwargs["model"], _QA_SYSTEM, user_prompt, settings)
+
 def answer_with_ebook(
     client: OpenAI,
     req: QARequest,
     model: str = DEFAULT_QA_MODEL,
+    retriever: Optional[ContextSelector] = None,
+    top_k: int = DEFAULT_TOP_K,
+    token_budget: int = DEFAULT_TOKEN_BUDGET,
+    use_cache: bool = True,
+    semantic_cache: Optional[SemanticAnswerCache] = None,
 ) -> QAOutput:
     """
     Responde usando SOMENTE o ebook ou o material da base de dados recebida. Retorna QAOutput com controle estrito da mensagem de insuficiência.
+    Com `retriever` (ex.: BM25Index construído uma vez por sessão), envia apenas os top_k blocos
+    relevantes dentro de `token_budget`, em vez do ebook inteiro (ebooks menores que o orçamento
+    continuam indo completos).
+    Respostas ficam no cache persistente (modelo + prompts + configurações); `use_cache=False` desativa.
+    Com `semantic_cache`, perguntas equivalentes a uma já respondida sobre o mesmo ebook voltam na hora
+    (QAOutput com `cache_hit=True`), sem recuperar contexto nem chamar a API.
     """
-    user_prompt = (
-        "Use exclusivamente o conteúdo-base abaixo para responder à pergunta. "
+    hit = _semantic_lookup(semantic_cache, req, model)
+    if hit is not None:
+        return hit
+    context = _resolve_context(req, retriever, top_k, token_budget)
+    if not context:
+        # Nenhum trecho do material casa com a pergunta: não há base para responder.
+        return _insufficient_output(req)
+    user_prompt = _build_user_prompt(context, req.question)
+
+    # Caminho preferencial: API Responses (se disponível)
+    use_responses = hasattr(client, "responses")
+    call_kwargs, settings = _call_spec(use_responses, model, user_prompt)
+
+    cache_key = _cache_key(req, call_kwargs, settings, user_prompt) if use_cache else None
+    hit = _cache_lookup(cache_key, call_kwargs["model"])
+    if hit is not None:
+        return hit
+
+    resp = create_response(client, use_responses, call_kwargs, "qa")
+    out = _finish(_parse_response(resp, use_responses), req, total_tokens(resp))
+
+    if cache_key is not None:
+        get_response_cache().set(cache_key, out.model_dump_json().encode("utf-8"))
+    _semantic_store(semantic_cache, req, out)
+    return out
+
+async def answer_with_ebook_async(
+    client: AsyncOpenAI,
+    req: QARequest,
+    model: str = DEFAULT_QA_MODEL,
+    retriever: Optional[ContextSelector] = None,
+    top_k: int = DEFAULT_TOP_K,
+    token_budget: int = DEFAULT_TOKEN_BUDGET,
+    use_cache: bool = True,
+    semantic_cache: Optional[SemanticAnswerCache] = None,
+) -> QAOutput:
+    """
+    Versão assíncrona de `answer_with_ebook` (cliente AsyncOpenAI).
+    As chamadas de rede respeitam o limite global de concorrência (api.concurrency).
+    """
+    hit = _semantic_lookup(semantic_cache, req, model)
+    if hit is not None:
+        return hit
+    context = _resolve_context(req, retriever, top_k, token_budget)
+    if not context:
+        return _insufficient_output(req)
+    user_prompt = _build_user_prompt(context, req.question)
+
+    use_responses = hasattr(client, "responses")
+    call_kwargs, settings = _call_spec(use_responses, model, user_prompt)
+
+    cache_key = _cache_key(req, call_kwargs, settings, user_prompt) if use_cache else None
+    hit = _cache_lookup(cache_key, call_kwargs["model"])
+    if hit is not None:
+        return hit
+
+    async with get_async_semaphore():
+        resp = await create_response_async(client, use_responses, call_kwargs, "qa")
+    out = _finish(_parse_response(resp, use_responses), req, total_tokens(resp))
+
+    if cache_key is not None:
+        get_response_cache().set(cache_key, out.model_dump_json().encode("utf-8"))
+    _semantic_store(semantic_cache, req, out)
+    return out
+
+_CONFIDENCE_RE = re.compile(r"^\W*confian[çc]a\W*(alta|parcial)\W*", re.IGNORECASE)
+
+def _build_map_prompt(context: str, question: str, part: Tuple[int, int]) -> str:
+    return (
+        f"Atenção: o conteúdo-base abaixo é o trecho {part[0]} de {part[1]} de um material maior; "
+        "os demais trechos são analisados separadamente. Responda apenas com o que este trecho sustenta. "
+        "Se ele responder à pergunta, comece com a linha \"CONFIANÇA: ALTA\" (responde direta e completamente) "
+        "ou \"CONFIANÇA: PARCIAL\" (responde só em parte).\n\n"
+        + _build_user_prompt(context, question)
+    )
+
+def _build_reduce_prompt(question: str, partials: Sequence[str]) -> str:
+    blocks = "\n\n".join(f"[Resposta parcial {i}]\n{answer}" for i, answer in enumerate(partials, 1))
+    return (
+        "As respostas parciais abaixo foram obtidas de trechos diferentes do mesmo material, na ordem do texto, "
+        "cada uma com base apenas no seu trecho. Combine-as em uma única resposta à pergunta: una as informações "
+        "complementares, elimine repetições e, se houver divergência, apresente as versões encontradas. "
+        "Não acrescente nada que não esteja nas respostas parciais nem mencione os trechos.\n\n"
+        f"Respostas parciais:\n----- INÍCIO -----\n{blocks}\n----- FIM -----\n\n"
+        "Pergunta do usuário:\n"
+        f"{question}\n\n"
+        f"Se nenhuma resposta parcial sustentar uma resposta, responda exatamente: \"{_INSUFF_PHRASE}\""
+    )
+
+def _parse_partial(text: str) -> Tuple[str, bool]:
+    """
+    (resposta sem a linha de confiança, alta confiança?); sem base, a resposta vira a frase de insuficiência.
+    """
+    text = text or ""
+    m = _CONFIDENCE_RE.match(text)
+    body = text[m.end():] if m else text
+    return _normalize_answer(body), bool(m and m.group(1).lower() == "alta")
+
+def _raw_cache_key(use_responses: bool, model: str, user_prompt: str, use_cache: bool, stage: str) -> Optional[str]:
+    if not use_cache:
+        return None
+    call_kwargs, settings = _call_spec(use_responses, model, user_prompt)
+    return response_cache_key(stage, call_kwargs["model"], _QA_SYSTEM, user_prompt, settings)
+
+def _raw_cache_lookup(cache_key: Optional[str], model: str) -> Optional[str]:
+    if cache_key is None:
+        return None
+    cached = get_response_cache().get(cache_key)
+    if cached is None:
+        return None
+    record_usage("qa", model, cache_hit=True)
+    return cached.decode("utf-8")
+
+async def _raw_answer_async(
+    client: AsyncOpenAI,
+    use_responses: bool,
+    model: str,
+    user_prompt: str,
+    cache_key: Optional[str],
+) -> Tuple[str, Optional[int]]:
+    """
+    Uma chamada do map-reduce: texto bruto da resposta (guardado em `cache_key`) e tokens gastos.
+    """
+    call_kwargs, _settings = _call_spec(use_responses, model, user_prompt)
+    async with get_async_semaphore():
+        resp = await create_response_async(client, use_responses, call_kwargs, "qa")
+    if use_responses:
+        text = _extract_text_from_responses(resp) or ""
+    else:
+        text = (resp.choices[0].message.content if resp.choices else "") or ""
+    if cache_key is not None:
+        get_response_cache().set(cache_key, text.encode("utf-8"))
+    return text, total_tokens(resp)
+
+async def answer_with_ebook_mapreduce_async(
+    client: AsyncOpenAI,
+    req: QARequest,
+    model: str = DEFAULT_QA_MODEL,
+    slice_tokens: int = DEFAULT_SLICE_TOKENS,
+    overlap_tokens: int = DEFAULT_SLICE_OVERLAP,
+    enough: int = DEFAULT_ENOUGH_SLICES,
+    max_partials: int = DEFAULT_MAX_PARTIALS,
+    use_cache: bool = True,
+    semantic_cache: Optional[SemanticAnswerCache] = None,
+    on_progress: Optional[Callable[[int, int, int], None]] = None,
+) -> QAOutput:
+    """
+    Alternativa a `answer_with_ebook` para materiais muito longos (map-reduce):
+    1) divide o ebook em fatias de até `slice_tokens` e faz a pergunta a todas em paralelo, disparadas
+       da mais à menos relevante (BM25), com o paralelismo real limitado pelo semáforo compartilhado;
+    2) descarta as fatias sem base e, assim que `enough` fatias responderem com alta confiança,
+       cancela as requisições restantes (`enough=0` varre todas);
+    3) une as respostas parciais (até `max_partials`) em uma única chamada de redução.
+    O tempo total fica perto do de poucas chamadas, qualquer que seja o tamanho do material.
+    `on_progress(concluídas, total, com resposta)` é chamado a cada fatia.
+    Material que cabe em uma fatia segue pelo caminho normal (`answer_with_ebook_async`).
+    A varredura é pedida justamente quando a resposta anterior não bastou: `semantic_cache` não é consultado,
+    só recebe a resposta nova (que passa a valer para a pergunta).
+    """
+    slices = split_segments(req.ebook_text, max_tokens=slice_tokens, overlap_tokens=overlap_tokens)
+    if len(slices) <= 1:
+        out = await answer_with_ebook_async(client, req, model=model, use_cache=use_cache)
+        _semantic_store(semantic_cache, req, out)
+        if on_progress is not None:
+            on_progress(1, 1, int(out.has_content))
+        return out
+
+    total = len(slices)
+    ranked = [ch.index for ch, _s in BM25Index(slices).search(req.question, top_k=total)]
+    seen = set(ranked)
+    order = ranked + [i for i in range(total) if i not in seen]
+
+    use_responses = hasattr(client, "responses")
+    call_model = _call_spec(use_responses, model, "")[0]["model"]  # modelo efetivo (rota Chat usa outro)
+    prompts = {i: _build_map_prompt(slices[i].text, req.question, (i + 1, total)) for i in order}
+    keys = {i: _raw_cache_key(use_responses, model, prompts[i], use_cache, "qa_map") for i in order}
+    partials: Dict[int, Tuple[str, bool]] = {}
+    counts: List[int] = []
+    errors: List[Exception] = []
+
+    def _collect(i: int, text: str, used: Optional[int]) -> None:
+        if used is not None:
+            counts.append(used)
+        answer, high = _parse_partial(text)
+        if answer != _INSUFF_PHRASE:
+            partials[i] = (answer, high)
+
+    def _enough() -> bool:
+        return enough > 0 and sum(1 for _a, high in partials.values() if high) >= enough
+
+    # Fatias já respondidas (cache) primeiro: pergunta repetida não abre nenhuma requisição
+    remaining = []
+    for i in order:
+        cached = _raw_cache_lookup(keys[i], call_model) if not _enough() else None
+        if cached is None:
+            remaining.append(i)
+        else:
+            _collect(i, cached, 0)
+    if on_progress is not None and len(remaining) < total:
+        on_progress(total - len(remaining), total, len(partials))
+
+    # Criadas na ordem de relevância: o semáforo libera as vagas na mesma ordem
+    tasks = {} if _enough() else {
+        asyncio.ensure_future(_raw_answer_async(client, use_responses, model, prompts[i], keys[i])): i
+        for i in remaining
+    }
+    pending = set(tasks)
+    try:
+        while pending:
+            finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                try:
+                    _collect(tasks[task], *task.result())
+                except openai.OpenAIError as e:
+                    errors.append(e)  # uma fatia com erro não derruba a varredura
+            if on_progress is not None:
+                on_progress(total - len(pending), total, len(partials))
+            if _enough():
+                break
+    finally:
+        # Encerramento antecipado (ou cancelamento externo): aborta as requisições em andamento
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    if not partials and errors:
+        raise errors[0]
+    position = {i: pos for pos, i in enumerate(order)}
+    picked = sorted(sorted(partials, key=lambda i: (not partials[i][1], position[i]))[:max(1, max_partials)])
+    if not picked:
+        answer_text = _INSUFF_PHRASE
+    elif len(picked) == 1:
+        answer_text = partials[picked[0]][0]
+    else:
+        prompt = _build_reduce_prompt(req.question, [partials[i][0] for i in picked])
+        key = _raw_cache_key(use_responses, model, prompt, use_cache, "qa_reduce")
+        text = _raw_cache_lookup(key, call_model)
+        if text is None:
+            text, used = await _raw_answer_async(client, use_responses, model, prompt, key)
+            if used is not None:
+                counts.append(used)
+        answer_text = _normalize_answer(text)
+
+    out = _finish(answer_text, req, sum(counts) if counts else None)
+    _semantic_store(semantic_cache, req, out)
+    return out
+
+def answer_with_ebook_stream(
+    client: OpenAI,
+    req: QARequest,
+    model: str = DEFAULT_QA_MODEL,
+    retriever: Optional[ContextSelector] = None,
+    top_k: int = DEFAULT_TOP_K,
+    token_budget: int = DEFAULT_TOKEN_BUDGET,
+    use_cache: bool = True,
+    semantic_cache: Optional[SemanticAnswerCache] = None,
+) -> TextStream[QAOutput]:
+    """
+    Versão em streaming de `answer_with_ebook`: iterar o retorno devolve os deltas de texto.
+    Ao fim do stream, a normalização da frase de insuficiência é aplicada e o QAOutput
+    fica disponível em `.result` (e vai para o cache).
+    """
+    semantic_hit = _semantic_lookup(semantic_cache, req, model)
+    if semantic_hit is not None:
+        return TextStream([semantic_hit.answer] if semantic_hit.answer else [], lambda _text: semantic_hit)
+    context = _resolve_context(req, retriever, top_k, token_budget)
+    if not context:
+        out = _insufficient_output(req)
+        return TextStream([out.answer] if out.answer else [], lambda _text: out)
+    user_prompt = _build_user_prompt(context, req.question)
+
+    use_responses = hasattr(client, "responses")
+    call_kwargs, settings = _call_spec(use_responses, model, user_prompt)
+
+    cache_key = _cache_key(req, call_kwargs, settings, user_prompt) if use_cache else None
+    hit = _cache_lookup(cache_key, call_kwargs["model"])
+    if hit is not None:
+        return TextStream([hit.answer] if hit.answer else [], lambda _text: hit)
+
+    t0 = time.perf_counter()
+    stats = CallStats()
+    stream = create_response(client, use_responses, call_kwargs, "qa", stats=stats, stream=True)
+    final: Dict[str, Any] = {}
+
+    def _finalize(text: str) -> QAOutput:
+        resp = final.get("resp")
+        record_usage("qa", call_kwargs["model"], resp, time.perf_counter() - t0, stats, streamed=True)
+        out = _finish(_normalize_answer(text), req, total_tokens(resp) if resp is not None else None)
+        if cache_key is not None:
+            get_response_cache().set(cache_key, out.model_dump_json().encode("utf-8"))
+        _semantic_store(semantic_cache, req, out)
+        return out
+
+    deltas = iter_text_deltas(stream, on_usage=lambda r: final.__setitem__("resp", r))
+    return TextStream(deltas, _finalize, close=getattr(stream, "close", None))
+
+def _session_prefix(ebook_text: str) -> str:
+    # Prefixo idêntico em todas as perguntas da sessão: é o que o cache de prompt do provedor reaproveita
+    return (
+        f"{_QA_SYSTEM}\n\n"
+        "Use exclusivamente o conteúdo-base abaixo para responder às perguntas desta conversa. "
         "Se a resposta não puder ser fundamentada apenas no conteúdo-base, "
         f"responda exatamente: \"{_INSUFF_PHRASE}\"\n\n"
         "Conteúdo-base (ebook):\n----- INÍCIO -----\n"
-        f"{req.ebook_text}\n"
-        "----- FIM -----\n\n"
+        f"{ebook_text}\n"
+        "----- FIM -----"
+    )
+
+def _session_question(question: str) -> str:
+    return (
         "Pergunta do usuário:\n"
-        f"{req.question}\n\n"
+        f"{question}\n\n"
         "Instruções finais:\n"
-        f"- Responda somente com base no conteúdo-base, procure exaustivamente a informação.\n"
+        "- Responda somente com base no conteúdo-base, procure exaustivamente a informação.\n"
         f"- Se não houver base suficiente, responda exatamente: \"{_INSUFF_PHRASE}\""
     )
 
-    # Caminho preferencial: API Responses (se disponível)
-    if hasattr(client, "responses"):
-        resp = client.responses.create(
-            model=model,
-            input=[
-                {"role": "system", "content": _QA_SYSTEM},
-                {"role": "user", "content": user_prompt},
-            ],
+def session_prefix_limit(
+    use_responses: bool,
+    model: str = DEFAULT_QA_MODEL,
+    history_turns: int = DEFAULT_HISTORY_TURNS,
+    max_prefix_tokens: int = DEFAULT_SESSION_PREFIX_TOKENS,
+) -> int:
+    """
+    Maior ebook (em `estimate_tokens`) que vai inteiro como prefixo da sessão: janela de contexto do modelo
+    efetivo (a rota Chat usa outro) menos a margem de segurança, a saída, o histórico e as instruções,
+    convertida para a estimativa de ~4 caracteres/token; nunca acima do teto `max_prefix_tokens`.
+    """
+    window = CONTEXT_WINDOWS.get(model if use_responses else _CHAT_QA_MODEL, DEFAULT_CONTEXT_WINDOW)
+    free = (
+        window * (1 - SESSION_SAFETY_MARGIN)
+        - SESSION_OUTPUT_TOKENS
+        - SESSION_OVERHEAD_TOKENS
+        - max(0, history_turns) * SESSION_TURN_TOKENS
+    )
+    return max(0, min(max_prefix_tokens, int(free / SESSION_TOKEN_FACTOR)))
+
+def _context_too_long(error: openai.BadRequestError) -> bool:
+    code = getattr(error, "code", None)
+    msg = str(error).lower()
+    return code == "context_length_exceeded" or "context length" in msg or "context window" in msg
+
+class QASession:
+    """
+    Conversa de perguntas e respostas sobre um mesmo ebook.
+    O ebook é enviado uma única vez, como prefixo estável:
+    - API Responses: a primeira pergunta leva o prefixo e as seguintes encadeiam por
+      `previous_response_id` (o contexto fica no servidor);
+    - Chat Completions: todas as chamadas começam pelo mesmo prefixo (mensagem de sistema),
+      seguido do histórico recente, o que permite ao cache de prompt do provedor reaproveitá-lo.
+    Cada QAOutput informa `cached_tokens`; os totais ficam em `input_tokens`/`cached_tokens`.
+    Ebooks maiores que `session_prefix_limit` (janela do modelo menos saída, histórico e margem; no máximo
+    `max_prefix_tokens`) não cabem no prefixo: cada pergunta usa o `retriever` (como `answer_with_ebook_stream`),
+    sem estado entre perguntas. Se a API ainda recusar o prefixo por tamanho, a sessão passa a esse modo
+    (sem `retriever`, um índice BM25 em memória).
+    Com `semantic_cache`, perguntas equivalentes a outras já respondidas sobre o mesmo ebook
+    (nesta ou em sessões anteriores) voltam do cache, sem entrar no histórico da conversa.
+    """
+
+    def __init__(
+        self,
+        client: OpenAI,
+        ebook_text: str,
+        model: str = DEFAULT_QA_MODEL,
+        retriever: Optional[ContextSelector] = None,
+        fallback_on_insufficient: str = "phrased",
+        max_prefix_tokens: int = DEFAULT_SESSION_PREFIX_TOKENS,
+        history_turns: int = DEFAULT_HISTORY_TURNS,
+        semantic_cache: Optional[SemanticAnswerCache] = None,
+    ) -> None:
+        self.client = client
+        self.ebook_text = ebook_text
+        self.model = model
+        self.retriever = retriever
+        self.fallback_on_insufficient = fallback_on_insufficient
+        self.history_turns = history_turns
+        self.semantic_cache = semantic_cache
+        self.use_responses = hasattr(client, "responses")
+        self.prefix_limit = session_prefix_limit(self.use_responses, model, history_turns, max_prefix_tokens)
+        self.stateful = estimate_tokens(ebook_text) <= self.prefix_limit
+        self._prefix = _session_prefix(ebook_text) if self.stateful else ""
+        self._previous_response_id: Optional[str] = None
+        self._history: List[Dict[str, str]] = []
+        self.turns = 0
+        self.input_tokens = 0
+        self.cached_tokens = 0
+
+    def reset(self) -> None:
+        """
+        Esquece o histórico; a próxima pergunta reenvia o prefixo.
+        """
+        self._previous_response_id = None
+        self._history = []
+
+    def _call_kwargs(self, question: str) -> Dict[str, Any]:
+        prompt = _session_question(question)
+        if self.use_responses:
+            if self._previous_response_id:
+                return {
+                    "model": self.model,
+                    "input": [{"role": "user", "content": prompt}],
+                    "previous_response_id": self._previous_response_id,
+                    "store": True,
+                }
+            return {
+                "model": self.model,
+                "input": [{"role": "system", "content": self._prefix}, {"role": "user", "content": prompt}],
+                "store": True,
+            }
+        messages = [{"role": "system", "content": self._prefix}]
+        messages += self._history[-2 * self.history_turns:] if self.history_turns > 0 else []
+        messages.append({"role": "user", "content": prompt})
+        return {"model": _CHAT_QA_MODEL, "messages": messages, "temperature": 0.0}
+
+    def _stateless_retriever(self) -> ContextSelector:
+        if self.retriever is None:
+            self.retriever = BM25Index.build(self.ebook_text)
+        return self.retriever
+
+    def _stateless_stream(self, req: QARequest) -> TextStream[QAOutput]:
+        return answer_with_ebook_stream(
+            self.client, req, model=self.model, retriever=self._stateless_retriever(), semantic_cache=self.semantic_cache
         )
-        answer_text = _extract_text_from_responses(resp) or ""
-        answer_text = _normalize_answer(answer_text)
-    else:
-        # Fallback: Chat Completions (compatível com qualquer 1.x)
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",  # ajuste aqui se desejar manter o mesmo modelo na rota antiga
-            messages=[
-                {"role": "system", "content": _QA_SYSTEM},
-                {"role": "user", "content": user_prompt},
-            ],
-            temperature=0.0,
+
+    def _recover(self, error: Exception, call_kwargs: Dict[str, Any]) -> bool:
+        """
+        Ajusta o estado após uma recusa da API; True se a pergunta pode ser reenviada.
+        """
+        if call_kwargs.get("previous_response_id"):
+            # Resposta anterior expirou/foi removida no servidor (ou a cadeia passou da janela):
+            # recomeça a cadeia com o prefixo
+            self._previous_response_id = None
+            return True
+        if self._history and isinstance(error, openai.BadRequestError) and _context_too_long(error):
+            # Histórico maior que o reservado: recomeça a conversa só com o prefixo
+            self._history = []
+            return True
+        return False
+
+    def _drop_prefix(self, error: openai.BadRequestError) -> None:
+        if not _context_too_long(error):
+            raise error
+        # A estimativa de tokens errou para baixo: o ebook não cabe no prefixo, segue por recuperação
+        self.stateful = False
+        self._prefix = ""
+        self.reset()
+
+    def _open_stream(self, question: str, stats: CallStats) -> Tuple[Any, Dict[str, Any]]:
+        call_kwargs = self._call_kwargs(question)
+        try:
+            return create_response(self.client, self.use_responses, call_kwargs, "qa", stats=stats, stream=True), call_kwargs
+        except (openai.BadRequestError, openai.NotFoundError) as e:
+            if not self._recover(e, call_kwargs):
+                raise
+            return self._open_stream(question, stats)
+
+    async def _open_stream_async(
+        self, client: AsyncOpenAI, question: str, stats: CallStats
+    ) -> Tuple[Any, Dict[str, Any]]:
+        call_kwargs = self._call_kwargs(question)
+        try:
+            async with get_async_semaphore():
+                stream = await create_response_async(client, self.use_responses, call_kwargs, "qa", stats=stats, stream=True)
+            return stream, call_kwargs
+        except (openai.BadRequestError, openai.NotFoundError) as e:
+            if not self._recover(e, call_kwargs):
+                raise
+            return await self._open_stream_async(client, question, stats)
+
+    def _end_turn(
+        self, req: QARequest, call_kwargs: Dict[str, Any], resp: Any, text: str, t0: float, stats: CallStats
+    ) -> QAOutput:
+        record_usage("qa", call_kwargs["model"], resp, time.perf_counter() - t0, stats, streamed=True)
+        usage = usage_from_response(resp) if resp is not None else None
+        answer = _normalize_answer(text)
+        self.turns += 1
+        if usage is not None:
+            self.input_tokens += usage["input_tokens"]
+            self.cached_tokens += usage["cached_tokens"]
+        if self.use_responses:
+            self._previous_response_id = getattr(resp, "id", None) or self._previous_response_id
+        else:
+            self._history += [
+                {"role": "user", "content": _session_question(req.question)},
+                {"role": "assistant", "content": answer},
+            ]
+        out = _finish(answer, req, total_tokens(resp) if resp is not None else None)
+        _semantic_store(self.semantic_cache, req, out)
+        return out.model_copy(update={"cached_tokens": usage["cached_tokens"] if usage is not None else None})
+
+    def ask_stream(self, question: str) -> TextStream[QAOutput]:
+        """
+        Faz uma pergunta na sessão; iterar o retorno devolve os deltas de texto e `.result` o QAOutput.
+        `close()` só surte efeito no próximo delta: a leitura síncrona em andamento não é interrompida.
+        """
+        req = QARequest(ebook_text=self.ebook_text, question=question, fallback_on_insufficient=self.fallback_on_insufficient)
+        if not self.stateful:
+            return self._stateless_stream(req)
+        hit = _semantic_lookup(self.semantic_cache, req, self.model)
+        if hit is not None:
+            return TextStream([hit.answer] if hit.answer else [], lambda _text: hit)
+
+        t0 = time.perf_counter()
+        stats = CallStats()
+        try:
+            stream, call_kwargs = self._open_stream(req.question, stats)
+        except openai.BadRequestError as e:
+            self._drop_prefix(e)
+            return self._stateless_stream(req)
+        final: Dict[str, Any] = {}
+        deltas = iter_text_deltas(stream, on_usage=lambda r: final.__setitem__("resp", r))
+        return TextStream(
+            deltas,
+            lambda text: self._end_turn(req, call_kwargs, final.get("resp"), text, t0, stats),
+            close=getattr(stream, "close", None),
         )
-        answer_text = _normalize_answer(resp.choices[0].message.content if resp.choices else "")
 
-    has_content = (answer_text != _INSUFF_PHRASE)
+    async def ask_async(
+        self,
+        client: AsyncOpenAI,
+        question: str,
+        on_delta: Optional[Callable[[str], None]] = None,
+    ) -> QAOutput:
+        """
+        Versão assíncrona de `ask` (mesma sessão, com um cliente AsyncOpenAI): `on_delta` recebe os deltas
+        de texto à medida que chegam. Cancelar a task aborta a requisição na hora, inclusive antes do
+        primeiro token; a pergunta cancelada não entra no histórico.
+        Sem prefixo (ebook maior que o limite), a resposta vem inteira, sem deltas.
+        """
+        req = QARequest(ebook_text=self.ebook_text, question=question, fallback_on_insufficient=self.fallback_on_insufficient)
+        if self.stateful:
+            hit = _semantic_lookup(self.semantic_cache, req, self.model)
+            if hit is not None:
+                return hit
+            t0 = time.perf_counter()
+            stats = CallStats()
+            try:
+                stream, call_kwargs = await self._open_stream_async(client, req.question, stats)
+            except openai.BadRequestError as e:
+                self._drop_prefix(e)
+            else:
+                final: Dict[str, Any] = {}
+                parts: List[str] = []
+                try:
+                    async for delta in aiter_text_deltas(stream, on_usage=lambda r: final.__setitem__("resp", r)):
+                        parts.append(delta)
+                        if on_delta is not None:
+                            on_delta(delta)
+                finally:
+                    close = getattr(stream, "close", None)
+                    if close is not None:
+                        await close()
+                return self._end_turn(req, call_kwargs, final.get("resp"), "".join(parts), t0, stats)
+        return await answer_with_ebook_async(
+            client, req, model=self.model, retriever=self._stateless_retriever(), semantic_cache=self.semantic_cache
+        )
 
-    if req.fallback_on_insufficient == "none" and not has_content:
-        return QAOutput(answer="", has_content=False)
+    def ask(self, question: str) -> QAOutput:
+        return self.ask_stream(question).result
+
+    def cache_summary(self) -> str:
+        if not self.stateful:
+            return "Sessão sem prefixo (ebook maior que o limite): trechos recuperados por pergunta."
+        pct = (100.0 * self.cached_tokens / self.input_tokens) if self.input_tokens else 0.0
+        text = (
+            f"{self.turns} pergunta(s) na sessão | tokens de entrada: {self.input_tokens} "
+            f"({self.cached_tokens} em cache, {pct:.0f}%)"
+        )
+        if self.semantic_cache is not None and self.semantic_cache.hits:
+            text += f" | {self.semantic_cache.hits} resposta(s) do cache de perguntas"
+        return text
 
-    return QAOutput(answer=answer_text, has_content=has_content)
+def _may_be_insufficient(text: str) -> bool:
+    # Enquanto o início da resposta ainda pode ser a frase de insuficiência, o stream roteado o segura
+    head = text.strip().strip("\"“”'").lower()
+    return _INSUFF_PHRASE.lower().startswith(head)
+
+class RoutedQASession:
+    """
+    Perguntas e respostas sobre vários ebooks sem enviar todos em cada pergunta.
+    Os perfis (palavras-chave/resumo calculados na ingestão, ver utils.doc_router) escolhem os
+    documentos mais relevantes; se a resposta vier insuficiente, a pergunta é refeita com mais
+    documentos, até todos. Cada conjunto de documentos tem a sua QASession (prefixo estável e
+    histórico), criada no primeiro uso: os tokens por pergunta acompanham o material relevante,
+    não o número de arquivos selecionados.
+    `retriever_for(documentos, texto)` fornece o índice dos conjuntos maiores que `session_prefix_limit`.
+    Com `semantic_cache` (escopado à base inteira), perguntas equivalentes voltam do cache antes do roteamento.
+    """
+
+    def __init__(
+        self,
+        client: OpenAI,
+        ebooks: Sequence[str],
+        profiles: Sequence[DocumentProfile],
+        model: str = DEFAULT_QA_MODEL,
+        retriever_for: Optional[Callable[[Sequence[int], str], ContextSelector]] = None,
+        fallback_on_insufficient: str = "phrased",
+        max_prefix_tokens: int = DEFAULT_SESSION_PREFIX_TOKENS,
+        history_turns: int = DEFAULT_HISTORY_TURNS,
+        first_docs: int = DEFAULT_ROUTE_DOCS,
+        step_docs: int = DEFAULT_ROUTE_STEP,
+        separator: str = DOCUMENT_SEPARATOR,
+        semantic_cache: Optional[SemanticAnswerCache] = None,
+    ) -> None:
+        if not ebooks or len(ebooks) != len(profiles):
+            raise ValueError("Informe um perfil para cada ebook.")
+        self.client = client
+        self.ebooks = list(ebooks)
+        self.router = DocumentRouter(profiles)
+        self.model = model
+        self.retriever_for = retriever_for
+        self.fallback_on_insufficient = fallback_on_insufficient
+        self.max_prefix_tokens = max_prefix_tokens
+        self.history_turns = history_turns
+        self.prefix_limit = session_prefix_limit(hasattr(client, "responses"), model, history_turns, max_prefix_tokens)
+        self.first_docs = first_docs
+        self.step_docs = step_docs
+        self.separator = separator
+        self.semantic_cache = semantic_cache
+        self.ebook_text = separator.join(self.ebooks).strip()
+        self._sessions: Dict[Tuple[int, ...], QASession] = {}
+        self.last_route: List[int] = []
+        self.turns = 0
+        self.attempts = 0
+        self.docs_sent = 0
+
+    def _session_for(self, docs: Sequence[int]) -> QASession:
+        key = tuple(docs)
+        session = self._sessions.get(key)
+        if session is None:
+            text = self.separator.join(self.ebooks[i] for i in docs).strip()
+            retriever = None
+            if self.retriever_for is not None and estimate_tokens(text) > self.prefix_limit:
+                retriever = self.retriever_for(key, text)
+            session = QASession(
+                self.client,
+                text,
+                model=self.model,
+                retriever=retriever,
+                fallback_on_insufficient=self.fallback_on_insufficient,
+                max_prefix_tokens=self.max_prefix_tokens,
+                history_turns=self.history_turns,
+            )
+            self._sessions[key] = session
+        return session
+
+    def reset(self) -> None:
+        for session in self._sessions.values():
+            session.reset()
+
+    def ask_stream(self, question: str) -> TextStream[QAOutput]:
+        """
+        Como `QASession.ask_stream`; tentativas insuficientes não aparecem no stream (só a última).
+        """
+        req = QARequest(ebook_text=self.ebook_text, question=question, fallback_on_insufficient=self.fallback_on_insufficient)
+        hit = _semantic_lookup(self.semantic_cache, req, self.model)
+        if hit is not None:
+            self.last_route = []
+            return TextStream([hit.answer] if hit.answer else [], lambda _text: hit)
+
+        tiers = self.router.tiers(req.question, first=self.first_docs, step=self.step_docs)
+        state: Dict[str, Any] = {"stream": None, "out": None, "tokens": 0, "closed": False}
+
+        def _deltas() -> Iterator[str]:
+            for n, docs in enumerate(tiers):
+                if state["closed"]:
+                    return
+                stream = self._session_for(docs).ask_stream(req.question)
+                state["stream"] = stream
+                held: List[str] = []
+                released = False
+                for delta in stream:
+                    if released:
+                        yield delta
+                        continue
+                    held.append(delta)
+                    if not _may_be_insufficient("".join(held)):
+                        released = True
+                        yield "".join(held)
+                out = stream.result
+                state["out"] = out
+                state["tokens"] += out.tokens_used or 0
+                self.attempts += 1
+                self.last_route = list(docs)
+                if released or out.has_content or n == len(tiers) - 1:
+                    if not released and out.answer:
+                        yield out.answer
+                    return
+
+        def _finalize(_text: str) -> QAOutput:
+            self.turns += 1
+            self.docs_sent += len(self.last_route)
+            out = state["out"].model_copy(update={"tokens_used": state["tokens"]})
+            _semantic_store(self.semantic_cache, req, out)
+            return out
+
+        def _close() -> None:
+            state["closed"] = True
+            if state["stream"] is not None:
+                state["stream"].close()
+
+        return TextStream(_deltas(), _finalize, close=_close)
+
+    def ask(self, question: str) -> QAOutput:
+        return self.ask_stream(question).result
+
+    def route_summary(self) -> str:
+        """
+        Documentos usados na última resposta.
+        """
+        if not self.last_route:
+            return "Resposta do cache de perguntas (nenhum documento enviado)."
+        titles = ", ".join(self.router.profiles[i].title for i in self.last_route)
+        return f"Documentos consultados ({len(self.last_route)} de {len(self.ebooks)}): {titles}"
+
+    def cache_summary(self) -> str:
+        input_tokens = sum(s.input_tokens for s in self._sessions.values())
+        cached = sum(s.cached_tokens for s in self._sessions.values())
+        pct = (100.0 * cached / input_tokens) if input_tokens else 0.0
+        per_question = (self.docs_sent / self.turns) if self.turns else 0.0
+        text = (
+            f"{self.turns} pergunta(s) | {per_question:.1f} de {len(self.ebooks)} documento(s) por pergunta, "
+            f"{self.attempts - self.turns} nova(s) tentativa(s) | tokens de entrada: {input_tokens} "
+            f"({cached} em cache, {pct:.0f}%)"
+        )
+        if self.semantic_cache is not None and self.semantic_cache.hits:
+            text += f" | {self.semantic_cache.hits} resposta(s) do cache de perguntas"
+        return text
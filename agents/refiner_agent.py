@@ -1,7 +1,20 @@
 from __future__ import annotations
-from typing import Optional
-from openai import OpenAI
+import asyncio
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from openai import AsyncOpenAI, OpenAI
+from api.concurrency import get_async_semaphore
+from api.scheduler import CallStats
+from api.usage import total_tokens
+from agents.base import create_response, create_response_async, record_usage
+from agents.streaming import TextStream, iter_text_deltas
 from models.refiner_models import RefinerRequest, RefinerOutput
+from utils.response_cache import get_response_cache, response_cache_key
+from utils.text_utils import split_segments, split_sentences, tokenize
+
+DEFAULT_REFINER_MODEL = "gpt-4o-mini"
 
 _REFINER_SYSTEM = (
     "Você é um editor que transforma transcrições de aulas em um ebook limpo, "
@@ -23,43 +36,286 @@ def _extract_text_from_responses(resp) -> Optional[str]:
     except Exception:
         return None
 
-def refine_transcript_to_ebook(client: OpenAI, req: RefinerRequest) -> RefinerOutput:
-    """
-    Refina a transcrição em um texto coeso de ebook.
-    Usa `client.responses.create` quando disponível; caso contrário, usa `client.chat.completions.create`.
-    """
-    user_prompt = (
+def _build_user_prompt(transcript_text: str, part: Optional[Tuple[int, int]] = None) -> str:
+    part_note = ""
+    if part is not None:
+        part_note = (
+            f"Atenção: este é o trecho {part[0]} de {part[1]} de uma transcrição maior. "
+            "Refine apenas este trecho, sem introdução, conclusão ou resumo do todo.\n\n"
+        )
+    return (
         "Você receberá abaixo a transcrição bruta de uma aula, em formato de texto ou também pode receber um material informativo e já organizado.\n"
         "Tarefas:\n"
         "1) Limpar e organizar em prosa contínua (formato de ebook).\n"
         "2) Remover trechos irrelevantes e repetições.\n"
         "3) Melhorar coesão e clareza, mantendo o conteúdo factual original.\n"
         "4) Não inventar fatos.\n\n"
-        f"Transcrição:\n{req.transcript_text}"
+        f"{part_note}"
+        f"Transcrição:\n{transcript_text}"
     )
 
-    # Caminho preferencial: Responses API (se existir no cliente)
-    if hasattr(client, "responses"):
-        resp = client.responses.create(
-            model="gpt-4o-mini",
-            input=[
-                {"role": "system", "content": _REFINER_SYSTEM},
-                {"role": "user", "content": user_prompt},
-            ],
-        )
+def refine_transcript_to_ebook(
+    client: OpenAI,
+    req: RefinerRequest,
+    use_cache: bool = True,
+) -> RefinerOutput:
+    """
+    Refina a transcrição em um texto coeso de ebook.
+    Usa `client.responses.create` quando disponível; caso contrário, usa `client.chat.completions.create`.
+    Resultados ficam no cache persistente (modelo + prompts + configurações); `use_cache=False` desativa.
+    """
+    return _refine_prompt(client, _build_user_prompt(req.transcript_text), use_cache)
+
+def _call_spec(use_responses: bool, user_prompt: str) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Monta os argumentos da chamada (Responses ou Chat Completions) e as configurações usadas na chave do cache.
+    """
+    messages = [
+        {"role": "system", "content": _REFINER_SYSTEM},
+        {"role": "user", "content": user_prompt},
+    ]
+    if use_responses:
+        return {"model": DEFAULT_REFINER_MODEL, "input": messages}, {"api": "responses"}
+    # Fallback universal: Chat Completions
+    kwargs = {"model": DEFAULT_REFINER_MODEL, "messages": messages, "temperature": 0.3}
+    return kwargs, {"api": "chat", "temperature": 0.3}
+
+def _parse_response(resp, use_responses: bool) -> RefinerOutput:
+    if use_responses:
         text = _extract_text_from_responses(resp)
         if not text:
             text = str(resp)
-        return RefinerOutput(ebook_text=text.strip())
+        return RefinerOutput(ebook_text=text.strip(), tokens_used=total_tokens(resp))
+    text = resp.choices[0].message.content if resp.choices else ""
+    return RefinerOutput(ebook_text=(text or "").strip(), tokens_used=total_tokens(resp))
 
-    # Fallback universal: Chat Completions
-    resp = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": _REFINER_SYSTEM},
-            {"role": "user", "content": user_prompt},
-        ],
-        temperature=0.3,
+def _cache_key(user_prompt: str, settings: Dict[str, Any]) -> str:
+    return response_cache_key("refine", DEFAULT_REFINER_MODEL, _REFINER_SYSTEM, user_prompt, settings)
+
+def _cache_lookup(cache_key: Optional[str]) -> Optional[RefinerOutput]:
+    if cache_key is None:
+        return None
+    cached = get_response_cache().get(cache_key)
+    if cached is None:
+        return None
+    record_usage("refine", DEFAULT_REFINER_MODEL, cache_hit=True)
+    # Acerto no cache não consome tokens
+    return RefinerOutput.model_validate_json(cached).model_copy(update={"tokens_used": 0})
+
+def _refine_prompt(client: OpenAI, user_prompt: str, use_cache: bool) -> RefinerOutput:
+    # Caminho preferencial: Responses API (se existir no cliente)
+    use_responses = hasattr(client, "responses")
+    call_kwargs, settings = _call_spec(use_responses, user_prompt)
+    cache_key = _cache_key(user_prompt, settings) if use_cache else None
+    hit = _cache_lookup(cache_key)
+    if hit is not None:
+        return hit
+
+    resp = create_response(client, use_responses, call_kwargs, "refine")
+    out = _parse_response(resp, use_responses)
+
+    if cache_key is not None:
+        get_response_cache().set(cache_key, out.model_dump_json().encode("utf-8"))
+    return out
+
+async def _refine_prompt_async(client: AsyncOpenAI, user_prompt: str, use_cache: bool) -> RefinerOutput:
+    use_responses = hasattr(client, "responses")
+    call_kwargs, settings = _call_spec(use_responses, user_prompt)
+    cache_key = _cache_key(user_prompt, settings) if use_cache else None
+    hit = _cache_lookup(cache_key)
+    if hit is not None:
+        return hit
+
+    async with get_async_semaphore():
+        resp = await create_response_async(client, use_responses, call_kwargs, "refine")
+    out = _parse_response(resp, use_responses)
+
+    if cache_key is not None:
+        get_response_cache().set(cache_key, out.model_dump_json().encode("utf-8"))
+    return out
+
+async def refine_transcript_to_ebook_async(
+    client: AsyncOpenAI,
+    req: RefinerRequest,
+    use_cache: bool = True,
+) -> RefinerOutput:
+    """
+    Versão assíncrona de `refine_transcript_to_ebook` (cliente AsyncOpenAI).
+    As chamadas de rede respeitam o limite global de concorrência (api.concurrency).
+    """
+    return await _refine_prompt_async(client, _build_user_prompt(req.transcript_text), use_cache)
+
+def refine_transcript_to_ebook_stream(
+    client: OpenAI,
+    req: RefinerRequest,
+    use_cache: bool = True,
+) -> TextStream[RefinerOutput]:
+    """
+    Versão em streaming de `refine_transcript_to_ebook`: iterar o retorno devolve os deltas de texto;
+    o RefinerOutput final fica em `.result` (e vai para o cache).
+    """
+    user_prompt = _build_user_prompt(req.transcript_text)
+    use_responses = hasattr(client, "responses")
+    call_kwargs, settings = _call_spec(use_responses, user_prompt)
+    cache_key = _cache_key(user_prompt, settings) if use_cache else None
+    hit = _cache_lookup(cache_key)
+    if hit is not None:
+        return TextStream([hit.ebook_text], lambda _text: hit)
+
+    t0 = time.perf_counter()
+    stats = CallStats()
+    stream = create_response(client, use_responses, call_kwargs, "refine", stats=stats, stream=True)
+    final: Dict[str, Any] = {}
+
+    def _finalize(text: str) -> RefinerOutput:
+        resp = final.get("resp")
+        record_usage("refine", DEFAULT_REFINER_MODEL, resp, time.perf_counter() - t0, stats, streamed=True)
+        out = RefinerOutput(ebook_text=text.strip(), tokens_used=total_tokens(resp) if resp is not None else None)
+        if cache_key is not None:
+            get_response_cache().set(cache_key, out.model_dump_json().encode("utf-8"))
+        return out
+
+    deltas = iter_text_deltas(stream, on_usage=lambda r: final.__setitem__("resp", r))
+    return TextStream(deltas, _finalize, close=getattr(stream, "close", None))
+
+def _seam_key(sentence: str) -> str:
+    return " ".join(tokenize(sentence, drop_stopwords=False))
+
+def _smooth_seam(previous: str, following: str, lookback: int = 60) -> str:
+    """
+    Remove do início de `following` as sentenças que repetem o final de `previous`
+    (efeito da sobreposição entre segmentos).
+    """
+    prev_keys = [_seam_key(s) for _, s in split_sentences(previous)[-lookback:]]
+    sentences = split_sentences(following)
+    keys = [_seam_key(s) for _, s in sentences]
+    if not keys:
+        return following
+
+    # 1) Sobreposição alinhada: o início de `following` reproduz a cauda de `previous`
+    for i, key in enumerate(prev_keys):
+        if key and key == keys[0]:
+            run = 0
+            while run < len(keys) and i + run < len(prev_keys) and keys[run] == prev_keys[i + run]:
+                run += 1
+            if i + run == len(prev_keys):
+                start, sent = sentences[run - 1]
+                return following[start + len(sent):].lstrip()
+
+    # 2) Fallback: descarta sentenças iniciais que já aparecem no final de `previous`
+    tail = set(prev_keys)
+    tail.discard("")
+    cut = 0
+    for (start, sent), key in zip(sentences, keys):
+        if key not in tail:
+            break
+        cut = start + len(sent)
+    return following[cut:].lstrip()
+
+def _stitch_segments(parts: List[str]) -> str:
+    stitched: List[str] = []
+    for text in parts:
+        text = (text or "").strip()
+        if stitched and text:
+            text = _smooth_seam(stitched[-1], text)
+        if text:
+            stitched.append(text)
+    return re.sub(r"\n{3,}", "\n\n", "\n\n".join(stitched))
+
+def _sum_tokens(outputs: List[RefinerOutput]) -> Optional[int]:
+    counts = [o.tokens_used for o in outputs if o.tokens_used is not None]
+    return sum(counts) if counts else None
+
+def refine_transcript_segmented(
+    client: OpenAI,
+    req: RefinerRequest,
+    max_segment_tokens: int = 4000,
+    overlap_tokens: int = 150,
+    max_workers: int = 4,
+    use_cache: bool = True,
+) -> RefinerOutput:
+    """
+    Refino map-reduce para transcrições longas:
+    1) divide em segmentos (limite de tokens, cortes entre parágrafos, pequena sobreposição);
+    2) refina os segmentos em paralelo (no máximo `max_workers` requisições simultâneas);
+    3) costura na ordem original, removendo repetições nas emendas.
+    Transcrições que cabem em um segmento seguem pelo caminho normal (uma única chamada).
+    """
+    segments = split_segments(req.transcript_text, max_tokens=max_segment_tokens, overlap_tokens=overlap_tokens)
+    if len(segments) <= 1:
+        return refine_transcript_to_ebook(client, req, use_cache=use_cache)
+
+    total = len(segments)
+    prompts = [_build_user_prompt(seg.text, part=(i, total)) for i, seg in enumerate(segments, 1)]
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, total))) as pool:
+        outputs = list(pool.map(lambda p: _refine_prompt(client, p, use_cache), prompts))
+
+    return RefinerOutput(
+        ebook_text=_stitch_segments([o.ebook_text for o in outputs]),
+        tokens_used=_sum_tokens(outputs),
+    )
+
+def refine_call_specs(
+    transcript_text: str,
+    max_segment_tokens: int = 4000,
+    overlap_tokens: int = 150,
+    use_responses: bool = False,
+) -> List[Tuple[Dict[str, Any], str]]:
+    """
+    Argumentos de chamada e chave de cache de cada segmento, idênticos aos de
+    `refine_transcript_segmented` (mesmos prompts e cortes). Usado pelo modo Batch.
+    """
+    segments = split_segments(transcript_text, max_tokens=max_segment_tokens, overlap_tokens=overlap_tokens)
+    if len(segments) <= 1:
+        prompts = [_build_user_prompt(transcript_text)]
+    else:
+        prompts = [_build_user_prompt(seg.text, part=(i, len(segments))) for i, seg in enumerate(segments, 1)]
+    specs = []
+    for prompt in prompts:
+        call_kwargs, settings = _call_spec(use_responses, prompt)
+        specs.append((call_kwargs, _cache_key(prompt, settings)))
+    return specs
+
+def stitch_refined_segments(parts: List[str]) -> str:
+    """
+    Costura segmentos refinados (na ordem original), removendo repetições nas emendas.
+    """
+    return _stitch_segments(parts)
+
+async def refine_transcript_segmented_async(
+    client: AsyncOpenAI,
+    req: RefinerRequest,
+    max_segment_tokens: int = 4000,
+    overlap_tokens: int = 150,
+    use_cache: bool = True,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+) -> RefinerOutput:
+    """
+    Versão assíncrona de `refine_transcript_segmented`: os segmentos são disparados juntos
+    e o paralelismo real fica limitado pelo semáforo compartilhado (api.concurrency).
+    `on_progress(concluídos, total)` é chamado a cada segmento refinado.
+    Cancelar a task aborta todas as requisições em andamento.
+    """
+    segments = split_segments(req.transcript_text, max_tokens=max_segment_tokens, overlap_tokens=overlap_tokens)
+    if len(segments) <= 1:
+        out = await refine_transcript_to_ebook_async(client, req, use_cache=use_cache)
+        if on_progress is not None:
+            on_progress(1, 1)
+        return out
+
+    total = len(segments)
+    done = 0
+
+    async def _segment(i: int, text: str) -> RefinerOutput:
+        nonlocal done
+        out = await _refine_prompt_async(client, _build_user_prompt(text, part=(i, total)), use_cache)
+        done += 1
+        if on_progress is not None:
+            on_progress(done, total)
+        return out
+
+    outputs = await asyncio.gather(*(_segment(i, seg.text) for i, seg in enumerate(segments, 1)))
+    return RefinerOutput(
+        ebook_text=_stitch_segments([o.ebook_text for o in outputs]),
+        tokens_used=_sum_tokens(outputs),
     )
-    text = resp.choices[0].message.content if resp.choices else ""
-    return RefinerOutput(ebook_text=(text or "").strip())
@@ -0,0 +1,107 @@
+from __future__ import annotations
+from typing import Any, AsyncIterable, AsyncIterator, Callable, Generic, Iterable, Iterator, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+def _event_delta(event: Any, on_usage: Optional[Callable[[Any], None]]) -> Optional[str]:
+    etype = getattr(event, "type", None)
+    if etype == "response.output_text.delta":
+        return getattr(event, "delta", None) or None
+    if etype == "response.completed":
+        if on_usage is not None:
+            on_usage(getattr(event, "response", None))
+        return None
+    if on_usage is not None and getattr(event, "usage", None) is not None:
+        on_usage(event)
+    choices = getattr(event, "choices", None)
+    if choices:
+        return getattr(getattr(choices[0], "delta", None), "content", None) or None
+    return None
+
+
+def iter_text_deltas(stream: Iterable[Any], on_usage: Optional[Callable[[Any], None]] = None) -> Iterator[str]:
+    """
+    Extrai os deltas de texto de um stream da API Responses (eventos 'response.output_text.delta')
+    ou de Chat Completions (chunks com choices[0].delta.content).
+    `on_usage` recebe o objeto com `usage` ao final (evento 'response.completed' ou último chunk).
+    """
+    for event in stream:
+        delta = _event_delta(event, on_usage)
+        if delta:
+            yield delta
+
+
+async def aiter_text_deltas(
+    stream: AsyncIterable[Any], on_usage: Optional[Callable[[Any], None]] = None
+) -> AsyncIterator[str]:
+    """
+    Versão assíncrona de `iter_text_deltas` (stream de um cliente AsyncOpenAI).
+    """
+    async for event in stream:
+        delta = _event_delta(event, on_usage)
+        if delta:
+            yield delta
+
+
+class TextStream(Generic[T]):
+    """
+    Resposta em streaming: iterar devolve os deltas de texto à medida que chegam.
+    Ao final do stream, `finalize(texto_completo)` produz o resultado tipado (ex.: QAOutput),
+    disponível em `.result`. `close()` aborta a requisição HTTP em andamento.
+    """
+
+    def __init__(
+        self,
+        deltas: Iterable[str],
+        finalize: Callable[[str], T],
+        close: Optional[Callable[[], None]] = None,
+    ) -> None:
+        self._deltas = iter(deltas)
+        self._finalize = finalize
+        self._close = close
+        self._parts: List[str] = []
+        self._result: Optional[T] = None
+        self._done = False
+        self._closed = False
+
+    def __iter__(self) -> Iterator[str]:
+        if self._done:
+            return
+        try:
+            for delta in self._deltas:
+                if self._closed:
+                    break
+                self._parts.append(delta)
+                yield delta
+        except Exception:
+            # Fechar a conexão no meio da leitura interrompe o stream com erro de I/O
+            if not self._closed:
+                raise
+        if not self._closed:
+            self._result = self._finalize(self.text)
+        self._done = True
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
+
+    @property
+    def result(self) -> T:
+        """
+        Resultado final; se o stream ainda não foi consumido, consome o restante.
+        """
+        if not self._done:
+            for _ in self:
+                pass
+        if self._result is None:
+            raise RuntimeError("Stream cancelado antes de terminar.")
+        return self._result
+
+    def close(self) -> None:
+        self._closed = True
+        if self._close is not None:
+            try:
+                self._close()
+            except Exception:
+                pass
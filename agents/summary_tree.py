@@ -0,0 +1,373 @@
+from __future__ import annotations
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from openai import OpenAI
+from agents.base import create_response, record_usage
+from api.usage import total_tokens
+from utils.job_manifest import atomic_write_text
+from utils.response_cache import get_response_cache, response_cache_key
+from utils.retrieval import BM25Index, DEFAULT_TOKEN_BUDGET, DEFAULT_TOP_K
+from utils.text_utils import TextChunk, chunk_text, estimate_tokens
+
+DEFAULT_SUMMARY_MODEL = "gpt-4o-mini"
+DEFAULT_LEAF_TOKENS = 1200
+DEFAULT_FANOUT = 8  # nós resumidos juntos em cada nível acima das folhas
+DEFAULT_BEAM = 3  # nós mantidos por nível na descida
+DEFAULT_TREE_MIN_TOKENS = 20_000  # ebooks menores usam uma árvore plana (resumo extrativo, sem chamadas)
+
+LEAF_WORDS = 80
+NODE_WORDS = 150
+
+_TREE_FILE = "summary_tree.json"
+_TREE_VERSION = 1
+_CHUNK_SEP = "\n\n[...]\n\n"
+
+_SUMMARY_SYSTEM = (
+    "Você resume partes de um ebook para um índice hierárquico de busca. "
+    "Seja fiel ao texto, denso e objetivo: preserve nomes, termos técnicos, números e definições. Não invente fatos."
+)
+
+
+def tree_min_tokens() -> Optional[int]:
+    """
+    Tamanho mínimo (tokens) para construir a árvore com resumos do modelo: $EBOOKQA_TREE_MIN_TOKENS;
+    "off" desativa (só árvores planas).
+    """
+    raw = os.environ.get("EBOOKQA_TREE_MIN_TOKENS", "").strip().lower()
+    if not raw:
+        return DEFAULT_TREE_MIN_TOKENS
+    if raw in {"off", "no", "false"}:
+        return None
+    try:
+        return max(0, int(raw))
+    except ValueError:
+        return DEFAULT_TREE_MIN_TOKENS
+
+
+@dataclass
+class SummaryNode:
+    level: int  # 0 = folha (trecho do texto); a raiz (documento) tem o maior nível
+    summary: str
+    children: List[int] = field(default_factory=list)  # índices em SummaryTree.nodes, nível abaixo
+    start: int = 0  # folhas: trecho = texto[start:end]
+    end: int = 0
+
+
+class SummaryTree:
+    """
+    Árvore de resumos de um ebook: folhas = trechos de ~leaf_tokens com o seu resumo; cada nível
+    acima resume `fanout` nós consecutivos (seções) até um único resumo do documento (a raiz, último nó).
+    Só resumos e offsets são gravados; o texto das folhas vem do próprio ebook.
+    """
+
+    def __init__(
+        self,
+        text: str,
+        nodes: List[SummaryNode],
+        model: Optional[str] = None,
+        leaf_tokens: int = DEFAULT_LEAF_TOKENS,
+        fanout: int = DEFAULT_FANOUT,
+        tokens_used: int = 0,
+    ) -> None:
+        self.text = text
+        self.nodes = nodes
+        self.model = model  # None = árvore plana (sem resumos do modelo)
+        self.leaf_tokens = leaf_tokens
+        self.fanout = fanout
+        self.tokens_used = tokens_used
+
+    @property
+    def root(self) -> SummaryNode:
+        return self.nodes[-1]
+
+    @property
+    def depth(self) -> int:
+        return self.root.level + 1
+
+    def leaves(self) -> List[SummaryNode]:
+        return [n for n in self.nodes if n.level == 0]
+
+    def leaf_text(self, node: SummaryNode) -> str:
+        return self.text[node.start:node.end].strip()
+
+    @classmethod
+    def flat(cls, text: str, summary: str, leaf_tokens: int = DEFAULT_LEAF_TOKENS) -> "SummaryTree":
+        """
+        Árvore de dois níveis sem chamadas ao modelo: trechos sob uma raiz com `summary`
+        (ex.: resumo extrativo do perfil do documento). Para ebooks pequenos.
+        """
+        nodes = _leaf_nodes(text, leaf_tokens)
+        nodes.append(SummaryNode(level=1, summary=summary, children=list(range(len(nodes)))))
+        return cls(text, nodes, model=None, leaf_tokens=leaf_tokens)
+
+    def save(self, directory: str | Path) -> Path:
+        d = Path(directory).expanduser().resolve()
+        d.mkdir(parents=True, exist_ok=True)
+        payload = {
+            "version": _TREE_VERSION,
+            "text_sha256": hashlib.sha256(self.text.encode("utf-8")).hexdigest(),
+            "model": self.model,
+            "leaf_tokens": self.leaf_tokens,
+            "fanout": self.fanout,
+            "tokens_used": self.tokens_used,
+            "nodes": [asdict(n) for n in self.nodes],
+        }
+        return atomic_write_text(d / _TREE_FILE, json.dumps(payload, ensure_ascii=False))
+
+    @classmethod
+    def load(cls, directory: str | Path, text: str) -> "SummaryTree":
+        data = json.loads((Path(directory).expanduser().resolve() / _TREE_FILE).read_text(encoding="utf-8"))
+        if data.get("version") != _TREE_VERSION:
+            raise ValueError("Árvore de resumos em versão antiga.")
+        if data.get("text_sha256") != hashlib.sha256(text.encode("utf-8")).hexdigest():
+            raise ValueError("Árvore de resumos de outro texto.")
+        return cls(
+            text,
+            [SummaryNode(**n) for n in data["nodes"]],
+            model=data.get("model"),
+            leaf_tokens=int(data.get("leaf_tokens", DEFAULT_LEAF_TOKENS)),
+            fanout=int(data.get("fanout", DEFAULT_FANOUT)),
+            tokens_used=int(data.get("tokens_used", 0)),
+        )
+
+
+def _leaf_nodes(text: str, leaf_tokens: int) -> List[SummaryNode]:
+    # Sem sobreposição: cada trecho vai do seu início ao início do próximo
+    chunks = chunk_text(text, max_tokens=leaf_tokens, overlap_tokens=0)
+    ends = [c.start for c in chunks[1:]] + [len(text)]
+    return [SummaryNode(level=0, summary="", start=c.start, end=end) for c, end in zip(chunks, ends)]
+
+
+# -------- construção (chamadas ao modelo) --------
+def _extract_text_from_responses(resp) -> Optional[str]:
+    for item in getattr(resp, "output", []) or []:
+        for c in getattr(item, "content", []) or []:
+            if getattr(c, "type", None) == "output_text" and getattr(c, "text", None):
+                return c.text
+    return getattr(resp, "output_text", None) or getattr(resp, "text", None)
+
+
+def _leaf_prompt(text: str, part: Tuple[int, int]) -> str:
+    return (
+        f"Resuma o trecho {part[0]} de {part[1]} de um ebook em até {LEAF_WORDS} palavras, "
+        "cobrindo todos os assuntos tratados (sem introdução).\n\n"
+        f"Trecho:\n----- INÍCIO -----\n{text}\n----- FIM -----"
+    )
+
+
+def _node_prompt(summaries: Sequence[str]) -> str:
+    parts = "\n\n".join(f"[{i}] {s}" for i, s in enumerate(summaries, 1))
+    return (
+        "Abaixo estão os resumos, em ordem, de partes consecutivas de um ebook. "
+        f"Escreva um único resumo destas partes em até {NODE_WORDS} palavras, citando todos os tópicos "
+        "(sem introdução).\n\n"
+        f"Resumos:\n{parts}"
+    )
+
+
+def _summarize(client: OpenAI, prompt: str, model: str, use_cache: bool) -> Tuple[str, int]:
+    use_responses = hasattr(client, "responses")
+    messages = [{"role": "system", "content": _SUMMARY_SYSTEM}, {"role": "user", "content": prompt}]
+    if use_responses:
+        call_kwargs: Dict[str, Any] = {"model": model, "input": messages}
+        settings: Dict[str, Any] = {"api": "responses"}
+    else:
+        call_kwargs = {"model": model, "messages": messages, "temperature": 0.0}
+        settings = {"api": "chat", "temperature": 0.0}
+    cache_key = response_cache_key("summary", model, _SUMMARY_SYSTEM, prompt, settings) if use_cache else None
+    if cache_key is not None:
+        cached = get_response_cache().get(cache_key)
+        if cached is not None:
+            record_usage("summary", model, cache_hit=True)
+            return cached.decode("utf-8"), 0
+
+    resp = create_response(client, use_responses, call_kwargs, "summary")
+    if use_responses:
+        text = _extract_text_from_responses(resp) or ""
+    else:
+        text = (resp.choices[0].message.content if resp.choices else "") or ""
+    text = text.strip()
+    if cache_key is not None and text:
+        get_response_cache().set(cache_key, text.encode("utf-8"))
+    return text, int(total_tokens(resp) or 0)
+
+
+def build_summary_tree(
+    client: OpenAI,
+    text: str,
+    model: str = DEFAULT_SUMMARY_MODEL,
+    leaf_tokens: int = DEFAULT_LEAF_TOKENS,
+    fanout: int = DEFAULT_FANOUT,
+    max_workers: int = 4,
+    use_cache: bool = True,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+) -> SummaryTree:
+    """
+    Constrói a árvore: resume as folhas em paralelo (no máximo `max_workers` requisições simultâneas),
+    depois cada grupo de `fanout` nós em paralelo, nível a nível, até a raiz.
+    Cada resumo vai para o cache de respostas: uma construção interrompida recomeça sem pagar de novo.
+    `on_progress(concluídos, total)` é chamado a cada resumo.
+    """
+    text = text.strip()
+    nodes = _leaf_nodes(text, leaf_tokens)
+    fanout = max(2, fanout)
+    total, width = len(nodes), len(nodes)
+    while width > 1:
+        width = -(-width // fanout)
+        total += width
+    done = 0
+    tokens = 0
+
+    def _run(prompts: List[str]) -> List[str]:
+        nonlocal done, tokens
+        results: List[str] = []
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(prompts)))) as pool:
+            for summary, used in pool.map(lambda p: _summarize(client, p, model, use_cache), prompts):
+                results.append(summary)
+                tokens += used
+                done += 1
+                if on_progress is not None:
+                    on_progress(done, total)
+        return results
+
+    n = len(nodes)
+    summaries = _run([_leaf_prompt(text[nd.start:nd.end].strip(), (i, n)) for i, nd in enumerate(nodes, 1)])
+    for nd, summary in zip(nodes, summaries):
+        nd.summary = summary
+
+    level_ids = list(range(len(nodes)))
+    level = 0
+    while len(level_ids) > 1:
+        level += 1
+        groups = [level_ids[i:i + fanout] for i in range(0, len(level_ids), fanout)]
+        summaries = _run([_node_prompt([nodes[c].summary for c in g]) for g in groups])
+        level_ids = []
+        for group, summary in zip(groups, summaries):
+            nodes.append(SummaryNode(level=level, summary=summary, children=group))
+            level_ids.append(len(nodes) - 1)
+    return SummaryTree(text, nodes, model=model, leaf_tokens=leaf_tokens, fanout=fanout, tokens_used=tokens)
+
+
+def open_summary_tree(directory: str | Path, text: str) -> Optional[SummaryTree]:
+    """
+    Árvore gravada em `directory` para este texto; None se não houver (ou for de outro texto).
+    """
+    try:
+        return SummaryTree.load(directory, text.strip())
+    except (OSError, ValueError, TypeError, KeyError):
+        return None
+
+
+def open_or_build_summary_tree(
+    directory: str | Path,
+    client: OpenAI,
+    text: str,
+    model: str = DEFAULT_SUMMARY_MODEL,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+) -> SummaryTree:
+    """
+    Reabre a árvore salva em `directory` se for do mesmo texto e modelo; caso contrário, constrói,
+    salva e retorna uma nova (ver `open_or_build_bm25_index`).
+    """
+    tree = open_summary_tree(directory, text)
+    if tree is not None and tree.model == model:
+        return tree
+    tree = build_summary_tree(client, text, model=model, on_progress=on_progress)
+    tree.save(directory)
+    return tree
+
+
+# -------- consulta --------
+def _bm25_rank(question: str, texts: Sequence[str]) -> List[Tuple[int, float]]:
+    index = BM25Index([TextChunk(index=i, text=t, start=i) for i, t in enumerate(texts)])
+    return [(ch.index, score) for ch, score in index.search(question, top_k=len(texts))]
+
+
+class SummaryTreeSelector:
+    """
+    ContextSelector sobre uma ou mais árvores (uma por ebook), com custo limitado por pergunta:
+    - desce das raízes nível a nível, mantendo os `beam` nós cujos resumos mais casam com a pergunta;
+    - sob os nós escolhidos, ranqueia os trechos originais (texto + resumo) e os envia até o orçamento,
+      precedidos pelo resumo de cada documento usado;
+    - pergunta sem termos nos trechos (ex.: "resuma o material"): envia os resumos de cima para baixo.
+    """
+
+    def __init__(self, trees: Sequence[SummaryTree], beam: int = DEFAULT_BEAM) -> None:
+        if not trees:
+            raise ValueError("Informe ao menos uma árvore de resumos.")
+        self.trees = list(trees)
+        self.beam = max(1, beam)
+
+    def _node_text(self, t: int, i: int) -> str:
+        # Folhas (árvores de profundidades diferentes se misturam na descida) contam também com o trecho
+        node = self.trees[t].nodes[i]
+        return f"{node.summary}\n{self.trees[t].leaf_text(node)}" if node.level == 0 else node.summary
+
+    def _descend(self, question: str) -> List[Tuple[int, int]]:
+        frontier = [(t, len(tree.nodes) - 1) for t, tree in enumerate(self.trees)]
+        while True:
+            candidates: List[Tuple[int, int]] = []
+            for t, i in frontier:
+                children = self.trees[t].nodes[i].children
+                candidates += [(t, c) for c in children] if children else [(t, i)]
+            if all(self.trees[t].nodes[i].level == 0 for t, i in candidates):
+                return candidates
+            ranked = _bm25_rank(question, [self._node_text(t, i) for t, i in candidates])
+            if not ranked:
+                # Resumos sem nenhum termo da pergunta: desce por todos (limitado ao beam no nível seguinte)
+                ranked = [(k, 0.0) for k in range(len(candidates))]
+            frontier = [candidates[k] for k, _score in ranked[:self.beam]]
+
+    def _overview(self, token_budget: int) -> Optional[str]:
+        # Resumos em largura (documento, seções, ...) até o orçamento
+        parts: List[str] = []
+        used = 0
+        queue = [(t, len(tree.nodes) - 1) for t, tree in enumerate(self.trees)]
+        while queue:
+            t, i = queue.pop(0)
+            node = self.trees[t].nodes[i]
+            if node.summary:
+                n_tokens = estimate_tokens(node.summary)
+                if parts and used + n_tokens > token_budget:
+                    break
+                parts.append(node.summary)
+                used += n_tokens
+            queue += [(t, c) for c in node.children]
+        return _CHUNK_SEP.join(parts) if parts else None
+
+    def select_context(
+        self,
+        question: str,
+        top_k: int = DEFAULT_TOP_K,
+        token_budget: int = DEFAULT_TOKEN_BUDGET,
+    ) -> Optional[str]:
+        leaves = self._descend(question)
+        leaf_texts = [self.trees[t].leaf_text(self.trees[t].nodes[i]) for t, i in leaves]
+        ranked = _bm25_rank(question, [self._node_text(t, i) for t, i in leaves])
+        if not ranked:
+            return self._overview(token_budget)
+
+        picked: List[int] = []
+        used = 0
+        for k, _score in ranked[:top_k]:
+            n_tokens = estimate_tokens(leaf_texts[k])
+            if picked and used + n_tokens > token_budget:
+                continue
+            picked.append(k)
+            used += n_tokens
+        picked.sort(key=lambda k: (leaves[k][0], self.trees[leaves[k][0]].nodes[leaves[k][1]].start))
+
+        # Resumo do documento de cada trecho escolhido, se couber no orçamento
+        heads: List[str] = []
+        for t in dict.fromkeys(leaves[k][0] for k in picked):
+            root = self.trees[t].root.summary
+            if root and used + estimate_tokens(root) <= token_budget:
+                heads.append(f"Resumo do documento: {root}")
+                used += estimate_tokens(root)
+        return _CHUNK_SEP.join(heads + [leaf_texts[k] for k in picked])
@@ -0,0 +1,146 @@
+from __future__ import annotations
+import asyncio
+import concurrent.futures as cf
+import threading
+from typing import Any, Awaitable, Callable, List, Optional, Set
+
+
+class BackgroundJob:
+    """
+    Operação rodando fora da thread da interface.
+    `cancel()`:
+    - corrotina: cancela a task no event loop (a requisição HTTP em andamento é abortada na hora);
+    - função síncrona: se ainda estiver na fila, sai dela; se já começou, marca `cancelled`
+      e chama o `abort` registrado pela função (ex.: TextStream.close).
+    """
+
+    def __init__(self) -> None:
+        self.future: Optional[cf.Future] = None
+        self.cancelled = False
+        self._abort: Optional[Callable[[], Any]] = None
+        self._started = False  # corrotina: já saiu da fila do runner
+        self._lock = threading.Lock()
+
+    def set_abort(self, abort: Optional[Callable[[], Any]]) -> None:
+        with self._lock:
+            self._abort = abort
+            cancelled = self.cancelled
+        if cancelled and abort is not None:
+            abort()
+
+    def cancel(self) -> None:
+        with self._lock:
+            self.cancelled = True
+            abort = self._abort
+        if self.future is not None:
+            self.future.cancel()
+        if abort is not None:
+            try:
+                abort()
+            except Exception:
+                pass
+
+    @property
+    def running(self) -> bool:
+        if self.future is None or self.future.done():
+            return False
+        return self.future.running() or self._started
+
+    def done(self) -> bool:
+        return self.future is not None and self.future.done()
+
+    def result(self, timeout: Optional[float] = None) -> Any:
+        return self.future.result(timeout) if self.future is not None else None
+
+
+class BackgroundRunner:
+    """
+    Executa operações longas sem travar a interface:
+    - `run(fn, ...)`: funções síncronas em um pool de `workers` threads; com workers=1 é uma fila
+      (ordem de chegada), útil para perguntas que compartilham o mesmo estado de conversa;
+    - `run_async(make_coro)`: corrotinas em um event loop próprio (thread dedicada), canceláveis de verdade;
+      no máximo `workers` ao mesmo tempo, as demais esperam na fila.
+    `on_done(job)` é chamado na thread do worker ao terminar, com erro ou cancelado.
+    """
+
+    def __init__(self, name: str = "ebookqa-bg", workers: int = 1) -> None:
+        self.name = name
+        self.workers = max(1, workers)
+        self._pool = cf.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=name)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._loop_lock = threading.Lock()
+        self._jobs: Set[BackgroundJob] = set()
+        self._jobs_lock = threading.Lock()
+
+    def _track(self, job: BackgroundJob, on_done: Optional[Callable[[BackgroundJob], None]]) -> BackgroundJob:
+        with self._jobs_lock:
+            self._jobs.add(job)
+
+        def _finish(_fut: cf.Future) -> None:
+            with self._jobs_lock:
+                self._jobs.discard(job)
+            if on_done is not None:
+                on_done(job)
+
+        job.future.add_done_callback(_finish)
+        return job
+
+    def run(
+        self,
+        fn: Callable[..., Any],
+        *args: Any,
+        on_done: Optional[Callable[[BackgroundJob], None]] = None,
+    ) -> BackgroundJob:
+        """
+        Enfileira `fn(job, *args)`: a função recebe o próprio job para registrar o abort e checar `cancelled`.
+        """
+        job = BackgroundJob()
+        job.future = self._pool.submit(fn, job, *args)
+        return self._track(job, on_done)
+
+    def _event_loop(self) -> asyncio.AbstractEventLoop:
+        with self._loop_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name=f"{self.name}-loop", daemon=True).start()
+                self._loop = loop
+                self._slots = asyncio.Semaphore(self.workers)
+            return self._loop
+
+    async def _guarded(self, job: BackgroundJob, make_coro: Callable[[], Awaitable[Any]]) -> Any:
+        async with self._slots:
+            job._started = True
+            return await make_coro()
+
+    def run_async(
+        self,
+        make_coro: Callable[[], Awaitable[Any]],
+        on_done: Optional[Callable[[BackgroundJob], None]] = None,
+    ) -> BackgroundJob:
+        job = BackgroundJob()
+        loop = self._event_loop()
+        job.future = asyncio.run_coroutine_threadsafe(self._guarded(job, make_coro), loop)
+        return self._track(job, on_done)
+
+    def jobs(self) -> List[BackgroundJob]:
+        with self._jobs_lock:
+            return list(self._jobs)
+
+    def pending(self) -> int:
+        """
+        Operações ainda não concluídas (em andamento + na fila).
+        """
+        return len(self.jobs())
+
+    def cancel_all(self) -> None:
+        for job in self.jobs():
+            job.cancel()
+
+    def shutdown(self) -> None:
+        self.cancel_all()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        with self._loop_lock:
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._loop = None
@@ -0,0 +1,23 @@
+from __future__ import annotations
+import asyncio
+import threading
+import weakref
+
+DEFAULT_MAX_CONCURRENCY = 8  # requisições simultâneas à API por event loop
+
+_lock = threading.Lock()
+# Um semáforo por event loop (asyncio.Semaphore não pode ser compartilhado entre loops)
+_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+
+def get_async_semaphore() -> asyncio.Semaphore:
+    """
+    Semáforo compartilhado por todos os agentes assíncronos do event loop atual.
+    """
+    loop = asyncio.get_running_loop()
+    with _lock:
+        sem = _semaphores.get(loop)
+        if sem is None:
+            sem = asyncio.Semaphore(DEFAULT_MAX_CONCURRENCY)
+            _semaphores[loop] = sem
+        return sem
@@ -1,14 +1,168 @@
 from __future__ import annotations
+import atexit
+import hashlib
+import importlib.util
+import os
+import threading
+from typing import Any, Dict, Optional
+
 import httpx
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
+
+from api.scheduler import get_scheduler
+
+# Limites do pool HTTP (keep-alive): conexões são reaproveitadas entre perguntas/refinos
+POOL_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=120.0)
+
+# Timeout padrão do cliente e timeouts de leitura por operação (segundos)
+DEFAULT_TIMEOUT = httpx.Timeout(connect=10.0, read=60.0, write=30.0, pool=10.0)
+OPERATION_TIMEOUTS: Dict[str, float] = {
+    "qa": 90.0,
+    "refine": 300.0,
+    "embed": 60.0,
+    "summary": 90.0,
+}
+
+
+def _http2_enabled() -> bool:
+    # HTTP/2 exige o pacote opcional 'h2' (pip install httpx[http2]); EBOOKQA_HTTP2=0 desliga
+    if os.environ.get("EBOOKQA_HTTP2", "1").strip() == "0":
+        return False
+    return importlib.util.find_spec("h2") is not None
+
+
+def _key_id(key: str) -> str:
+    # Nunca guardamos/exibimos a chave: apenas um prefixo do hash
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:12]
+
+
+def operation_timeout(operation: str) -> httpx.Timeout:
+    read = OPERATION_TIMEOUTS.get(operation, DEFAULT_TIMEOUT.read)
+    return httpx.Timeout(connect=DEFAULT_TIMEOUT.connect, read=read, write=DEFAULT_TIMEOUT.write, pool=DEFAULT_TIMEOUT.pool)
+
+
+def with_operation_timeout(client: Any, operation: str) -> Any:
+    """
+    Retorna uma visão do cliente com o timeout da operação ('qa', 'refine', 'embed', 'summary').
+    A cópia compartilha o mesmo pool HTTP do cliente original.
+    """
+    if hasattr(client, "with_options"):
+        return client.with_options(timeout=operation_timeout(operation))
+    return client
+
 
 class OpenAIClientFactory:
+    _lock = threading.Lock()
+    _clients: Dict[str, OpenAI] = {}
+    _stats: Dict[str, Dict[str, int]] = {}
+
     @staticmethod
-    def build(api_key: str) -> OpenAI:
+    def build(api_key: str, pooled: bool = True) -> OpenAI:
+        """
+        Retorna o cliente do processo para esta API key (criado uma vez e reutilizado),
+        com keep-alive, limites de conexão e HTTP/2 quando disponível.
+        `pooled=False` cria um cliente avulso (o chamador deve fechá-lo).
+        """
         key = (api_key or "").strip()
         if not key:
             raise ValueError("API key não informada.")
+        if not pooled:
+            return OpenAIClientFactory._new_client(key, stats=None)
+
+        kid = _key_id(key)
+        with OpenAIClientFactory._lock:
+            stats = OpenAIClientFactory._stats.setdefault(kid, {"builds": 0, "reuses": 0, "requests": 0, "responses": 0})
+            client = OpenAIClientFactory._clients.get(kid)
+            if client is not None and not client.is_closed():
+                stats["reuses"] += 1
+                return client
+            client = OpenAIClientFactory._new_client(key, stats=stats)
+            OpenAIClientFactory._clients[kid] = client
+            stats["builds"] += 1
+            return client
+
+    @staticmethod
+    def _new_client(key: str, stats: Optional[Dict[str, int]]) -> OpenAI:
+        def _observe(response: httpx.Response) -> None:
+            # Cabeçalhos x-ratelimit-* alimentam o agendador compartilhado
+            get_scheduler().observe_headers(response.headers)
+
+        hooks: Dict[str, list] = {"response": [_observe]}
+        if stats is not None:
+            def _on_request(request: httpx.Request) -> None:
+                stats["requests"] += 1
+
+            def _on_response(response: httpx.Response) -> None:
+                stats["responses"] += 1
+
+            hooks = {"request": [_on_request], "response": [_observe, _on_response]}
 
         # httpx sem herdar variáveis do ambiente (trust_env=False) => ignora HTTP(S)_PROXY
-        http_client = httpx.Client(trust_env=False, timeout=30.0, verify=True)
-        return OpenAI(api_key=key, http_client=http_client)
\ No newline at end of file
+        http_client = httpx.Client(
+            trust_env=False,
+            timeout=DEFAULT_TIMEOUT,
+            limits=POOL_LIMITS,
+            http2=_http2_enabled(),
+            verify=True,
+            event_hooks=hooks,
+        )
+        # Retentativas ficam a cargo do agendador (api.scheduler), não do SDK
+        return OpenAI(api_key=key, http_client=http_client, max_retries=0)
+
+    @staticmethod
+    def build_async(api_key: str) -> AsyncOpenAI:
+        """
+        Cliente assíncrono para as versões *_async dos agentes.
+        Não entra no registro (fica preso ao event loop que o usa); o chamador deve fechá-lo.
+        """
+        key = (api_key or "").strip()
+        if not key:
+            raise ValueError("API key não informada.")
+
+        async def _observe(response: httpx.Response) -> None:
+            get_scheduler().observe_headers(response.headers)
+
+        http_client = httpx.AsyncClient(
+            trust_env=False,
+            timeout=DEFAULT_TIMEOUT,
+            limits=POOL_LIMITS,
+            http2=_http2_enabled(),
+            verify=True,
+            event_hooks={"response": [_observe]},
+        )
+        return AsyncOpenAI(api_key=key, http_client=http_client, max_retries=0)
+
+    @staticmethod
+    def pool_stats() -> Dict[str, Dict[str, Any]]:
+        """
+        Estatísticas por cliente do registro (chave identificada por hash):
+        builds/reuses do cliente, requisições/respostas HTTP e conexões abertas no pool.
+        Muitas requisições para poucas conexões = keep-alive funcionando.
+        """
+        out: Dict[str, Dict[str, Any]] = {}
+        with OpenAIClientFactory._lock:
+            for kid, stats in OpenAIClientFactory._stats.items():
+                entry: Dict[str, Any] = dict(stats)
+                client = OpenAIClientFactory._clients.get(kid)
+                pool = getattr(getattr(getattr(client, "_client", None), "_transport", None), "_pool", None)
+                entry["open_connections"] = len(getattr(pool, "connections", []) or [])
+                entry["http2"] = _http2_enabled()
+                out[kid] = entry
+        return out
+
+    @staticmethod
+    def close_all() -> None:
+        """
+        Fecha todos os clientes do registro (chamado automaticamente ao encerrar o processo).
+        """
+        with OpenAIClientFactory._lock:
+            clients = list(OpenAIClientFactory._clients.values())
+            OpenAIClientFactory._clients.clear()
+        for client in clients:
+            try:
+                client.close()
+            except Exception:
+                pass
+
+
+atexit.register(OpenAIClientFactory.close_all)
@@ -0,0 +1,35 @@
+from __future__ import annotations
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Balde de fichas thread-safe: `capacity` fichas, reabastecidas a `refill_per_sec`.
+    `reserve(n)` consome as fichas e diz quanto esperar (quem espera é o chamador).
+    """
+
+    def __init__(self, capacity: float, refill_per_sec: float) -> None:
+        self.capacity = float(capacity)
+        self.refill_per_sec = float(refill_per_sec)
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.refill_per_sec)
+        self._updated = now
+
+    def reserve(self, n: float = 1.0) -> float:
+        """
+        Consome `n` fichas imediatamente (o saldo pode ficar negativo) e retorna
+        quantos segundos o chamador deve esperar antes de usá-las. Não bloqueia,
+        por isso serve tanto para threads quanto para asyncio.
+        """
+        with self._lock:
+            self._refill()
+            need = min(n, self.capacity)
+            delay = max(0.0, need - self._tokens) / self.refill_per_sec if self.refill_per_sec > 0 else 0.0
+            self._tokens -= n
+            return delay
@@ -0,0 +1,293 @@
+from __future__ import annotations
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Dict, Mapping, Optional, Tuple, TypeVar
+
+import httpx
+import openai
+
+from api.rate_limit import TokenBucket
+
+T = TypeVar("T")
+
+# Classes de erro
+RATE_LIMIT = "rate_limit"
+TRANSIENT = "transient"
+FATAL = "fatal"
+
+_TRANSIENT_STATUS = {408, 409, 500, 502, 503, 504, 520, 522, 524}
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNIT = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+# Aviso de retentativa: (erro, classe do erro, tentativa que falhou, espera em segundos antes da próxima)
+RetryHook = Callable[[BaseException, str, int, float], None]
+
+# Saída assumida quando a chamada não informa limite de tokens de resposta
+DEFAULT_OUTPUT_ESTIMATE = 1000
+
+
+@dataclass
+class CallStats:
+    attempts: int = 0
+    waited_s: float = 0.0  # tempo total aguardando limites/backoff
+
+
+def parse_reset(value: Optional[str]) -> Optional[float]:
+    """
+    Converte os formatos de reset da OpenAI ('1s', '6m0s', '250ms', '0.5') em segundos.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parts = _DURATION_RE.findall(value)
+    if not parts:
+        return None
+    return sum(float(n) * _DURATION_UNIT[u] for n, u in parts)
+
+
+def retry_after_from_headers(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    """
+    Tempo de espera sugerido pelo servidor: retry-after-ms, retry-after (segundos ou data HTTP)
+    ou o maior x-ratelimit-reset-* quando o respectivo remaining chegou a zero.
+    """
+    if not headers:
+        return None
+    ms = headers.get("retry-after-ms")
+    if ms:
+        try:
+            return max(0.0, float(ms) / 1000.0)
+        except ValueError:
+            pass
+    ra = headers.get("retry-after")
+    if ra:
+        try:
+            return max(0.0, float(ra))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(ra).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    waits = []
+    for kind in ("requests", "tokens"):
+        if headers.get(f"x-ratelimit-remaining-{kind}") == "0":
+            reset = parse_reset(headers.get(f"x-ratelimit-reset-{kind}"))
+            if reset is not None:
+                waits.append(reset)
+    return max(waits) if waits else None
+
+
+def classify_error(exc: BaseException) -> Tuple[str, Optional[float]]:
+    """
+    Classifica o erro pelo tipo de exceção da OpenAI/httpx e status HTTP.
+    Retorna (classe, espera sugerida pelo servidor em segundos ou None).
+    """
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    wait = retry_after_from_headers(headers)
+
+    if isinstance(exc, openai.RateLimitError):
+        # 429 por falta de crédito não se resolve esperando
+        if getattr(exc, "code", None) == "insufficient_quota":
+            return FATAL, None
+        return RATE_LIMIT, wait
+    if isinstance(exc, (openai.APITimeoutError, openai.APIConnectionError)):
+        return TRANSIENT, wait
+    if isinstance(exc, openai.APIStatusError):
+        status = exc.status_code
+        if status == 429:
+            return RATE_LIMIT, wait
+        if status in _TRANSIENT_STATUS or status >= 500:
+            return TRANSIENT, wait
+        return FATAL, None
+    if isinstance(exc, (httpx.TimeoutException, httpx.TransportError)):
+        return TRANSIENT, None
+    return FATAL, None
+
+
+def estimate_request_tokens(call_kwargs: Mapping[str, Any]) -> int:
+    """
+    Estimativa do custo (tokens de entrada + saída esperada) antes de enviar a requisição.
+    """
+    payload = call_kwargs.get("input", call_kwargs.get("messages", ""))
+    chars = len(json.dumps(payload, ensure_ascii=False)) if not isinstance(payload, str) else len(payload)
+    out = call_kwargs.get("max_output_tokens") or call_kwargs.get("max_tokens") or DEFAULT_OUTPUT_ESTIMATE
+    return chars // 4 + int(out)
+
+
+class RequestScheduler:
+    """
+    Agendador compartilhado de requisições à API:
+    - baldes de requisições/min (RPM) e tokens/min (TPM); limites informados ou aprendidos
+      dos cabeçalhos x-ratelimit-limit-*;
+    - pausa global até o reset informado pelo servidor quando o limite é atingido;
+    - retry com backoff exponencial + jitter apenas para erros transitórios/429;
+      `on_retry` é avisado de cada espera (front ends mostram ao usuário por que a chamada está parada).
+    """
+
+    def __init__(
+        self,
+        rpm: Optional[float] = None,
+        tpm: Optional[float] = None,
+        max_retries: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        jitter: float = 0.25,
+        on_retry: Optional[RetryHook] = None,
+    ) -> None:
+        self.max_retries = max_retries
+        self.on_retry = on_retry
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self._lock = threading.Lock()
+        self._pinned = {"requests": rpm is not None, "tokens": tpm is not None}
+        self._buckets: Dict[str, Optional[TokenBucket]] = {
+            "requests": self._make_bucket(rpm),
+            "tokens": self._make_bucket(tpm),
+        }
+        self._blocked_until = 0.0
+
+    @staticmethod
+    def _make_bucket(per_minute: Optional[float]) -> Optional[TokenBucket]:
+        if not per_minute:
+            return None
+        return TokenBucket(capacity=per_minute, refill_per_sec=per_minute / 60.0)
+
+    def set_limits(self, rpm: Optional[float] = None, tpm: Optional[float] = None) -> None:
+        """
+        Fixa os limites (não serão sobrescritos pelos cabeçalhos do servidor).
+        """
+        with self._lock:
+            if rpm is not None:
+                self._buckets["requests"] = self._make_bucket(rpm)
+                self._pinned["requests"] = True
+            if tpm is not None:
+                self._buckets["tokens"] = self._make_bucket(tpm)
+                self._pinned["tokens"] = True
+
+    def observe_headers(self, headers: Mapping[str, str]) -> None:
+        """
+        Atualiza o estado a partir dos cabeçalhos x-ratelimit-* de qualquer resposta da API.
+        """
+        with self._lock:
+            for kind in ("requests", "tokens"):
+                limit = headers.get(f"x-ratelimit-limit-{kind}")
+                if limit and not self._pinned[kind]:
+                    try:
+                        value = float(limit)
+                    except ValueError:
+                        continue
+                    bucket = self._buckets[kind]
+                    if bucket is None or bucket.capacity != value:
+                        self._buckets[kind] = self._make_bucket(value)
+            wait = retry_after_from_headers(headers)
+            if wait:
+                self._blocked_until = max(self._blocked_until, time.monotonic() + wait)
+
+    def _reserve(self, estimated_tokens: int) -> float:
+        """
+        Reserva capacidade nos baldes e devolve quanto esperar antes de enviar.
+        """
+        with self._lock:
+            delay = max(0.0, self._blocked_until - time.monotonic())
+            req, tok = self._buckets["requests"], self._buckets["tokens"]
+        if req is not None:
+            delay = max(delay, req.reserve(1))
+        if tok is not None and estimated_tokens:
+            delay = max(delay, tok.reserve(estimated_tokens))
+        return delay
+
+    def _retry_delay(self, attempt: int, kind: str, server_wait: Optional[float]) -> float:
+        if server_wait is not None:
+            delay = server_wait
+            if kind == RATE_LIMIT:
+                with self._lock:
+                    self._blocked_until = max(self._blocked_until, time.monotonic() + server_wait)
+        else:
+            delay = self.base_delay * (2 ** (attempt - 1))
+        delay = min(self.max_delay, delay) * (1 + random.uniform(-self.jitter, self.jitter))
+        return max(0.1, delay)
+
+    def _notify_retry(self, error: BaseException, kind: str, attempt: int, delay: float) -> None:
+        hook = self.on_retry
+        if hook is None:
+            return
+        try:
+            hook(error, kind, attempt, delay)
+        except Exception:
+            pass
+
+    def call(
+        self,
+        fn: Callable[[], T],
+        estimated_tokens: int = 0,
+        stats: Optional[CallStats] = None,
+    ) -> T:
+        stats = stats if stats is not None else CallStats()
+        for attempt in range(1, self.max_retries + 2):
+            wait = self._reserve(estimated_tokens)
+            if wait > 0:
+                time.sleep(wait)
+                stats.waited_s += wait
+            stats.attempts = attempt
+            try:
+                return fn()
+            except Exception as e:
+                kind, server_wait = classify_error(e)
+                if kind == FATAL or attempt > self.max_retries:
+                    raise
+                delay = self._retry_delay(attempt, kind, server_wait)
+                self._notify_retry(e, kind, attempt, delay)
+                time.sleep(delay)
+                stats.waited_s += delay
+        raise RuntimeError("unreachable")
+
+    async def acall(
+        self,
+        fn: Callable[[], Awaitable[T]],
+        estimated_tokens: int = 0,
+        stats: Optional[CallStats] = None,
+    ) -> T:
+        stats = stats if stats is not None else CallStats()
+        for attempt in range(1, self.max_retries + 2):
+            wait = self._reserve(estimated_tokens)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                stats.waited_s += wait
+            stats.attempts = attempt
+            try:
+                return await fn()
+            except Exception as e:
+                kind, server_wait = classify_error(e)
+                if kind == FATAL or attempt > self.max_retries:
+                    raise
+                delay = self._retry_delay(attempt, kind, server_wait)
+                self._notify_retry(e, kind, attempt, delay)
+                await asyncio.sleep(delay)
+                stats.waited_s += delay
+        raise RuntimeError("unreachable")
+
+
+_SCHEDULER: Optional[RequestScheduler] = None
+_SCHEDULER_LOCK = threading.Lock()
+
+
+def get_scheduler() -> RequestScheduler:
+    """
+    Agendador do processo, compartilhado por todos os agentes e front ends.
+    """
+    global _SCHEDULER
+    with _SCHEDULER_LOCK:
+        if _SCHEDULER is None:
+            _SCHEDULER = RequestScheduler()
+        return _SCHEDULER
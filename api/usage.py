@@ -0,0 +1,147 @@
+from __future__ import annotations
+import csv
+import json
+import threading
+import time
+from dataclasses import asdict, dataclass, field, fields
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+
+@dataclass
+class UsageRecord:
+    operation: str  # "qa" | "refine" | "embed" | ...
+    model: str
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cached_tokens: int = 0
+    latency_s: float = 0.0
+    retries: int = 0
+    cache_hit: bool = False
+    streamed: bool = False
+    timestamp: float = field(default_factory=time.time)
+
+    @property
+    def total_tokens(self) -> int:
+        return self.input_tokens + self.output_tokens
+
+
+def _get(obj: Any, name: str) -> Any:
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+
+def usage_from_response(resp: Any) -> Dict[str, int]:
+    """
+    Lê o objeto `usage` da API Responses (input/output_tokens) ou de Chat Completions
+    (prompt/completion_tokens), incluindo tokens de entrada servidos do cache do provedor.
+    """
+    usage = _get(resp, "usage")
+    if usage is None:
+        return {"input_tokens": 0, "output_tokens": 0, "cached_tokens": 0}
+    inp = _get(usage, "input_tokens")
+    if inp is None:
+        inp = _get(usage, "prompt_tokens")
+    out = _get(usage, "output_tokens")
+    if out is None:
+        out = _get(usage, "completion_tokens")
+    details = _get(usage, "input_tokens_details") or _get(usage, "prompt_tokens_details")
+    cached = _get(details, "cached_tokens") if details is not None else None
+    return {"input_tokens": int(inp or 0), "output_tokens": int(out or 0), "cached_tokens": int(cached or 0)}
+
+
+def total_tokens(resp: Any) -> Optional[int]:
+    """
+    Total de tokens (entrada + saída) da resposta; None se a API não informou `usage`.
+    """
+    if _get(resp, "usage") is None:
+        return None
+    u = usage_from_response(resp)
+    return u["input_tokens"] + u["output_tokens"]
+
+
+class UsageLedger:
+    """
+    Registro em memória (thread-safe) de todas as chamadas à API do processo:
+    tokens (entrada/saída/cache), latência, modelo e retentativas.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._records: List[UsageRecord] = []
+
+    def record(self, rec: UsageRecord) -> UsageRecord:
+        with self._lock:
+            self._records.append(rec)
+        return rec
+
+    def records(self) -> List[UsageRecord]:
+        with self._lock:
+            return list(self._records)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._records.clear()
+
+    def totals(self) -> Dict[str, Any]:
+        recs = self.records()
+        calls = [r for r in recs if not r.cache_hit]
+        latency = sum(r.latency_s for r in calls)
+        return {
+            "calls": len(calls),
+            "cache_hits": len(recs) - len(calls),
+            "input_tokens": sum(r.input_tokens for r in calls),
+            "output_tokens": sum(r.output_tokens for r in calls),
+            "cached_tokens": sum(r.cached_tokens for r in calls),
+            "total_tokens": sum(r.total_tokens for r in calls),
+            "retries": sum(r.retries for r in calls),
+            "latency_s": round(latency, 3),
+            "avg_latency_s": round(latency / len(calls), 3) if calls else 0.0,
+        }
+
+    def summary_text(self) -> str:
+        t = self.totals()
+        return (
+            f"{t['calls']} chamada(s) à API, {t['cache_hits']} resposta(s) do cache local | "
+            f"tokens: {t['input_tokens']} entrada ({t['cached_tokens']} em cache), "
+            f"{t['output_tokens']} saída | latência total {t['latency_s']:.1f}s "
+            f"(média {t['avg_latency_s']:.1f}s) | {t['retries']} retentativa(s)"
+        )
+
+    def to_json(self, path: str | Path) -> Path:
+        p = Path(path).expanduser().resolve()
+        payload = {
+            "totals": self.totals(),
+            "records": [dict(asdict(r), total_tokens=r.total_tokens) for r in self.records()],
+        }
+        p.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+        return p
+
+    def to_csv(self, path: str | Path) -> Path:
+        p = Path(path).expanduser().resolve()
+        names = [f.name for f in fields(UsageRecord)] + ["total_tokens"]
+        with p.open("w", encoding="utf-8", newline="") as fh:
+            writer = csv.DictWriter(fh, fieldnames=names)
+            writer.writeheader()
+            for r in self.records():
+                writer.writerow(dict(asdict(r), total_tokens=r.total_tokens))
+        return p
+
+    def export(self, path: str | Path) -> Path:
+        """
+        Exporta em CSV se a extensão for .csv; caso contrário, em JSON.
+        """
+        return self.to_csv(path) if str(path).lower().endswith(".csv") else self.to_json(path)
+
+
+_LEDGER: Optional[UsageLedger] = None
+_LEDGER_LOCK = threading.Lock()
+
+
+def get_ledger() -> UsageLedger:
+    global _LEDGER
+    with _LEDGER_LOCK:
+        if _LEDGER is None:
+            _LEDGER = UsageLedger()
+        return _LEDGER
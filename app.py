@@ -1,13 +1,18 @@
 from __future__ import annotations
+import hashlib
 import streamlit as st
 from openai import OpenAI
 from api.openai_client import OpenAIClientFactory
-from agents.refiner_agent import refine_transcript_to_ebook
-from agents.qa_agent import answer_with_ebook
+from agents.refiner_agent import DEFAULT_REFINER_MODEL, refine_transcript_segmented
+from agents.qa_agent import DEFAULT_QA_MODEL, QASession
 from models.refiner_models import RefinerRequest
-from models.qa_models import QARequest
-from utils.io_utils import read_txt, save_txt
+from utils.io_utils import read_txt, read_uploaded_text_or_pdf, save_txt
+from utils.library import get_library
+from utils.pdf_extract import file_sha256
+from utils.semantic_cache import semantic_cache_for
+from utils.vector_store import default_retriever, open_retriever
 from utils.flow_utils import normalize_none_answer
+from api.usage import get_ledger
 from pathlib import Path
 
 import os
@@ -16,6 +21,38 @@ for var in ("HTTP_PROXY", "HTTPS_PROXY", "ALL_PROXY", "NO_PROXY"):
 
 st.set_page_config(page_title="Ebook Q&A (OpenAI + Streamlit)", page_icon="📚", layout="centered")
 
+
+# ----------------- Caches entre reruns -----------------
+@st.cache_data(show_spinner="Lendo o arquivo...", max_entries=16)
+def _extract_upload(digest: str, name: str, _uploaded) -> str:
+    # Chave = hash do conteúdo + nome (o arquivo em si não entra no hash do cache)
+    return read_uploaded_text_or_pdf(_uploaded, name)
+
+
+@st.cache_resource(show_spinner=False)
+def _get_client(api_key: str) -> OpenAI:
+    return OpenAIClientFactory.build(api_key)
+
+
+@st.cache_resource(show_spinner="Indexando o ebook...", max_entries=8)
+def _get_index(text_digest: str, retriever: str, _text: str, _client: OpenAI):
+    # BM25 ou embeddings ($EBOOKQA_RETRIEVER); o tipo entra na chave do cache
+    return open_retriever(get_library().index_dir(_text), _text, retriever, _client)
+
+
+def upload_text(uploaded) -> str:
+    """
+    Texto do upload atual, guardado no estado da sessão: reruns com o mesmo arquivo não o releem
+    nem recalculam o hash; outro upload do mesmo conteúdo reaproveita a extração (`_extract_upload`).
+    """
+    upload_key = (getattr(uploaded, "file_id", None) or uploaded.name, uploaded.size)
+    if st.session_state.get("upload_key") != upload_key:
+        digest = file_sha256(uploaded)
+        st.session_state.upload_text = _extract_upload(digest, uploaded.name, uploaded)
+        st.session_state.upload_key = upload_key
+    return st.session_state.upload_text
+
+
 if "step" not in st.session_state:
     st.session_state.step = 1
 if "api_key" not in st.session_state:
@@ -24,8 +61,18 @@ if "ebook_text" not in st.session_state:
     st.session_state.ebook_text = None
 if "last_answer" not in st.session_state:
     st.session_state.last_answer = None
+if "ebook_index" not in st.session_state:
+    st.session_state.ebook_index = None
+if "qa_session" not in st.session_state:
+    st.session_state.qa_session = None
 
 st.title("📚 Ebook Q&A")
+
+# Uso da API (tokens/latência) acumulado no processo do servidor
+with st.sidebar:
+    st.markdown("#### Uso da API")
+    st.caption(get_ledger().summary_text())
+
 api_key_input = ""
 
 # ----------------- Etapa 1: Token -----------------
@@ -52,13 +99,30 @@ elif st.session_state.step == 2:
         accept_multiple_files=False
     )
 
+    # Biblioteca: ebooks processados em sessões anteriores abrem sem reprocessar
+    library = get_library()
+    lib_entries = library.entries()
+    if lib_entries and uploaded is None:
+        with st.expander(f"Ou use ebooks da biblioteca ({len(lib_entries)})"):
+            picked = st.multiselect(
+                "Ebooks já processados",
+                [e.id for e in lib_entries],
+                format_func=lambda entry_id: library.get(entry_id).label(),
+            )
+            if st.button("Usar selecionados", disabled=not picked):
+                sep = "\n\n" + ("-" * 80) + "\n"
+                st.session_state.ebook_text = sep.join(library.read_many(picked)).strip()
+                st.session_state.ebook_index = None
+                st.session_state.qa_session = None
+                st.session_state.step = 3
+                st.rerun()
+
     if uploaded is not None:
-        from utils.io_utils import read_uploaded_text_or_pdf, save_txt
         tmp_paths_to_cleanup = []  # se o util criar arquivos temporários, adicione-os aqui para limpeza
 
         try:
-            # 1) Ler conteúdo em memória, sem persistir o arquivo de entrada
-            raw_text = read_uploaded_text_or_pdf(uploaded, uploaded.name)
+            # 1) Ler o UploadedFile em streaming (sem getvalue()), uma vez por arquivo (cache + estado da sessão)
+            raw_text = upload_text(uploaded)
             st.success(f"Arquivo carregado: {uploaded.name}")
         except Exception as e:
             st.error(f"Falha ao ler arquivo: {e}")
@@ -90,29 +154,33 @@ elif st.session_state.step == 2:
             if prosseguir:
                 if material_type.startswith("Material já Tratado"):
                     # Pular agente: usar texto como está
+                    library.add(raw_text, uploaded.name.rsplit(".", 1)[0], source=uploaded.name)
                     st.session_state.ebook_text = raw_text
+                    st.session_state.ebook_index = None
+                    st.session_state.qa_session = None
                     st.success("Material carregado. Indo para a Etapa 3.")
                     st.session_state.step = 3
                     st.rerun()
                 else:
                     # 2) Geração do ebook (mantendo apenas o resultado final)
                     try:
-                        from api.openai_client import OpenAIClientFactory
-                        from models.refiner_models import RefinerRequest
-                        from agents.refiner_agent import refine_transcript_to_ebook
-
-                        client = OpenAIClientFactory.build(st.session_state.api_key)
+                        client = _get_client(st.session_state.api_key)
 
                         with st.spinner("Gerando ebook a partir da transcrição..."):
                             req = RefinerRequest(transcript_text=raw_text)
-                            out = refine_transcript_to_ebook(client, req)
+                            out = refine_transcript_segmented(client, req)
 
                         # 3) Salvar apenas o ebook gerado (arquivo final do usuário)
                         safe_base = (uploaded.name or "ebook").rsplit(".", 1)[0]
                         out_path = save_txt(out.ebook_text, f"{safe_base}_refinado.txt")
+                        library.add(
+                            out.ebook_text, safe_base, source=uploaded.name, model=DEFAULT_REFINER_MODEL, refined=True
+                        )
 
                         # 4) Atualizar estado e seguir
                         st.session_state.ebook_text = out.ebook_text
+                        st.session_state.ebook_index = None
+                        st.session_state.qa_session = None
                         st.success(f"Ebook gerado e salvo em: {out_path}")
                         st.session_state.step = 3
                         st.rerun()
@@ -140,6 +208,14 @@ elif st.session_state.step == 3:
     if not st.session_state.get("ebook_text"):
         st.warning("Nenhum ebook carregado. Volte à Etapa 2.")
     else:
+        # Índice por ebook: no estado da sessão (reruns) e em cache de recurso (outras sessões, mesmo texto)
+        if st.session_state.get("ebook_index") is None:
+            text = st.session_state.ebook_text
+            st.session_state.ebook_index = _get_index(
+                hashlib.sha256(text.encode("utf-8")).hexdigest(), default_retriever(), text,
+                _get_client(st.session_state.api_key),
+            )
+
         # Campo de pergunta
         q = st.text_area("Digite sua pergunta", height=120)
 
@@ -149,22 +225,24 @@ elif st.session_state.step == 3:
                 st.error("Escreva uma pergunta.")
             else:
                 try:
-                    from api.openai_client import OpenAIClientFactory
-                    from models.qa_models import QARequest
-                    from agents.qa_agent import answer_with_ebook
-                    from utils.io_utils import save_txt
-
-                    client = OpenAIClientFactory.build(st.session_state.api_key)
-
-                    with st.spinner("Consultando o material..."):
-                        req = QARequest(
-                            ebook_text=st.session_state.ebook_text,
-                            question=q.strip(),
-                            # se existir este campo no seu modelo:
-                            # fallback_on_insufficient="none"
+                    # Sessão por ebook: o material vai uma única vez como prefixo (contexto reaproveitado)
+                    if st.session_state.get("qa_session") is None:
+                        client = _get_client(st.session_state.api_key)
+                        st.session_state.qa_session = QASession(
+                            client, st.session_state.ebook_text, retriever=st.session_state.ebook_index,
+                            semantic_cache=semantic_cache_for(st.session_state.ebook_text, DEFAULT_QA_MODEL),
                         )
-                        out = answer_with_ebook(client, req)
-                        # out é QAOutput(answer: str, has_content: bool)
+                    stream = st.session_state.qa_session.ask_stream(q.strip())
+                    # Exibe os tokens conforme chegam; a resposta final normalizada vem de stream.result
+                    live = st.empty()
+                    with live.container():
+                        st.write_stream(stream)
+                    out = stream.result
+                    live.empty()  # a resposta final é exibida abaixo, a partir do estado
+                    if out.cache_hit:
+                        st.caption("Resposta reaproveitada do cache de perguntas (sem chamada à API).")
+                    st.caption(st.session_state.qa_session.cache_summary())
+                    # out é QAOutput(answer: str, has_content: bool)
 
                     # Comentário original: "QARequest sem has_content como atributo..."
                     # Correção: quem tem 'has_content' é o QAOutput (out.has_content).
@@ -228,6 +306,8 @@ elif st.session_state.step == 3:
                     st.session_state.last_answer = None
                     st.session_state.qa_status = None
                     st.session_state.ebook_text = None
+                    st.session_state.ebook_index = None
+                    st.session_state.qa_session = None
                     st.session_state.step = 2
                     st.rerun()
                 elif opt == "Sair":
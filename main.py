@@ -1,18 +1,25 @@
 from __future__ import annotations
+import asyncio
 import os
-import io
+import multiprocessing
+import time
 from pathlib import Path
 from typing import Optional
 import flet as ft
 
 # ===== Seus módulos (iguais aos do projeto) =====
 from api.openai_client import OpenAIClientFactory
-from agents.refiner_agent import refine_transcript_to_ebook
-from agents.qa_agent import answer_with_ebook
+from agents.refiner_agent import DEFAULT_REFINER_MODEL, refine_transcript_segmented_async
+from agents.qa_agent import DEFAULT_QA_MODEL, QASession
 from models.refiner_models import RefinerRequest
-from models.qa_models import QARequest
 from utils.io_utils import read_uploaded_text_or_pdf
 from utils.flow_utils import normalize_none_answer
+from utils.retrieval import ContextSelector
+from utils.library import get_library
+from api.background import BackgroundJob, BackgroundRunner
+from api.usage import get_ledger
+from utils.semantic_cache import semantic_cache_for
+from utils.vector_store import open_retriever
 
 # Remove proxies, como no Streamlit
 for var in ("HTTP_PROXY", "HTTPS_PROXY", "ALL_PROXY", "NO_PROXY"):
@@ -24,13 +31,20 @@ class AppState:
         self.step: int = 1
         self.api_key: Optional[str] = None
         self.ebook_text: Optional[str] = None
+        self.ebook_index: Optional[ContextSelector] = None  # construído uma vez por ebook (Etapa 3)
+        self.qa_session: Optional[QASession] = None  # conversa sobre o ebook atual (prefixo enviado uma vez)
         self.last_answer: Optional[str] = None
-        self.qa_status: Optional[str] = None   # "ok" | "insufficient" | "error"
+        self.qa_status: Optional[str] = None   # "ok" | "insufficient" | "error" | "cancelled"
         self.uploaded_file_name: Optional[str] = None
         self.selected_file: Optional[ft.FilePickerFile] = None  # guarda seleção da etapa 2
+        self.refine_job: Optional[BackgroundJob] = None  # leitura/refino em andamento (Etapa 2)
 
 STATE = AppState()
 
+# Operações longas fora da thread da interface
+REFINE_RUNNER = BackgroundRunner("ebookqa-refine")
+QA_RUNNER = BackgroundRunner("ebookqa-qa", workers=1)  # fila: uma pergunta por vez (a sessão guarda o histórico)
+
 # ===== Util =====
 def toast(page: ft.Page, msg: str):
     page.snack_bar = ft.SnackBar(ft.Text(msg))
@@ -132,63 +146,127 @@ def view_step2(page: ft.Page):
         ),
     )
 
+    # Biblioteca: ebooks processados em sessões anteriores abrem sem reprocessar
+    library = get_library()
+    lib_checks = [ft.Checkbox(label=entry.label(), data=entry.id) for entry in library.entries()]
+
+    def on_use_library(e):
+        ids = [c.data for c in lib_checks if c.value]
+        if not ids:
+            toast(page, "Marque ao menos um ebook da biblioteca.")
+            return
+        sep = "\n\n" + ("-" * 80) + "\n"
+        STATE.ebook_text = sep.join(library.read_many(ids)).strip()
+        STATE.ebook_index = None
+        STATE.qa_session = None
+        STATE.step = 3
+        route_to_step(page)
+
+    library_section = ft.Column(
+        [ft.Text("Ou use ebooks da biblioteca:"), *lib_checks, ft.OutlinedButton("Usar selecionados", on_click=on_use_library)],
+        spacing=6,
+        visible=bool(lib_checks),
+    )
+
+    confirm_btn = ft.FilledButton("COnfirmar")
+    cancel_btn = ft.OutlinedButton("Cancelar")
+
+    def set_busy(busy: bool) -> None:
+        confirm_btn.disabled = busy
+        pick_btn.disabled = busy
+        library_section.disabled = busy
+
     def on_cancel(e):
+        if STATE.refine_job is not None:
+            # Aborta a leitura/refino em andamento (requisições HTTP canceladas)
+            STATE.refine_job.cancel()
+            status_lbl.value = "Cancelando..."
+            page.update()
+            return
         STATE.selected_file = None
         STATE.uploaded_file_name = None
         STATE.ebook_text = None
+        STATE.ebook_index = None
+        STATE.qa_session = None
         selected_lbl.value = "Nenhum arquivo selecionado."
         status_lbl.value = ""
         page.update()
 
-    def on_confirm(e):
-        try:
-            if STATE.selected_file is None:
-                toast(page, "Selecione um arquivo antes.")
-                return
-
-            sel = STATE.selected_file
-            if not sel.path:
-                toast(page, "Arquivo sem caminho local disponível. Execute em modo desktop.")
-                return
+    def on_refine_progress(done: int, total: int) -> None:
+        status_lbl.value = f"Gerando ebook a partir da transcrição... ({done}/{total} trecho(s))"
+        page.update()
 
-            # Leitura -> BytesIO para compatibilidade com seu util
-            with open(sel.path, "rb") as f:
-                data = f.read()
-            name = sel.name or Path(sel.path).name
-            raw_text = read_uploaded_text_or_pdf(io.BytesIO(data), name)
+    async def prepare_ebook(path: str, name: str, refine: bool):
+        # Extração (CPU) em thread; refino assíncrono: cancelar a task aborta as requisições
+        raw_text = await asyncio.to_thread(read_uploaded_text_or_pdf, path, name)
+        safe_base = (name or "ebook").rsplit(".", 1)[0]
+        if not refine:
+            library.add(raw_text, safe_base, source=path)
+            return raw_text, None
 
-            STATE.uploaded_file_name = name
-            selected_lbl.value = f"Arquivo carregado: {name}"
+        status_lbl.value = "Gerando ebook a partir da transcrição..."
+        page.update()
+        client = OpenAIClientFactory.build_async(STATE.api_key)
+        try:
+            out = await refine_transcript_segmented_async(
+                client, RefinerRequest(transcript_text=raw_text), on_progress=on_refine_progress
+            )
+        finally:
+            await client.close()
+        out_path = save_txt_only(out.ebook_text, f"{safe_base}_refinado")
+        library.add(out.ebook_text, safe_base, source=path, model=DEFAULT_REFINER_MODEL, refined=True)
+        return out.ebook_text, out_path
+
+    def on_prepared(job: BackgroundJob) -> None:
+        STATE.refine_job = None
+        set_busy(False)
+        if job.cancelled:
+            status_lbl.value = "Operação cancelada."
             page.update()
-
-            choice = material_radio.value
-            if choice == "pronto":
-                STATE.ebook_text = raw_text
-                STATE.step = 3
-                route_to_step(page)
-                return
-
-            # Refinamento
-            status_lbl.value = "Gerando ebook a partir da transcrição..."
+            return
+        try:
+            text, out_path = job.result()
+        except Exception as ex:
+            status_lbl.value = f"Falha: {ex}"
             page.update()
-
-            client = OpenAIClientFactory.build(STATE.api_key)
-            req = RefinerRequest(transcript_text=raw_text)
-            out = refine_transcript_to_ebook(client, req)
-
-            safe_base = (name or "ebook").rsplit(".", 1)[0]
-            out_path = save_txt_only(out.ebook_text, f"{safe_base}_refinado")
-            STATE.ebook_text = out.ebook_text
+            return
+        STATE.ebook_text = text
+        STATE.ebook_index = None
+        STATE.qa_session = None
+        if out_path is not None:
             status_lbl.value = f"Ebook gerado e salvo em: {out_path}"
             page.update()
+        STATE.step = 3
+        route_to_step(page)
 
-            STATE.step = 3
-            route_to_step(page)
+    def on_confirm(e):
+        if STATE.refine_job is not None:
+            toast(page, "Aguarde a operação em andamento (ou cancele).")
+            return
+        if STATE.selected_file is None:
+            toast(page, "Selecione um arquivo antes.")
             return
 
-        except Exception as ex:
-            status_lbl.value = f"Falha: {ex}"
-            page.update()
+        sel = STATE.selected_file
+        if not sel.path:
+            toast(page, "Arquivo sem caminho local disponível. Execute em modo desktop.")
+            return
+
+        # Leitura direto do caminho (streaming), sem carregar o arquivo inteiro em bytes
+        name = sel.name or Path(sel.path).name
+        STATE.uploaded_file_name = name
+        selected_lbl.value = f"Arquivo: {name}"
+        status_lbl.value = "Lendo o arquivo..."
+        set_busy(True)
+        page.update()
+
+        refine = material_radio.value != "pronto"
+        STATE.refine_job = REFINE_RUNNER.run_async(
+            lambda: prepare_ebook(sel.path, name, refine), on_done=on_prepared
+        )
+
+    confirm_btn.on_click = on_confirm
+    cancel_btn.on_click = on_cancel
 
     page.add(
         ft.Column(
@@ -198,15 +276,10 @@ def view_step2(page: ft.Page):
                 selected_lbl,
                 ft.Text("Como deseja prosseguir?"),
                 material_radio,
-                ft.Row(
-                    [
-                        ft.FilledButton("COnfirmar", on_click=on_confirm),
-                        ft.OutlinedButton("Cancelar", on_click=on_cancel),
-                    ],
-                    spacing=10,
-                ),
+                ft.Row([confirm_btn, cancel_btn], spacing=10),
                 ft.Divider(),
                 status_lbl,
+                library_section,
             ],
             horizontal_alignment=ft.CrossAxisAlignment.START,
             spacing=14,
@@ -233,6 +306,12 @@ def view_step3(page: ft.Page):
         )
         return
 
+    if STATE.ebook_index is None:
+        # Reaberto da biblioteca quando o mesmo conteúdo já foi indexado (BM25 ou embeddings: $EBOOKQA_RETRIEVER)
+        STATE.ebook_index = open_retriever(
+            get_library().index_dir(STATE.ebook_text), STATE.ebook_text, client=OpenAIClientFactory.build(STATE.api_key)
+        )
+
     question_field = ft.TextField(
         label="Digite sua pergunta",
         multiline=True,
@@ -250,6 +329,7 @@ def view_step3(page: ft.Page):
         width=820,
     )
     msg_lbl = ft.Text("")  # removido uso de ft.colors
+    usage_lbl = ft.Text(get_ledger().summary_text(), size=12)  # tokens/latência acumulados na sessão
 
     action_radio = ft.RadioGroup(
         value="new",
@@ -263,49 +343,115 @@ def view_step3(page: ft.Page):
         ),
     )
 
-    def do_answer(e):
-        q = (question_field.value or "").strip()
-        if not q:
-            toast(page, "Escreva uma pergunta.")
-            return
-        try:
-            msg_lbl.value = "Consultando o material..."
-            page.update()
+    queue_lbl = ft.Text("", size=12)
+    cancel_answer_btn = ft.OutlinedButton("Cancelar resposta", disabled=QA_RUNNER.pending() == 0)
 
-            client = OpenAIClientFactory.build(STATE.api_key)
-            req = QARequest(ebook_text=STATE.ebook_text, question=q)
-            out = answer_with_ebook(client, req)
+    def refresh_queue() -> None:
+        pending = QA_RUNNER.pending()
+        queue_lbl.value = f"{pending - 1} pergunta(s) na fila" if pending > 1 else ""
+        cancel_answer_btn.disabled = pending == 0
 
-            if getattr(out, "has_content", False):
-                ans = normalize_none_answer(out.answer) if out.answer else ""
-                STATE.last_answer = (ans or "").strip()
-                STATE.qa_status = "ok"
-            else:
-                STATE.last_answer = None
-                STATE.qa_status = "insufficient"
-        except Exception as ex:
+    async def answer_question(q: str):
+        # Roda no event loop da fila (uma pergunta por vez): a interface continua respondendo e
+        # cancelar aborta a requisição na hora, inclusive na espera pelo primeiro token
+        msg_lbl.value = "Consultando o material..."
+        page.update()
+
+        if STATE.qa_session is None:
+            STATE.qa_session = QASession(
+                OpenAIClientFactory.build(STATE.api_key), STATE.ebook_text, retriever=STATE.ebook_index,
+                semantic_cache=semantic_cache_for(STATE.ebook_text, DEFAULT_QA_MODEL),
+            )
+        result_title.value = f"Resposta — {q[:80]}"
+        result_markdown.value = ""
+        result_markdown.visible = True
+        parts = []
+        last_paint = 0.0
+
+        def on_delta(delta: str) -> None:
+            # Atualiza o Markdown conforme os tokens chegam (no máx. ~10 atualizações/s)
+            nonlocal last_paint
+            parts.append(delta)
+            now = time.monotonic()
+            if now - last_paint >= 0.1:
+                msg_lbl.value = ""
+                result_markdown.value = "".join(parts)
+                page.update()
+                last_paint = now
+
+        client = OpenAIClientFactory.build_async(STATE.api_key)
+        try:
+            return await STATE.qa_session.ask_async(client, q, on_delta=on_delta)
+        finally:
+            await client.close()
+
+    def on_answer_done(job: BackgroundJob) -> None:
+        from_cache = False
+        if job.cancelled:
             STATE.last_answer = None
-            STATE.qa_status = "error"
-            msg_lbl.value = f"Falha ao obter resposta: {ex}"
-            page.update()
-            return
+            STATE.qa_status = "cancelled"
+        else:
+            try:
+                out = job.result()
+                from_cache = out.cache_hit
+                if getattr(out, "has_content", False):
+                    ans = normalize_none_answer(out.answer) if out.answer else ""
+                    STATE.last_answer = (ans or "").strip()
+                    STATE.qa_status = "ok"
+                else:
+                    STATE.last_answer = None
+                    STATE.qa_status = "insufficient"
+            except Exception as ex:
+                STATE.last_answer = None
+                STATE.qa_status = "error"
+                msg_lbl.value = f"Falha ao obter resposta: {ex}"
+                refresh_queue()
+                page.update()
+                return
 
         if STATE.last_answer is None:
             if STATE.qa_status == "insufficient":
                 msg_lbl.value = "Não há informações suficientes no material fornecido."
             elif STATE.qa_status == "error":
                 msg_lbl.value = "Falha ao obter resposta. Tente novamente."
+            elif STATE.qa_status == "cancelled":
+                msg_lbl.value = "Resposta cancelada."
             else:
                 msg_lbl.value = ""
             result_title.value = ""
             result_markdown.visible = False
         else:
             msg_lbl.value = ""
-            result_title.value = "Resposta"
+            if from_cache:
+                result_title.value += " (do cache de perguntas)"
             result_markdown.value = STATE.last_answer
             result_markdown.visible = True
+        usage_lbl.value = get_ledger().summary_text()
+        if STATE.qa_session is not None:
+            usage_lbl.value += "\n" + STATE.qa_session.cache_summary()
+        refresh_queue()
         page.update()
 
+    def do_answer(e):
+        q = (question_field.value or "").strip()
+        if not q:
+            toast(page, "Escreva uma pergunta.")
+            return
+        # Perguntas feitas enquanto outra é respondida entram na fila
+        QA_RUNNER.run_async(lambda: answer_question(q), on_done=on_answer_done)
+        question_field.value = ""
+        refresh_queue()
+        page.update()
+
+    def on_cancel_answer(e):
+        for job in QA_RUNNER.jobs():
+            if job.running:
+                job.cancel()
+        msg_lbl.value = "Cancelando..."
+        page.update()
+
+    cancel_answer_btn.on_click = on_cancel_answer
+
     def on_confirm_action(e):
         opt = action_radio.value
         if opt == "new":
@@ -323,12 +469,18 @@ def view_step3(page: ft.Page):
             p = save_txt_only(STATE.last_answer, "resposta_ebook")
             toast(page, f"Arquivo salvo em: {p}")
         elif opt == "restart":
+            QA_RUNNER.cancel_all()
             STATE.last_answer = None
             STATE.qa_status = None
             STATE.ebook_text = None
+            STATE.ebook_index = None
+            STATE.qa_session = None
             STATE.step = 2
             route_to_step(page)
         elif opt == "exit":
+            QA_RUNNER.cancel_all()
+            if STATE.refine_job is not None:
+                STATE.refine_job.cancel()
             STATE.__init__()  # reset total
             STATE.step = 1
             route_to_step(page)
@@ -338,7 +490,7 @@ def view_step3(page: ft.Page):
             [
                 subtitle,
                 question_field,
-                ft.FilledButton("Responder", on_click=do_answer),
+                ft.Row([ft.FilledButton("Responder", on_click=do_answer), cancel_answer_btn, queue_lbl], spacing=10),
                 ft.Divider(),
                 msg_lbl,
                 ft.Text("", size=4),
@@ -348,6 +500,8 @@ def view_step3(page: ft.Page):
                 ft.Text("Ações"),
                 action_radio,
                 ft.ElevatedButton("Confirmar", on_click=on_confirm_action),
+                ft.Divider(),
+                usage_lbl,
             ],
             spacing=12,
         )
@@ -376,4 +530,5 @@ def main(page: ft.Page):
     route_to_step(page)
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # workers do extrator de PDF no executável congelado
     ft.app(target=main)
@@ -2,19 +2,41 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import annotations
+import argparse
+import multiprocessing
 import os
 import sys
-import time
-import random
 from pathlib import Path
-from typing import Optional, List
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from utils.startup import StartupProfiler, prewarm_imports
+
+# Com --profile-startup, mede cada import daqui em diante (como -X importtime, também no executável)
+STARTUP = StartupProfiler.from_argv(sys.argv)
 
 # ====== Imports do seu projeto ======
-from api.openai_client import OpenAIClientFactory
-from agents.refiner_agent import refine_transcript_to_ebook
-from agents.qa_agent import answer_with_ebook
-from models.refiner_models import RefinerRequest
-from models.qa_models import QARequest
+# No carregamento só entram módulos leves (biblioteca padrão); openai/httpx/pydantic/numpy
+# são importados no primeiro uso, para o primeiro prompt aparecer sem esperar por eles
+from utils.library import EbookLibrary, get_library, parse_selection
+from utils.io_utils import iter_text_chunks
+from utils.job_manifest import DONE, FAILED, FALLBACK, MANIFEST_NAME, PENDING, JobManifest, atomic_write_text
+from utils.text_utils import estimate_tokens
+from api.usage import get_ledger
+
+if TYPE_CHECKING:
+    from openai import OpenAI
+    from agents.ingest import IngestProgress
+    from agents.summary_tree import SummaryTree
+
+# Módulos do Q&A interativo: importados em segundo plano enquanto o usuário responde os primeiros prompts
+INTERACTIVE_MODULES = (
+    "api.openai_client",
+    "agents.qa_agent",
+    "agents.ingest",
+    "agents.summary_tree",
+    "utils.retrieval",
+    "utils.semantic_cache",
+)
 
 # Utils opcionais
 try:
@@ -52,40 +74,93 @@ def save_text_to_downloads(content: str, filename: str) -> Path:
     Salva 'content' como UTF-8 em ~/Downloads/filename (ou cwd, se não houver Downloads).
     """
     target_dir = get_downloads_dir()
-    p = (target_dir / filename).resolve()
-    p.write_text(content or "", encoding="utf-8")
-    return p
+    # Gravação atômica (temporário + rename): um arquivo parcial nunca parece completo
+    return atomic_write_text(target_dir / filename, content or "")
 
 # ---------- Leitura de TXT/PDF ----------
-def read_text_or_pdf(path: Path) -> str:
+def read_text_or_pdf(path: Path, digest: Optional[str] = None) -> str:
     """
     Lê .txt ou .pdf e retorna texto em UTF-8.
-    Para PDF usa pypdf (texto extraível).
+    Para PDF usa pypdf (texto extraível), com cache pelo SHA-256 do arquivo (`digest`, se já calculado).
     """
     suffix = path.suffix.lower()
     if suffix == ".txt":
-        return path.read_text(encoding="utf-8", errors="ignore")
+        return "".join(iter_text_chunks(path))
 
     if suffix == ".pdf":
         try:
-            from pypdf import PdfReader  # pip install pypdf
-        except Exception:
+            from utils.pdf_extract import extract_pdf_text_cached  # pip install pypdf
+            result = extract_pdf_text_cached(path, digest=digest)
+        except ImportError:
             print("[ERRO] Falta a dependência 'pypdf'. Instale com: pip install pypdf", file=sys.stderr)
             raise
-        reader = PdfReader(str(path))
-        parts = []
-        for pg in reader.pages:
-            try:
-                parts.append(pg.extract_text() or "")
-            except Exception:
-                parts.append("")
-        text = "\n".join(parts).strip()
+        if result.cached:
+            print(f"[INFO] {path.name}: texto reaproveitado do cache de extração.", file=sys.stderr)
+        if result.skipped:
+            print(f"[AVISO] {path.name}: páginas ignoradas: {result.skipped_summary()}", file=sys.stderr)
+        text = result.text
         if not text:
             print(f"[AVISO] Extração vazia em: {path.name}. PDF pode ser imagem/OCR.", file=sys.stderr)
         return text
 
     raise ValueError(f"Formato não suportado: {suffix}. Use .txt ou .pdf")
 
+def dedupe_files(paths: List[Path]) -> List[Tuple[Path, str]]:
+    """
+    Remove arquivos de conteúdo idêntico (mesmo SHA-256), mantendo a ordem da seleção.
+    Retorna pares (caminho, hash) para reaproveitar o hash no cache de extração.
+    """
+    from utils.pdf_extract import file_sha256
+
+    seen: Dict[str, Path] = {}
+    unique: List[Tuple[Path, str]] = []
+    for p in paths:
+        try:
+            digest = file_sha256(p)
+        except OSError as e:
+            print(f"[AVISO] Falha na leitura de {p.name}: {e}", file=sys.stderr)
+            continue
+        if digest in seen:
+            print(f"[INFO] {p.name} é idêntico a {seen[digest].name}; processado uma única vez.", file=sys.stderr)
+            continue
+        seen[digest] = p
+        unique.append((p, digest))
+    return unique
+
+_PROGRESS_WIDTH = 0
+
+def _print_status(line: str) -> None:
+    # Linha de progresso reescrita no lugar (stderr), apagada antes das mensagens normais
+    global _PROGRESS_WIDTH
+    _PROGRESS_WIDTH = max(_PROGRESS_WIDTH, len(line))
+    print("\r" + line.ljust(_PROGRESS_WIDTH), end="", file=sys.stderr, flush=True)
+
+def _print_progress(progress: IngestProgress) -> None:
+    _print_status(progress.format())
+
+def _clear_progress() -> None:
+    global _PROGRESS_WIDTH
+    if _PROGRESS_WIDTH:
+        print("\r" + " " * _PROGRESS_WIDTH + "\r", end="", file=sys.stderr, flush=True)
+        _PROGRESS_WIDTH = 0
+
+def _print_retry(error: BaseException, kind: str, attempt: int, delay: float) -> None:
+    from api.scheduler import RATE_LIMIT, get_scheduler
+
+    reason = "Limite de taxa da API" if kind == RATE_LIMIT else "Falha transitória"
+    _clear_progress()
+    print(
+        f"[AVISO] {reason} ({error}). Tentativa {attempt}/{get_scheduler().max_retries + 1}. "
+        f"Aguardando {delay:.1f}s para tentar novamente ...",
+        file=sys.stderr,
+    )
+
+def _announce_retries() -> None:
+    # Sem o aviso, um backoff longo (ex.: 429 com reset de minutos) parece um prompt travado
+    from api.scheduler import get_scheduler
+
+    get_scheduler().on_retry = _print_retry
+
 def clear_screen() -> None:
     try:
         os.system("cls" if os.name == "nt" else "clear")
@@ -121,46 +196,50 @@ def select_files_with_dialog() -> List[str]:
     root.destroy()
     return list(paths) if paths else []
 
-# ---------- Retry/backoff para chamadas do agente ----------
-def call_with_retry(fn, *args, max_retries: int = 5, base_delay: float = 1.5, jitter: float = 0.4, **kwargs):
+# ---------- Fluxo principal ----------
+def choose_from_library(library: EbookLibrary) -> List[Tuple[str, str]]:
     """
-    Executa 'fn(*args, **kwargs)' com backoff exponencial + jitter.
-    Trata erros transitórios (520/502/503/504/timeout).
+    Lista os ebooks da biblioteca e deixa escolher um subconjunto para o Q&A.
+    Retorna pares (título, texto) dos escolhidos ou lista vazia (processar novos arquivos).
     """
-    for attempt in range(1, max_retries + 1):
-        try:
-            return fn(*args, **kwargs)
-        except Exception as e:
-            msg = str(e).lower()
-            transient = any(code in msg for code in [" 520", " 502", " 503", " 504", "timeout", "connection reset", "temporarily unavailable"])
-            if not transient or attempt == max_retries:
-                raise
-            delay = (base_delay * (2 ** (attempt - 1))) * (1 + random.uniform(-jitter, jitter))
-            delay = max(0.6, delay)
-            print(f"[AVISO] Falha transitória ({e}). Tentativa {attempt}/{max_retries}. Aguardando {delay:.1f}s ...")
-            time.sleep(delay)
-
-# ---------- Fluxo principal ----------
-def main() -> None:
+    entries = library.entries()
+    if not entries:
+        return []
     clear_screen()
-    header("Ebook Q&A (Terminal) — 1 ebook por material, sem chunk e sem consolidate")
+    header("Biblioteca — ebooks já processados")
+    for n, entry in enumerate(entries, 1):
+        print(f"  {n}) {entry.label()}")
+    print("\nDigite os números (ex.: 1,3-4), 'todos', ou Enter para processar novos arquivos.")
+    while True:
+        raw = input("Seleção: ").strip()
+        if not raw:
+            return []
+        try:
+            picked = [entries[i] for i in parse_selection(raw, len(entries))]
+        except ValueError as e:
+            print(f"[AVISO] {e}")
+            continue
+        if picked:
+            break
+    texts = library.read_many([e.id for e in picked])
+    print(f"[OK] {len(texts)} ebook(s) carregado(s) da biblioteca.")
+    return [(e.title, text) for e, text in zip(picked, texts)]
 
-    # 1) API Key
-    api_key = os.environ.get("OPENAI_API_KEY", "").strip()
-    if not api_key:
-        api_key = input("Informe sua OpenAI API Key: ").strip()
-    if not api_key:
-        print("[ERRO] API Key não informada. Encerrando.")
-        sys.exit(1)
+def process_new_files(client: OpenAI, library: EbookLibrary) -> List[Tuple[str, str]]:
+    """
+    Seleciona, extrai e (opcionalmente) refina novos arquivos; cada ebook gerado é salvo em
+    Downloads e acrescentado à biblioteca. Retorna pares (título, texto) na ordem da seleção.
+    """
+    from agents.ingest import run_ingest_pipeline
+    from agents.refiner_agent import DEFAULT_REFINER_MODEL
 
-    # 2) Seleção de arquivos
     print("\nEtapa 1 – Selecione 1 ou mais arquivos base (.txt ou .pdf) no diálogo que será aberto.")
     files = select_files_with_dialog()
     if not files:
         print("[ERRO] Nenhum arquivo selecionado. Encerrando.")
         sys.exit(1)
 
-    # 3) Pergunta única: tratar/refinar ou não
+    # Pergunta única: tratar/refinar ou não
     clear_screen()
     header("Configuração do Material")
     print("Como deseja prosseguir para TODOS os arquivos selecionados?\n")
@@ -171,75 +250,223 @@ def main() -> None:
         print("[ERRO] Opção inválida.")
         sys.exit(1)
 
-    client = OpenAIClientFactory.build(api_key)
-
-    # 4) Processar cada material (um por arquivo). Um bloco por material.
+    # Processar cada material (um por arquivo). Um bloco por material.
     generated_outputs: List[Path] = []
-    all_ebooks_text: List[str] = []
-
-    for idx, f in enumerate(files, 1):
-        p = Path(f).expanduser().resolve()
-        print("\n" + "-" * 80)
-        print(f"[INFO] Processando material {idx}/{len(files)}: {p.name}")
-        print("-" * 80)
+    all_ebooks: List[Tuple[str, str]] = []
+
+    materials = dedupe_files([Path(f).expanduser().resolve() for f in files])
+    refine = choice == "1"
+    print(f"\n[INFO] Processando {len(materials)} material(is): extração em paralelo"
+          + (", refino concorrente" if refine else "") + "; resultados na ordem da seleção.")
+
+    # Manifesto da execução: materiais já concluídos (mesmo conteúdo e modo) não são refeitos
+    manifest = JobManifest(get_downloads_dir() / MANIFEST_NAME)
+    mode = "refine" if refine else "original"
+    resumed: Dict[int, Path] = {}
+    todo: List[Tuple[Path, str]] = []
+    for i, (p, digest) in enumerate(materials):
+        done_out = manifest.completed_output(digest, mode)
+        if done_out is not None:
+            resumed[i] = done_out
+        else:
+            manifest.mark(digest, mode, p, PENDING)
+            todo.append((p, digest))
+    if resumed:
+        print(f"[INFO] Retomando execução anterior: {len(resumed)} material(is) já concluído(s) serão reaproveitados.")
+
+    # Retentativas/limites de taxa do refino são tratados pelo agendador compartilhado (api.scheduler)
+    pipeline = run_ingest_pipeline(
+        todo, read_text_or_pdf, client=client, refine=refine, on_progress=_print_progress
+    ) if todo else iter(())
+    for i, (p, digest) in enumerate(materials):
+        if i in resumed:
+            text = resumed[i].read_text(encoding="utf-8", errors="ignore").strip()
+            print(f"[OK] Já concluído anteriormente: {resumed[i]}")
+            generated_outputs.append(resumed[i])
+            all_ebooks.append((p.stem, text))
+            library.add(
+                text, p.stem, source=p, source_sha256=digest,
+                model=DEFAULT_REFINER_MODEL if refine else None, refined=refine,
+            )
+            continue
 
-        try:
-            raw_text = read_text_or_pdf(p)
-            if not raw_text.strip():
-                print(f"[AVISO] Texto vazio em {p.name}; material ignorado.")
-                continue
-        except Exception as e:
-            print(f"[AVISO] Falha na leitura de {p.name}: {e}")
+        res = next(pipeline)
+        _clear_progress()
+        if res.error:
+            print(f"[AVISO] {res.error}")
+            manifest.mark(digest, mode, p, FAILED, outcome=res.error)
             continue
+        if res.warning:
+            print(f"[AVISO] {res.warning}")
 
-        if choice == "2":
+        if not refine:
             # Não tratar: salva como está na pasta Downloads
-            final_text = raw_text.strip()
-            out_name = f"{p.stem}_original.txt"
-            out_path = save_text_to_downloads(final_text, out_name)
-            generated_outputs.append(out_path)
-            all_ebooks_text.append(final_text)
+            out_path = save_text_to_downloads(res.text, f"{p.stem}_original.txt")
             print(f"[OK] Ebook (sem tratamento) salvo: {out_path}")
         else:
             # Tratar: UM bloco por material
-            def _do_refine():
-                req = RefinerRequest(transcript_text=raw_text)
-                return refine_transcript_to_ebook(client, req)
+            out_path = save_text_to_downloads(res.text, f"{p.stem}_refinado.txt")
+            print(f"[OK] Ebook refinado salvo: {out_path} ({res.seconds:.1f}s)")
+        # Refino que caiu no original fica como FALLBACK e é refeito na próxima execução
+        stage = FALLBACK if res.warning else DONE
+        manifest.mark(digest, mode, p, stage, output=out_path, outcome=res.warning or "ok")
+        generated_outputs.append(out_path)
+        all_ebooks.append((p.stem, res.text))
+        # Biblioteca: o material processado fica disponível para as próximas sessões
+        if not res.warning:
+            library.add(
+                res.text, p.stem, source=p, source_sha256=digest,
+                model=DEFAULT_REFINER_MODEL if refine else None, refined=refine,
+            )
+    _clear_progress()
+    return all_ebooks
+
+def build_summary_trees(client: OpenAI, library: EbookLibrary, ebooks: List[Tuple[str, str]]) -> Dict[int, SummaryTree]:
+    """
+    Árvores de resumos (trechos -> seções -> documento) dos ebooks a partir de `tree_min_tokens()`:
+    construídas uma única vez, com os resumos em paralelo, e guardadas na biblioteca ao lado do ebook.
+    """
+    from agents.summary_tree import open_or_build_summary_tree, tree_min_tokens
+
+    min_tokens = tree_min_tokens()
+    trees: Dict[int, SummaryTree] = {}
+    if min_tokens is None:
+        return trees
+    for i, (title, text) in enumerate(ebooks):
+        text = text.strip()
+        if estimate_tokens(text) < min_tokens:
+            continue
+        trees[i] = open_or_build_summary_tree(
+            library.index_dir(text),
+            client,
+            text,
+            on_progress=lambda done, total, title=title: _print_status(f"[INFO] Resumos de {title}: {done}/{total}"),
+        )
+        _clear_progress()
+        if trees[i].tokens_used:
+            print(f"[OK] Árvore de resumos de {title}: {len(trees[i].nodes)} nós em {trees[i].depth} níveis.")
+    return trees
+
+def ask_mapreduce(api_key: str, ebook_text: str, question: str, semantic_cache=None):
+    """
+    Pergunta em varredura completa (map-reduce): todas as fatias do material em paralelo, em um event loop
+    próprio com cliente assíncrono (fechado ao final). Ctrl+C cancela as requisições em andamento.
+    """
+    import asyncio
 
-            try:
-                out = call_with_retry(_do_refine, max_retries=5, base_delay=1.5)
-                final_text = (out.ebook_text or "").strip()
-                if not final_text:
-                    print(f"[AVISO] Agente não retornou texto para {p.name}; usando original.")
-                    final_text = raw_text.strip()
-            except Exception as e:
-                print(f"[AVISO] Falha no tratamento de {p.name} ({e}); usando original.")
-                final_text = raw_text.strip()
+    from api.openai_client import OpenAIClientFactory
+    from agents.qa_agent import answer_with_ebook_mapreduce_async
+    from models.qa_models import QARequest
+
+    def _progress(done: int, total: int, answered: int) -> None:
+        _print_status(f"[INFO] Varredura: {done}/{total} trecho(s), {answered} com resposta")
+
+    async def _run():
+        aclient = OpenAIClientFactory.build_async(api_key)
+        try:
+            return await answer_with_ebook_mapreduce_async(
+                aclient,
+                QARequest(ebook_text=ebook_text, question=question),
+                semantic_cache=semantic_cache,
+                on_progress=_progress,
+            )
+        finally:
+            await aclient.close()
+
+    try:
+        return asyncio.run(_run())
+    finally:
+        _clear_progress()
+
+def main(retriever: Optional[str] = None) -> None:
+    # openai/agentes carregam em segundo plano enquanto o usuário informa a chave e escolhe o material
+    prewarm = prewarm_imports(INTERACTIVE_MODULES)
+    clear_screen()
+    header("Ebook Q&A (Terminal) — 1 ebook por material, sem chunk e sem consolidate")
+    STARTUP.report("primeiro prompt")
+
+    # 1) API Key
+    api_key = os.environ.get("OPENAI_API_KEY", "").strip()
+    if not api_key:
+        api_key = input("Informe sua OpenAI API Key: ").strip()
+    if not api_key:
+        print("[ERRO] API Key não informada. Encerrando.")
+        sys.exit(1)
+
+    # 2) Biblioteca: ebooks já processados abrem na hora, sem reextrair nem refinar
+    library = get_library()
+    all_ebooks = choose_from_library(library)
+
+    prewarm.join()
+    from api.openai_client import OpenAIClientFactory
+    from agents.qa_agent import (
+        DEFAULT_QA_MODEL,
+        DOCUMENT_SEPARATOR,
+        QASession,
+        RoutedQASession,
+        session_prefix_limit,
+    )
+    from agents.summary_tree import SummaryTree, SummaryTreeSelector
+    from utils.semantic_cache import semantic_cache_for
+    from utils.vector_store import open_retriever
 
-            out_name = f"{p.stem}_refinado.txt"
-            out_path = save_text_to_downloads(final_text, out_name)
-            generated_outputs.append(out_path)
-            all_ebooks_text.append(final_text)
-            print(f"[OK] Ebook refinado salvo: {out_path}")
+    _announce_retries()
+    client = OpenAIClientFactory.build(api_key)
+    if not all_ebooks:
+        all_ebooks = process_new_files(client, library)
 
-    if not all_ebooks_text:
+    if not all_ebooks:
         print("\n[ERRO] Nenhum ebook disponível para Q&A. Encerrando.")
         sys.exit(1)
 
-    # 5) Q&A com TODOS os ebooks (concatenação simples)
+    texts = [text for _title, text in all_ebooks]
+    combined_ebooks = DOCUMENT_SEPARATOR.join(texts).strip()
+    # Material maior que o prefixo da sessão: árvores de resumos dos ebooks grandes
+    # (construídas uma única vez e guardadas; nas próximas sessões só reabre)
+    trees: Dict[int, SummaryTree] = {}
+    if estimate_tokens(combined_ebooks) > session_prefix_limit(hasattr(client, "responses")):
+        trees = build_summary_trees(client, library, all_ebooks)
+
+    def tree_of(i: int) -> SummaryTree:
+        # Ebooks sem árvore própria entram como árvore plana, com o resumo extrativo do perfil
+        title, text = all_ebooks[i]
+        return trees.get(i) or SummaryTree.flat(text.strip(), library.profile(text, title).summary)
+
+    def retriever_for(docs: List[int], text: str):
+        # Conjuntos que não cabem no prefixo: descida pela árvore de resumos se algum ebook tiver uma;
+        # senão, a busca escolhida (--retriever / $EBOOKQA_RETRIEVER)
+        if not any(i in trees for i in docs):
+            return open_retriever(library.index_dir(text), text, retriever, client)
+        return SummaryTreeSelector([tree_of(i) for i in docs])
+
+    # 3) Q&A: um ebook vai inteiro para a sessão; com vários, cada pergunta vai só aos mais relevantes
     clear_screen()
-    header("Perguntas e Respostas — usando TODOS os ebooks gerados")
-    sep = "\n\n" + ("-" * 80) + "\n"
-    combined_ebooks = sep.join(all_ebooks_text).strip()
+    # Perguntas equivalentes a outras já respondidas sobre este mesmo material voltam do cache
+    semantic_cache = semantic_cache_for(combined_ebooks, DEFAULT_QA_MODEL)
+    routed = len(all_ebooks) > 1
+    if routed:
+        header(f"Perguntas e Respostas — {len(all_ebooks)} ebooks, cada pergunta vai aos mais relevantes")
+        # Perfis (palavras-chave/resumo) gravados na ingestão; cada conjunto de ebooks roteado tem sua sessão
+        profiles = [library.profile(text, title) for title, text in all_ebooks]
+        qa_session = RoutedQASession(
+            client, texts, profiles, retriever_for=retriever_for, semantic_cache=semantic_cache
+        )
+    else:
+        header("Perguntas e Respostas — usando o ebook gerado")
+        # Índice construído uma única vez (e guardado na biblioteca); cada pergunta envia só os trechos relevantes
+        ebook_index = retriever_for([0], combined_ebooks)
+        # Sessão: o ebook vai uma única vez como prefixo; as perguntas seguintes reaproveitam o contexto
+        qa_session = QASession(client, combined_ebooks, retriever=ebook_index, semantic_cache=semantic_cache)
 
     last_answer: Optional[str] = None
 
     while True:
         print("\nOpções:")
-        print("  1) Fazer pergunta (usa todos os ebooks carregados)")
-        print("  2) Salvar última resposta em .txt (Downloads)")
-        print("  3) Sair")
-        opt = input("Selecione uma opção [1-3]: ").strip()
+        print("  1) Fazer pergunta" + (" (roteada aos ebooks mais relevantes)" if routed else ""))
+        print("  2) Fazer pergunta com varredura completa (todos os trechos em paralelo; materiais muito longos)")
+        print("  3) Salvar última resposta em .txt (Downloads)")
+        print("  4) Sair")
+        opt = input("Selecione uma opção [1-4]: ").strip()
 
         if opt == "1":
             q = input("\nDigite sua pergunta: ").strip()
@@ -247,16 +474,24 @@ def main() -> None:
                 print("[AVISO] Pergunta vazia; tente novamente.")
                 continue
             try:
-                req = QARequest(ebook_text=combined_ebooks, question=q)
-                out = answer_with_ebook(client, req)
+                stream = qa_session.ask_stream(q)
+                print("\n" + "-" * 80)
+                print("RESPOSTA")
+                print("-" * 80)
+                # Tokens impressos à medida que chegam
+                for delta in stream:
+                    print(delta, end="", flush=True)
+                print("\n" + "-" * 80)
+                out = stream.result
+                if routed and not out.cache_hit:
+                    print(f"[INFO] {qa_session.route_summary()}")
+                if out.cache_hit:
+                    print("[INFO] Resposta reaproveitada do cache de perguntas (sem chamada à API).")
+                elif out.cached_tokens is not None:
+                    print(f"[INFO] {qa_session.cache_summary()}")
                 if getattr(out, "has_content", False):
                     ans = normalize_none_answer(getattr(out, "answer", ""))
-                    last_answer = ans.strip()
-                    print("\n" + "-" * 80)
-                    print("RESPOSTA")
-                    print("-" * 80)
-                    print(last_answer or "[Sem conteúdo]")
-                    print("-" * 80)
+                    last_answer = (ans or "").strip()
                 else:
                     last_answer = None
                     print("\n[INFO] Não há informações suficientes nos ebooks fornecidos.")
@@ -265,6 +500,34 @@ def main() -> None:
                 print(f"\n[ERRO] Falha ao obter resposta: {e}")
 
         elif opt == "2":
+            q = input("\nDigite sua pergunta: ").strip()
+            if not q:
+                print("[AVISO] Pergunta vazia; tente novamente.")
+                continue
+            try:
+                out = ask_mapreduce(api_key, combined_ebooks, q, semantic_cache)
+                print("\n" + "-" * 80)
+                print("RESPOSTA")
+                print("-" * 80)
+                print(out.answer)
+                print("-" * 80)
+                if out.cache_hit:
+                    print("[INFO] Resposta reaproveitada do cache de respostas (sem chamada à API).")
+                elif out.tokens_used is not None:
+                    print(f"[INFO] Varredura: {out.tokens_used} token(s).")
+                if out.has_content:
+                    last_answer = (normalize_none_answer(out.answer) or "").strip()
+                else:
+                    last_answer = None
+                    print("\n[INFO] Não há informações suficientes nos ebooks fornecidos.")
+            except KeyboardInterrupt:
+                last_answer = None
+                print("\n[AVISO] Varredura cancelada.")
+            except Exception as e:
+                last_answer = None
+                print(f"\n[ERRO] Falha ao obter resposta: {e}")
+
+        elif opt == "3":
             if not last_answer:
                 print("[AVISO] Não há resposta para salvar.")
                 continue
@@ -275,15 +538,258 @@ def main() -> None:
             except Exception as e:
                 print(f"[ERRO] Falha ao salvar: {e}")
 
-        elif opt == "3":
+        elif opt == "4":
+            from utils.response_cache import get_response_cache
+
+            stats = get_response_cache().stats()
+            print(f"\n[INFO] Cache de respostas: {stats['hits']} hit(s), {stats['misses']} miss(es).")
+            print(f"[INFO] Uso da API: {get_ledger().summary_text()}")
             print("\nSessão encerrada.")
             break
 
         else:
             print("[AVISO] Opção inválida.")
 
+# ---------- Modo em lote (não interativo) ----------
+def _read_api_key(prompt: bool = True) -> str:
+    api_key = os.environ.get("OPENAI_API_KEY", "").strip()
+    if not api_key and not prompt:
+        print("[ERRO] Defina OPENAI_API_KEY (o stdin está sendo usado para as perguntas). Encerrando.", file=sys.stderr)
+        sys.exit(1)
+    if not api_key:
+        api_key = input("Informe sua OpenAI API Key: ").strip()
+    if not api_key:
+        print("[ERRO] API Key não informada. Encerrando.", file=sys.stderr)
+        sys.exit(1)
+    return api_key
+
+def batch_main(args: argparse.Namespace) -> None:
+    """
+    Responde um arquivo de perguntas contra os ebooks informados e grava um JSONL de respostas.
+    Os ebooks são lidos uma única vez; perguntas já presentes na saída são puladas (retomável).
+    """
+    from api.openai_client import OpenAIClientFactory
+    from agents.batch_qa import load_questions, run_batch_qa
+    from agents.ingest import run_ingest_pipeline
+    from agents.qa_agent import DEFAULT_QA_MODEL, DOCUMENT_SEPARATOR
+    from utils.semantic_cache import semantic_cache_for
+    from utils.vector_store import open_retriever
+
+    # Perguntas antes da chave: com `-q -`, o stdin traz as perguntas e não pode ser lido como a chave
+    try:
+        questions = load_questions(args.questions)
+    except OSError as e:
+        print(f"[ERRO] {e}", file=sys.stderr)
+        sys.exit(1)
+    api_key = _read_api_key(prompt=args.questions != "-")
+
+    texts: List[str] = []
+    if args.library:
+        library = get_library()
+        entries = library.entries()
+        try:
+            texts = library.read_many([entries[i].id for i in parse_selection(args.library, len(entries))])
+        except ValueError as e:
+            print(f"[ERRO] --library: {e}", file=sys.stderr)
+            sys.exit(1)
+    materials = dedupe_files([Path(f).expanduser().resolve() for f in args.ebooks])
+    for res in run_ingest_pipeline(materials, read_text_or_pdf) if materials else ():
+        if res.error:
+            print(f"[AVISO] {res.error}", file=sys.stderr)
+        else:
+            texts.append(res.text)
+    if not texts:
+        print("[ERRO] Nenhum ebook disponível para Q&A. Encerrando.", file=sys.stderr)
+        sys.exit(1)
+
+    combined_ebooks = DOCUMENT_SEPARATOR.join(texts).strip()
+    _announce_retries()
+    client = OpenAIClientFactory.build(api_key)
+    ebook_index = open_retriever(get_library().index_dir(combined_ebooks), combined_ebooks, args.retriever, client)
+
+    def _progress(rec: dict) -> None:
+        status = "ERRO" if rec.get("error") else ("OK" if rec.get("has_content") else "SEM BASE")
+        if rec.get("cache_hit"):
+            status += " (cache)"
+        print(f"[{status}] {rec['latency_s']:.1f}s  {rec['question'][:70]}", file=sys.stderr)
+
+    summary = run_batch_qa(
+        client,
+        combined_ebooks,
+        questions,
+        args.out,
+        workers=args.workers,
+        rpm=args.rpm,
+        tpm=args.tpm,
+        retriever=ebook_index,
+        on_result=_progress,
+        semantic_cache=semantic_cache_for(combined_ebooks, DEFAULT_QA_MODEL),
+    )
+    print(
+        f"[OK] {summary['answered']} respondida(s), {summary['failed']} falha(s), "
+        f"{summary['skipped']} já presente(s) em {args.out}.",
+        file=sys.stderr,
+    )
+    print(f"[INFO] Uso da API: {get_ledger().summary_text()}", file=sys.stderr)
+
+
+def refine_batch_main(args: argparse.Namespace) -> None:
+    """
+    Refino offline pela Batch API: gera o JSONL de requisições a partir de uma pasta de
+    transcrições, envia, acompanha e grava `<stem>_refinado.txt` por material (nomes-base repetidos
+    ganham a extensão: `aula_pdf_refinado.txt`).
+    Com --no-wait, encerra após o envio; depois use --resume <plano> para coletar.
+    """
+    from api.openai_client import OpenAIClientFactory
+    from agents.batch_refine import (
+        BatchPlan,
+        OpenAIBatchTransport,
+        build_refine_batch,
+        collect_batch_results,
+        find_transcripts,
+        output_name,
+        poll_batch,
+        submit_batch,
+    )
+    from agents.refiner_agent import DEFAULT_REFINER_MODEL
+
+    if args.resume:
+        plan = BatchPlan.load(args.resume)
+    else:
+        if not args.folder:
+            print("[ERRO] Informe a pasta de transcrições (ou --resume <plano>).", file=sys.stderr)
+            sys.exit(1)
+        inputs = find_transcripts(args.folder)
+        if not inputs:
+            print("[ERRO] Nenhum .txt/.pdf na pasta informada.", file=sys.stderr)
+            sys.exit(1)
+        jsonl = Path(args.jsonl) if args.jsonl else get_downloads_dir() / "refine_batch.jsonl"
+        plan = build_refine_batch(inputs, jsonl)
+        n_requests = len(plan.cache_keys)
+        print(f"[OK] {n_requests} requisição(ões) de {len(plan.materials)} material(is) em: {plan.jsonl_path}", file=sys.stderr)
+        if args.no_submit:
+            print(f"[INFO] Plano salvo em: {plan.plan_path} (não enviado).", file=sys.stderr)
+            return
+
+    transport = OpenAIBatchTransport(OpenAIClientFactory.build(_read_api_key()))
+    if not plan.batch_id:
+        submit_batch(transport, plan)
+        print(f"[OK] Lote enviado: {plan.batch_id} (plano: {plan.plan_path})", file=sys.stderr)
+    if args.no_wait:
+        print(f"[INFO] Para coletar depois: main_cli.py refine-batch --resume {plan.plan_path}", file=sys.stderr)
+        return
+
+    def _status(st: dict) -> None:
+        counts = st.get("request_counts") or {}
+        print(
+            f"[INFO] Lote {plan.batch_id}: {st.get('status')} "
+            f"({counts.get('completed', 0)}/{counts.get('total', '?')} concluídas, {counts.get('failed', 0)} falhas)",
+            file=sys.stderr,
+        )
+
+    status = poll_batch(transport, plan.batch_id, interval_s=args.poll, on_status=_status)
+    out_dir = Path(args.out_dir) if args.out_dir else get_downloads_dir()
+    written, failed = collect_batch_results(transport, plan, status, out_dir)
+    library = get_library()
+    for digest, info in plan.materials.items():
+        out_path = out_dir.expanduser().resolve() / output_name(info)
+        if out_path in written:
+            library.add(
+                out_path.read_text(encoding="utf-8"), info["stem"], source=info["source"], source_sha256=digest,
+                model=DEFAULT_REFINER_MODEL, refined=True,
+            )
+    for p in written:
+        print(f"[OK] Ebook refinado salvo: {p}")
+    for source, reason in failed.items():
+        print(f"[AVISO] {Path(source).name}: {reason}", file=sys.stderr)
+
+def library_main(args: argparse.Namespace) -> None:
+    """
+    Lista os ebooks da biblioteca local; --remove/--compact fazem a manutenção do segmento.
+    """
+    library = get_library()
+    if args.remove:
+        entries = library.entries()
+        try:
+            picked = [entries[i] for i in parse_selection(args.remove, len(entries))]
+        except ValueError as e:
+            print(f"[ERRO] --remove: {e}", file=sys.stderr)
+            sys.exit(1)
+        for entry in picked:
+            library.remove(entry.id)
+            print(f"[OK] Removido da biblioteca: {entry.title}")
+    if args.compact:
+        freed = library.compact()
+        print(f"[OK] Biblioteca compactada: {freed / 1024:.0f} KB liberados.")
+    entries = library.entries()
+    if not entries:
+        print(f"[INFO] Biblioteca vazia ({library.dir}).")
+        return
+    print(f"Biblioteca: {library.dir}")
+    for n, entry in enumerate(entries, 1):
+        print(f"  {n}) {entry.label()}  [{entry.id}]")
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Ebook Q&A (Terminal). Sem argumentos: modo interativo.")
+    parser.add_argument(
+        "--usage-out",
+        default=None,
+        help="Ao encerrar, exporta o registro de uso da API (tokens/latência) em .json ou .csv.",
+    )
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="Mede a inicialização: tempo até o primeiro prompt e os imports mais caros (como -X importtime).",
+    )
+    parser.add_argument(
+        "--retriever",
+        choices=("bm25", "dense", "dense-int8"),
+        default=None,
+        help="Busca de trechos quando o material não cabe inteiro: bm25 (padrão, local) ou embeddings "
+        "(dense; dense-int8 ocupa 4x menos disco). Padrão: $EBOOKQA_RETRIEVER.",
+    )
+    sub = parser.add_subparsers(dest="command")
+
+    batch = sub.add_parser("batch", help="Responde um arquivo de perguntas e grava um JSONL de respostas.")
+    batch.add_argument("ebooks", nargs="*", help="Arquivos .txt/.pdf usados como base (já tratados).")
+    batch.add_argument("--library", default=None, help="Ebooks da biblioteca (ex.: 1,3-4 ou 'todos'; ver o comando library).")
+    batch.add_argument("-q", "--questions", required=True, help="Arquivo de perguntas (.txt/.jsonl) ou '-' para stdin.")
+    batch.add_argument("-o", "--out", default="respostas.jsonl", help="JSONL de saída (retomável).")
+    batch.add_argument("-w", "--workers", type=int, default=4, help="Perguntas simultâneas.")
+    batch.add_argument("--rpm", type=float, default=None, help="Limite de requisições por minuto.")
+    batch.add_argument("--tpm", type=float, default=None, help="Limite de tokens por minuto.")
+
+    rb = sub.add_parser("refine-batch", help="Refina uma pasta de transcrições pela Batch API (offline, mais barato).")
+    rb.add_argument("folder", nargs="?", help="Pasta com as transcrições .txt/.pdf.")
+    rb.add_argument("--jsonl", default=None, help="JSONL de requisições a gerar (padrão: Downloads/refine_batch.jsonl).")
+    rb.add_argument("-o", "--out-dir", default=None, help="Pasta dos <stem>_refinado.txt (padrão: Downloads).")
+    rb.add_argument("--no-submit", action="store_true", help="Apenas gera o JSONL e o plano.")
+    rb.add_argument("--no-wait", action="store_true", help="Envia e encerra sem aguardar o resultado.")
+    rb.add_argument("--resume", default=None, help="Plano (.plan.json) de um lote já gerado/enviado.")
+    rb.add_argument("--poll", type=float, default=60.0, help="Intervalo entre consultas ao lote (s).")
+
+    lib = sub.add_parser("library", help="Lista/mantém a biblioteca de ebooks já processados.")
+    lib.add_argument("--remove", default=None, help="Remove ebooks (ex.: 2 ou 1,3-4).")
+    lib.add_argument("--compact", action="store_true", help="Reescreve o segmento sem os ebooks removidos.")
+    return parser
+
+
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # workers do extrator de PDF no executável congelado
+    cli_args = build_arg_parser().parse_args()
     try:
-        main()
+        if cli_args.command == "batch":
+            batch_main(cli_args)
+        elif cli_args.command == "refine-batch":
+            refine_batch_main(cli_args)
+        elif cli_args.command == "library":
+            library_main(cli_args)
+        else:
+            main(cli_args.retriever)
     except KeyboardInterrupt:
         print("\nEncerrado pelo usuário.")
+    finally:
+        # Com --profile-startup: imports adiados para o primeiro uso (fora do caminho até o primeiro prompt)
+        STARTUP.report("encerramento (imports sob demanda)")
+        if cli_args.usage_out:
+            print(f"[OK] Registro de uso exportado: {get_ledger().export(cli_args.usage_out)}")
@@ -15,3 +15,5 @@ class QAOutput(BaseModel):
     answer: str = Field(..., description="Resposta textual.")
     has_content: bool = Field(..., description="True se a resposta foi baseada no ebook.")
     tokens_used: Optional[int] = None
+    cached_tokens: Optional[int] = Field(None, description="Tokens de entrada servidos do cache do provedor.")
+    cache_hit: bool = Field(False, description="True se a resposta veio do cache local (sem chamada à API).")
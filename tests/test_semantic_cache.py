@@ -0,0 +1,44 @@
+from __future__ import annotations
+import pytest
+
+from utils.disk_cache import DiskCache
+from utils.semantic_cache import SemanticAnswerCache, normalize_question
+
+EBOOK = "Material de teste sobre capítulos, fotossíntese e capitalismo."
+
+
+@pytest.fixture
+def cache(tmp_path) -> SemanticAnswerCache:
+    return SemanticAnswerCache(EBOOK, "modelo", store=DiskCache(tmp_path / "answers.sqlite"))
+
+
+def test_numeros_fazem_parte_da_pergunta():
+    assert normalize_question("Resuma o capítulo 3") == "resuma capitulo 3"
+    assert normalize_question("Resuma o capítulo 3") != normalize_question("Resuma o capítulo 4")
+
+
+def test_capitulo_3_nao_responde_capitulo_4(cache):
+    cache.add("Resuma o capítulo 3", "resposta 3")
+    assert cache.lookup("Resuma o capítulo 4") is None
+    assert cache.lookup("resuma o capitulo 3?").payload == "resposta 3"
+
+
+@pytest.mark.parametrize(
+    "stored, asked",
+    [
+        ("Quais as vantagens do capitalismo?", "Quais as desvantagens do capitalismo?"),
+        ("O que acontece na fase clara da fotossíntese?", "O que acontece na fase escura da fotossíntese?"),
+        ("Explique a relatividade restrita", "Explique a relatividade geral"),
+        ("Quando a fotossíntese produz oxigênio?", "Onde a fotossíntese produz oxigênio?"),
+        ("A fotossíntese produz oxigênio?", "A fotossíntese não produz oxigênio?"),
+    ],
+)
+def test_perguntas_diferentes_nao_reaproveitam_resposta(cache, stored, asked):
+    cache.add(stored, "resposta")
+    assert cache.lookup(asked) is None
+
+
+def test_variacoes_sem_conteudo_reaproveitam(cache):
+    cache.add("Quais as vantagens do capitalismo?", "resposta")
+    hit = cache.lookup("quais são as VANTAGENS do capitalismo")
+    assert hit is not None and hit.payload == "resposta"
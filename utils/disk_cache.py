@@ -0,0 +1,117 @@
+from __future__ import annotations
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+
+def default_cache_dir() -> Path:
+    """
+    Pasta dos caches persistentes: $EBOOKQA_CACHE_DIR ou ~/.ebookqa/cache.
+    """
+    base = os.environ.get("EBOOKQA_CACHE_DIR", "").strip()
+    d = Path(base).expanduser() if base else Path.home() / ".ebookqa" / "cache"
+    d.mkdir(parents=True, exist_ok=True)
+    return d
+
+
+class DiskCache:
+    """
+    Cache chave -> bytes em SQLite, seguro entre threads e processos.
+    - TTL: entradas mais velhas que `ttl_seconds` são tratadas como ausentes.
+    - Evicção LRU por tamanho total (`max_bytes`) e/ou número de entradas (`max_entries`).
+    - Contadores de hits/misses por instância.
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        max_bytes: int = 256 * 1024 * 1024,
+        max_entries: Optional[int] = None,
+        ttl_seconds: Optional[float] = 30 * 24 * 3600,
+    ) -> None:
+        self.path = Path(path).expanduser().resolve()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL,"
+            " created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_accessed ON entries(accessed)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[bytes]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl_seconds is not None and now - row[1] > self.ttl_seconds:
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return bytes(row[0])
+
+    def set(self, key: str, value: bytes) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries(key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, sqlite3.Binary(value), len(value), now, now),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM entries")
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        # Remove expirados e, depois, os menos usados recentemente até caber nos limites
+        if self.ttl_seconds is not None:
+            self._conn.execute("DELETE FROM entries WHERE created < ?", (time.time() - self.ttl_seconds,))
+        count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        if total <= self.max_bytes and (self.max_entries is None or count <= self.max_entries):
+            return
+        for key, size in self._conn.execute("SELECT key, size FROM entries ORDER BY accessed ASC").fetchall():
+            if total <= self.max_bytes and (self.max_entries is None or count <= self.max_entries):
+                break
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+            count -= 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "entries": count,
+            "bytes": total,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,191 @@
+from __future__ import annotations
+import hashlib
+import json
+import math
+from collections import Counter
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, List, Sequence, Tuple
+
+from utils.job_manifest import atomic_write_text
+from utils.text_utils import estimate_tokens, split_sentences, tokenize
+
+DEFAULT_ROUTE_DOCS = 2  # documentos da primeira tentativa
+DEFAULT_ROUTE_STEP = 2  # documentos acrescentados a cada nova tentativa (resposta insuficiente)
+DEFAULT_MIN_RATIO = 0.25  # documentos com score abaixo desta fração do melhor só entram nas tentativas seguintes
+
+SUMMARY_TOKENS = 160
+KEYWORDS = 30
+TITLE_BOOST = 5  # termos do título contam como 5 ocorrências (perguntas que citam o material pelo nome)
+
+_PROFILE_FILE = "profile.json"
+_PROFILE_VERSION = 1
+
+
+@dataclass
+class DocumentProfile:
+    """
+    Perfil leve de um ebook, calculado uma vez na ingestão: frequência dos termos (para o roteamento),
+    palavras-chave e um resumo extrativo (sentenças mais representativas, na ordem do texto).
+    """
+
+    title: str
+    text_sha256: str
+    tokens: int  # estimativa de tokens do texto completo
+    length: int  # número de termos (normalização por tamanho do BM25)
+    terms: Dict[str, int] = field(default_factory=dict)
+    keywords: List[str] = field(default_factory=list)
+    summary: str = ""
+
+    @classmethod
+    def build(cls, text: str, title: str, summary_tokens: int = SUMMARY_TOKENS) -> "DocumentProfile":
+        text = text.strip()
+        sentences = [(start, s, tokenize(s)) for start, s in split_sentences(text)]
+        tf: Counter = Counter()
+        for _start, _s, terms in sentences:
+            tf.update(terms)
+        keywords = [t for t, _n in tf.most_common(KEYWORDS * 2) if len(t) > 2][:KEYWORDS]
+        return cls(
+            title=title,
+            text_sha256=hashlib.sha256(text.encode("utf-8")).hexdigest(),
+            tokens=estimate_tokens(text),
+            length=sum(tf.values()),
+            terms=dict(tf),
+            keywords=keywords,
+            summary=_extractive_summary(sentences, tf, summary_tokens),
+        )
+
+    def describe(self) -> str:
+        return f"{self.title}: {', '.join(self.keywords[:8])}"
+
+
+def _extractive_summary(
+    sentences: Sequence[Tuple[int, str, List[str]]], tf: Counter, budget_tokens: int
+) -> str:
+    """
+    Primeira sentença + sentenças com maior peso médio de termos frequentes, até o orçamento de tokens.
+    """
+    if not sentences:
+        return ""
+    scored = []
+    for pos, (_start, s, terms) in enumerate(sentences):
+        if len(terms) < 4:
+            continue
+        weight = sum(math.log1p(tf[t]) for t in set(terms)) / math.sqrt(len(terms))
+        scored.append((weight, pos))
+    picked = {0}
+    used = estimate_tokens(sentences[0][1])
+    for _weight, pos in sorted(scored, reverse=True):
+        t = estimate_tokens(sentences[pos][1])
+        if used + t > budget_tokens:
+            continue
+        picked.add(pos)
+        used += t
+    return " ".join(sentences[pos][1].strip() for pos in sorted(picked))
+
+
+def save_profile(directory: str | Path, profile: DocumentProfile) -> Path:
+    d = Path(directory).expanduser().resolve()
+    d.mkdir(parents=True, exist_ok=True)
+    payload = dict(asdict(profile), version=_PROFILE_VERSION)
+    return atomic_write_text(d / _PROFILE_FILE, json.dumps(payload, ensure_ascii=False))
+
+
+def load_profile(directory: str | Path) -> DocumentProfile:
+    data = json.loads((Path(directory).expanduser().resolve() / _PROFILE_FILE).read_text(encoding="utf-8"))
+    if data.pop("version", None) != _PROFILE_VERSION:
+        raise ValueError("Perfil de documento em versão antiga.")
+    return DocumentProfile(**data)
+
+
+def open_or_build_profile(directory: str | Path, text: str, title: str) -> DocumentProfile:
+    """
+    Reabre o perfil salvo em `directory` se corresponder ao mesmo texto; caso contrário,
+    calcula, salva e retorna um novo (ver `open_or_build_bm25_index`).
+    """
+    digest = hashlib.sha256(text.strip().encode("utf-8")).hexdigest()
+    try:
+        profile = load_profile(directory)
+        if profile.text_sha256 == digest:
+            profile.title = title  # título pode ter mudado (mesmo texto)
+            return profile
+    except (OSError, ValueError, TypeError):
+        pass
+    profile = DocumentProfile.build(text, title)
+    save_profile(directory, profile)
+    return profile
+
+
+class DocumentRouter:
+    """
+    Escolhe, para cada pergunta, os documentos que provavelmente contêm a resposta:
+    BM25 com cada documento como unidade (frequências do perfil + título), sem abrir os textos.
+    `tiers()` devolve as tentativas em ordem crescente de material: os melhores documentos
+    primeiro e, se a resposta vier insuficiente, conjuntos maiores até todos.
+    """
+
+    def __init__(self, profiles: Sequence[DocumentProfile], k1: float = 1.2, b: float = 0.75) -> None:
+        self.profiles = list(profiles)
+        self.k1 = k1
+        self.b = b
+        self._terms: List[Counter] = []
+        for p in self.profiles:
+            terms = Counter(p.terms)
+            for t in set(tokenize(p.title)):
+                terms[t] += TITLE_BOOST
+            self._terms.append(terms)
+        self._lengths = [max(1, sum(t.values())) for t in self._terms]
+        n = len(self.profiles)
+        self._avgdl = (sum(self._lengths) / n) if n else 1.0
+        df: Counter = Counter()
+        for terms in self._terms:
+            df.update(terms.keys())
+        self._idf = {t: math.log(1 + (n - d + 0.5) / (d + 0.5)) for t, d in df.items()}
+
+    def __len__(self) -> int:
+        return len(self.profiles)
+
+    def scores(self, question: str) -> List[float]:
+        query = set(tokenize(question))
+        out = []
+        for terms, dl in zip(self._terms, self._lengths):
+            norm = self.k1 * (1 - self.b + self.b * dl / self._avgdl)
+            score = 0.0
+            for term in query:
+                tf = terms.get(term)
+                if tf:
+                    score += self._idf[term] * tf * (self.k1 + 1) / (tf + norm)
+            out.append(score)
+        return out
+
+    def rank(self, question: str) -> List[Tuple[int, float]]:
+        """
+        (índice do documento, score) de todos os documentos, do mais ao menos relevante
+        (empate: ordem de seleção).
+        """
+        return sorted(enumerate(self.scores(question)), key=lambda kv: (-kv[1], kv[0]))
+
+    def tiers(
+        self,
+        question: str,
+        first: int = DEFAULT_ROUTE_DOCS,
+        step: int = DEFAULT_ROUTE_STEP,
+        min_ratio: float = DEFAULT_MIN_RATIO,
+    ) -> List[List[int]]:
+        """
+        Conjuntos de documentos a tentar, cada um contendo o anterior; o último tem todos.
+        A primeira tentativa leva até `first` documentos com score >= `min_ratio` x melhor score
+        (pergunta sem termos conhecidos: os `first` primeiros da seleção).
+        """
+        ranked = self.rank(question)
+        if not ranked:
+            return []
+        best = ranked[0][1]
+        strong = [i for i, s in ranked if best > 0 and s >= min_ratio * best][:max(1, first)]
+        order = strong + [i for i, _s in ranked if i not in strong]
+        tiers = [sorted(order[:len(strong) or max(1, first)])]
+        size = len(tiers[0])
+        while size < len(order):
+            size = min(len(order), size + max(1, step))
+            tiers.append(sorted(order[:size]))
+        return tiers
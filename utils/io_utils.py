@@ -1,6 +1,19 @@
 from __future__ import annotations
+import codecs
+import sys
+from contextlib import contextmanager
 from pathlib import Path
-from typing import BinaryIO, Optional
+from typing import BinaryIO, Iterator, Optional, Union
+
+# Caminho ou arquivo binário aberto (ex.: UploadedFile do Streamlit); nunca exige os bytes inteiros
+Source = Union[str, Path, BinaryIO]
+
+TEXT_CHUNK_SIZE = 256 * 1024
+_BOMS = (
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
 
 def read_txt(path: str) -> str:
     p = Path(path).expanduser().resolve()
@@ -15,39 +28,103 @@ def save_txt(content: str, path: str) -> Path:
     p.write_text(content, encoding="utf-8")
     return p
 
+def _source_name(source: Source, filename: Optional[str]) -> str:
+    if filename:
+        return filename.lower()
+    if isinstance(source, (str, Path)):
+        return str(source).lower()
+    return str(getattr(source, "name", "") or "").lower()
+
+@contextmanager
+def _open_binary(source: Source) -> Iterator[BinaryIO]:
+    if isinstance(source, (str, Path)):
+        with open(Path(source).expanduser(), "rb") as fh:
+            yield fh
+        return
+    if hasattr(source, "seek"):
+        source.seek(0)
+    yield source
+
+# -------- TXT: decodificação incremental --------
+def detect_encoding(head: bytes) -> str:
+    """
+    Detecta a codificação pelo início do arquivo: BOM (UTF-8/UTF-16), UTF-8 válido
+    ou, como último recurso, latin-1.
+    """
+    for bom, encoding in _BOMS:
+        if head.startswith(bom):
+            return encoding
+    try:
+        # final=False tolera um caractere multibyte cortado no fim do bloco lido
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "latin-1"
+
+def iter_text_chunks(source: Source, encoding: Optional[str] = None, chunk_size: int = TEXT_CHUNK_SIZE) -> Iterator[str]:
+    """
+    Decodifica um arquivo de texto em blocos de `chunk_size` bytes, sem ler o arquivo inteiro.
+    A codificação é detectada pelo primeiro bloco quando não informada. Detectado UTF-8, um byte inválido
+    em qualquer ponto do arquivo faz o restante ser lido como latin-1 (o que já saiu era UTF-8 válido;
+    no caso comum, um início só em ASCII, o resultado é o mesmo de ler tudo em latin-1).
+    """
+    with _open_binary(source) as fh:
+        block = fh.read(chunk_size)
+        detected = encoding or detect_encoding(block)
+        strict = encoding is None and detected == "utf-8"
+        decoder = codecs.getincrementaldecoder(detected)(errors="strict" if strict else "replace")
+        while block:
+            try:
+                text = decoder.decode(block)
+            except UnicodeDecodeError as e:
+                # e.object: bytes pendentes do bloco anterior + bloco atual
+                text = e.object[:e.start].decode("utf-8") + e.object[e.start:].decode("latin-1")
+                decoder = codecs.getincrementaldecoder("latin-1")()
+            if text:
+                yield text
+            block = fh.read(chunk_size)
+        try:
+            tail = decoder.decode(b"", final=True)
+        except UnicodeDecodeError as e:
+            tail = e.object[:e.start].decode("utf-8") + e.object[e.start:].decode("latin-1")
+        if tail:
+            yield tail
+
 # -------- PDF helpers (sem dependência pesada) --------
-def extract_text_from_pdf_bytes(pdf_bytes: bytes) -> str:
+def extract_text_from_pdf(source: Union[bytes, Source]) -> str:
     """
-    Extrai texto de um PDF a partir dos bytes.
+    Extrai texto de um PDF (bytes, caminho ou arquivo aberto), páginas em paralelo e com timeout por página.
+    O resultado fica em cache pelo SHA-256 do arquivo: reenviar o mesmo PDF não o reprocessa.
+    Páginas puladas são informadas no stderr.
     Requer: pip install pypdf
     """
-    from pypdf import PdfReader  # leve e suficiente para a maioria dos PDFs baseados em texto
-    import io
+    from utils.pdf_extract import extract_pdf_text_cached
+
+    result = extract_pdf_text_cached(source)
+    if result.skipped:
+        print(f"[AVISO] Páginas do PDF ignoradas: {result.skipped_summary()}", file=sys.stderr)
+    return result.text
 
-    reader = PdfReader(io.BytesIO(pdf_bytes))
-    parts = []
-    for page in reader.pages:
-        text = page.extract_text() or ""
-        parts.append(text)
-    return "\n".join(parts).strip()
+def extract_text_from_pdf_bytes(pdf_bytes: bytes) -> str:
+    """
+    Extrai texto de um PDF a partir dos bytes (ver `extract_text_from_pdf`).
+    """
+    return extract_text_from_pdf(pdf_bytes)
 
-def read_uploaded_text_or_pdf(uploaded_file: BinaryIO, filename: Optional[str]) -> str:
+def read_uploaded_text_or_pdf(uploaded_file: Source, filename: Optional[str]) -> str:
     """
-    Lê conteúdo de um arquivo enviado no Streamlit (TXT ou PDF).
-    - TXT: tenta utf-8 e fallback latin-1.
+    Lê conteúdo de um arquivo (TXT ou PDF) a partir do caminho ou do arquivo aberto
+    (ex.: UploadedFile do Streamlit), sem copiar os bytes inteiros para a memória.
+    - TXT: decodificação incremental, com detecção de codificação (BOM, utf-8, fallback latin-1).
     - PDF: extrai com pypdf.
     """
-    name = (filename or "").lower()
-    data = uploaded_file.getvalue()  # bytes
+    name = _source_name(uploaded_file, filename)
 
     if name.endswith(".txt"):
-        try:
-            return data.decode("utf-8")
-        except UnicodeDecodeError:
-            return data.decode("latin-1", errors="ignore")
+        return "".join(iter_text_chunks(uploaded_file))
 
     if name.endswith(".pdf"):
-        text = extract_text_from_pdf_bytes(data)
+        text = extract_text_from_pdf(uploaded_file)
         if not text:
             raise ValueError("Não foi possível extrair texto do PDF (pode ser um PDF somente-imagem).")
         return text
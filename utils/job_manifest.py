@@ -0,0 +1,130 @@
+from __future__ import annotations
+import json
+import os
+import stat
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+MANIFEST_NAME = "ebookqa_job.json"
+
+# Estágios de cada material no manifesto
+PENDING = "pending"  # selecionado, ainda não concluído
+DONE = "done"  # saída gravada com o resultado esperado
+FALLBACK = "fallback"  # refino falhou e o original foi salvo: refeito na próxima execução
+FAILED = "failed"  # leitura/extração falhou
+
+
+_UMASK: Optional[int] = None
+_UMASK_LOCK = threading.Lock()
+
+
+def _umask() -> int:
+    """
+    Umask do processo. Lida de /proc quando possível; senão, os.umask (que só lê trocando o valor,
+    por isso uma única vez, sob lock).
+    """
+    global _UMASK
+    try:
+        with open("/proc/self/status", encoding="ascii") as fh:
+            for line in fh:
+                if line.startswith("Umask:"):
+                    return int(line.split()[1], 8)
+    except (OSError, ValueError, IndexError):
+        pass
+    with _UMASK_LOCK:
+        if _UMASK is None:
+            _UMASK = os.umask(0o022)
+            os.umask(_UMASK)
+        return _UMASK
+
+
+def atomic_write_text(path: str | Path, content: str, encoding: str = "utf-8") -> Path:
+    """
+    Grava em um arquivo temporário na mesma pasta e renomeia por cima do destino:
+    o arquivo final nunca fica parcialmente escrito. As permissões são as do destino existente
+    ou, para um arquivo novo, as de um open() comum (0666 menos a umask), não as 0600 do mkstemp.
+    """
+    p = Path(path).expanduser().resolve()
+    try:
+        mode = stat.S_IMODE(p.stat().st_mode)
+    except OSError:
+        mode = 0o666 & ~_umask()
+    fd, tmp = tempfile.mkstemp(prefix=f".{p.name}.", suffix=".tmp", dir=str(p.parent))
+    try:
+        with os.fdopen(fd, "w", encoding=encoding) as fh:
+            fh.write(content)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.chmod(tmp, mode)
+        os.replace(tmp, p)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    return p
+
+
+class JobManifest:
+    """
+    Manifesto de uma execução multiarquivo, gravado ao lado das saídas.
+    Cada material é identificado pelo SHA-256 do conteúdo + modo ('refine' ou 'original');
+    guarda o estágio, o caminho de saída e o resultado, para que uma nova execução com a
+    mesma seleção pule o que já foi concluído e refaça apenas o que falhou ou ficou pendente.
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        self.path = Path(path).expanduser().resolve()
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        if self.path.exists():
+            try:
+                data = json.loads(self.path.read_text(encoding="utf-8"))
+                self.entries = dict(data.get("entries", {}))
+            except (OSError, ValueError, AttributeError):
+                self.entries = {}  # manifesto ilegível: recomeça sem perder as saídas já gravadas
+
+    @staticmethod
+    def _key(digest: str, mode: str) -> str:
+        return f"{digest}:{mode}"
+
+    def get(self, digest: str, mode: str) -> Optional[Dict[str, Any]]:
+        return self.entries.get(self._key(digest, mode))
+
+    def completed_output(self, digest: str, mode: str) -> Optional[Path]:
+        """
+        Caminho da saída se o material já foi concluído e o arquivo ainda existe.
+        """
+        entry = self.get(digest, mode)
+        if not entry or entry.get("stage") != DONE or not entry.get("output"):
+            return None
+        out = Path(entry["output"])
+        return out if out.is_file() else None
+
+    def mark(
+        self,
+        digest: str,
+        mode: str,
+        source: Path,
+        stage: str,
+        output: Optional[Path] = None,
+        outcome: Optional[str] = None,
+    ) -> None:
+        entry = self.entries.setdefault(self._key(digest, mode), {"sha256": digest, "mode": mode, "attempts": 0})
+        if stage == PENDING:
+            entry["attempts"] = int(entry.get("attempts", 0)) + 1
+        entry.update(
+            source=str(source),
+            stage=stage,
+            output=str(output) if output else entry.get("output"),
+            outcome=outcome,
+            updated=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        )
+        self.save()
+
+    def save(self) -> None:
+        payload = {"version": 1, "entries": self.entries}
+        atomic_write_text(self.path, json.dumps(payload, ensure_ascii=False, indent=2))
@@ -0,0 +1,401 @@
+from __future__ import annotations
+import contextlib
+import hashlib
+import json
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from utils.doc_router import DocumentProfile, open_or_build_profile, save_profile
+from utils.job_manifest import atomic_write_text
+
+try:  # zstd é opcional (pip install zstandard); sem ele, zlib
+    import zstandard as _zstd
+except ImportError:  # pragma: no cover - depende do ambiente
+    _zstd = None
+
+SEGMENT_FILE = "ebooks.seg"
+INDEX_FILE = "index.json"
+INDEXES_DIR = "indexes"
+LOCK_FILE = "library.lock"
+LOCK_TIMEOUT = 30.0
+
+CODEC_ZLIB = "zlib"
+CODEC_ZSTD = "zstd"
+
+# Registro no segmento: magic, tamanho dos metadados (JSON) e do texto comprimido
+_MAGIC = b"EQL1"
+_HEADER = struct.Struct("<4sII")
+_INDEX_VERSION = 2  # v1 podia perder registros gravados por outro processo: o segmento é reindexado uma vez
+
+_LIBRARY: Optional["EbookLibrary"] = None
+_LIBRARY_LOCK = threading.Lock()
+
+
+def default_library_dir() -> Path:
+    """
+    Pasta da biblioteca: $EBOOKQA_LIBRARY_DIR ou ~/.ebookqa/library.
+    """
+    base = os.environ.get("EBOOKQA_LIBRARY_DIR", "").strip()
+    d = Path(base).expanduser() if base else Path.home() / ".ebookqa" / "library"
+    d.mkdir(parents=True, exist_ok=True)
+    return d
+
+
+def default_codec() -> str:
+    return CODEC_ZSTD if _zstd is not None else CODEC_ZLIB
+
+
+def _compress(data: bytes, codec: str) -> bytes:
+    if codec == CODEC_ZSTD:
+        return _zstd.ZstdCompressor(level=10).compress(data)
+    return zlib.compress(data, 6)
+
+
+def _decompress(data: bytes, codec: str) -> bytes:
+    if codec == CODEC_ZSTD:
+        if _zstd is None:
+            raise RuntimeError("Ebook gravado com zstd: instale com pip install zstandard")
+        return _zstd.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+@contextlib.contextmanager
+def _file_lock(path: Path, timeout: float = LOCK_TIMEOUT) -> Iterator[None]:
+    """
+    Trava exclusiva entre processos (CLI, Flet e Streamlit gravam na mesma biblioteca).
+    """
+    fh = open(path, "a+b")
+    try:
+        if sys.platform == "win32":
+            import msvcrt
+
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    fh.seek(0)
+                    msvcrt.locking(fh.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(f"Biblioteca em uso por outro processo: {path.parent}") from None
+                    time.sleep(0.05)
+            try:
+                yield
+            finally:
+                fh.seek(0)
+                msvcrt.locking(fh.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+    finally:
+        fh.close()
+
+
+@dataclass
+class LibraryEntry:
+    id: str  # início do SHA-256 do texto
+    title: str
+    text_sha256: str
+    chars: int
+    offset: int  # posição do registro no segmento
+    length: int  # bytes do texto comprimido
+    codec: str
+    source: Optional[str] = None
+    source_sha256: Optional[str] = None  # hash do arquivo de origem (mesmo do cache de extração/manifesto)
+    model: Optional[str] = None  # modelo do refino (None = conteúdo original)
+    refined: bool = False
+    created: str = field(default_factory=lambda: time.strftime("%Y-%m-%dT%H:%M:%S"))
+    removed: bool = False
+
+    def label(self) -> str:
+        kind = "refinado" if self.refined else "original"
+        return f"{self.title} ({kind}, {self.chars:,} caracteres, {self.created[:10]})"
+
+
+class EbookLibrary:
+    """
+    Biblioteca local de ebooks processados.
+    - `ebooks.seg`: segmento só de acréscimo; cada registro traz os metadados e o texto comprimido
+      (zstd, se instalado, ou zlib).
+    - `index.json`: id -> offset/tamanho/metadados, para abrir qualquer ebook com um seek.
+    - `indexes/<hash>/`: índices de busca (BM25/denso) e o perfil de roteamento (palavras-chave e resumo,
+      calculado ao acrescentar o ebook) construídos sobre os textos da biblioteca.
+    O índice é reconstruído a partir do segmento se estiver ausente ou atrasado (ex.: queda no meio da gravação).
+    Gravações (acrescentar, remover, compactar) usam uma trava entre processos e relêem índice e segmento
+    antes de escrever: vários processos podem usar a mesma pasta.
+    Remover só marca a entrada; `compact()` reescreve o segmento sem os removidos.
+    """
+
+    def __init__(self, directory: Optional[str | Path] = None) -> None:
+        self.dir = Path(directory).expanduser().resolve() if directory else default_library_dir()
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.segment_path = self.dir / SEGMENT_FILE
+        self.index_path = self.dir / INDEX_FILE
+        self.lock_path = self.dir / LOCK_FILE
+        self._lock = threading.Lock()
+        self._entries: Dict[str, LibraryEntry] = {}
+        self._indexed_size = 0
+        self._stamp: Optional[Tuple[int, int]] = None
+        self._refresh()
+
+    # -------- índice --------
+    def _disk_stamp(self) -> Tuple[int, int]:
+        index_mtime = self.index_path.stat().st_mtime_ns if self.index_path.exists() else 0
+        size = self.segment_path.stat().st_size if self.segment_path.exists() else 0
+        return index_mtime, size
+
+    def _refresh(self, repair: bool = False) -> None:
+        """
+        Relê o índice gravado e indexa os registros acrescentados ao segmento depois dele (por este ou outro processo).
+        `repair` (só com a trava entre processos): descarta um registro incompleto no fim do segmento
+        (gravação interrompida) e grava o índice atualizado. Sem a trava, o fim incompleto pode ser
+        uma gravação em andamento: apenas é ignorado.
+        """
+        stamp = self._disk_stamp()
+        try:
+            data = json.loads(self.index_path.read_text(encoding="utf-8"))
+            entries = {e["id"]: LibraryEntry(**e) for e in data.get("entries", [])}
+            indexed = int(data.get("segment_size", 0)) if data.get("version") == _INDEX_VERSION else 0
+        except (OSError, ValueError, TypeError, KeyError):
+            entries, indexed = {}, 0
+        saved = indexed
+        size = stamp[1]
+        if size < indexed:
+            # Segmento menor que o indexado (substituído/truncado): o índice não vale mais
+            entries, indexed = {}, 0
+        self._entries, self._indexed_size = entries, indexed
+        if size > indexed:
+            self._scan_tail(size, truncate=repair)
+        if repair and self._indexed_size != saved:
+            self._save_index()
+            stamp = self._disk_stamp()
+        self._stamp = stamp
+
+    def _scan_tail(self, size: int, truncate: bool = False) -> None:
+        with open(self.segment_path, "rb") as fh:
+            pos = self._indexed_size
+            fh.seek(pos)
+            while pos + _HEADER.size <= size:
+                magic, meta_len, payload_len = _HEADER.unpack(fh.read(_HEADER.size))
+                end = pos + _HEADER.size + meta_len + payload_len
+                if magic != _MAGIC or end > size:
+                    break  # registro incompleto no fim do arquivo: ignorado
+                try:
+                    meta = json.loads(fh.read(meta_len).decode("utf-8"))
+                    entry = LibraryEntry(**dict(meta, offset=pos, length=payload_len))
+                except (ValueError, TypeError):
+                    break
+                fh.seek(payload_len, os.SEEK_CUR)
+                # Entradas já indexadas mantêm o que só existe no índice (ex.: marcação de removido)
+                self._entries.setdefault(entry.id, entry)
+                pos = end
+            self._indexed_size = pos
+        if truncate and pos < size:
+            # Registro incompleto (gravação interrompida): descartado para os próximos acréscimos ficarem contíguos
+            with open(self.segment_path, "r+b") as fh:
+                fh.truncate(pos)
+
+    @contextlib.contextmanager
+    def _writing(self) -> Iterator[None]:
+        """
+        Trava da thread e entre processos, com o estado relido do disco (nada gravado por outro processo se perde).
+        """
+        with self._lock, _file_lock(self.lock_path):
+            self._refresh(repair=True)
+            yield
+            self._save_index()
+            self._stamp = self._disk_stamp()
+
+    def _save_index(self) -> None:
+        payload = {
+            "version": _INDEX_VERSION,
+            "segment_size": self._indexed_size,
+            "entries": [asdict(e) for e in self._entries.values()],
+        }
+        atomic_write_text(self.index_path, json.dumps(payload, ensure_ascii=False, indent=1))
+
+    # -------- consulta --------
+    def entries(self, include_removed: bool = False) -> List[LibraryEntry]:
+        """
+        Ebooks da biblioteca, do mais antigo ao mais recente (inclui os acrescentados por outros processos).
+        """
+        with self._lock:
+            if self._disk_stamp() != self._stamp:
+                self._refresh()
+        items = [e for e in self._entries.values() if include_removed or not e.removed]
+        return sorted(items, key=lambda e: (e.created, e.offset))
+
+    def __len__(self) -> int:
+        return len(self.entries())
+
+    def get(self, entry_id: str) -> LibraryEntry:
+        try:
+            return self._entries[entry_id]
+        except KeyError:
+            raise KeyError(f"Ebook não encontrado na biblioteca: {entry_id}") from None
+
+    def find_source(self, source_sha256: str, refined: Optional[bool] = None) -> Optional[LibraryEntry]:
+        """
+        Último ebook gerado a partir do arquivo com este hash (opcionalmente só refinados/originais).
+        """
+        found = [
+            e for e in self.entries()
+            if e.source_sha256 == source_sha256 and (refined is None or e.refined == refined)
+        ]
+        return found[-1] if found else None
+
+    def _read_record(self, entry: LibraryEntry) -> str:
+        with open(self.segment_path, "rb") as fh:
+            fh.seek(entry.offset)
+            magic, meta_len, payload_len = _HEADER.unpack(fh.read(_HEADER.size))
+            if magic != _MAGIC or payload_len != entry.length:
+                raise ValueError(f"Registro corrompido na biblioteca: {entry.id}")
+            fh.seek(meta_len, os.SEEK_CUR)
+            return _decompress(fh.read(payload_len), entry.codec).decode("utf-8")
+
+    def read(self, entry_id: str) -> str:
+        try:
+            return self._read_record(self.get(entry_id))
+        except (ValueError, struct.error):
+            # Outro processo pode ter compactado o segmento (offsets mudaram): relê o índice e tenta de novo
+            with self._lock:
+                self._refresh()
+            return self._read_record(self.get(entry_id))
+
+    def read_many(self, entry_ids: Sequence[str]) -> List[str]:
+        return [self.read(i) for i in entry_ids]
+
+    # -------- gravação --------
+    def add(
+        self,
+        text: str,
+        title: str,
+        source: Optional[str | Path] = None,
+        source_sha256: Optional[str] = None,
+        model: Optional[str] = None,
+        refined: bool = False,
+        codec: Optional[str] = None,
+    ) -> LibraryEntry:
+        """
+        Acrescenta o ebook ao segmento (texto idêntico já presente não é gravado de novo).
+        """
+        text = text.strip()
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        entry_id = digest[:16]
+        with self._writing():
+            existing = self._entries.get(entry_id)
+            if existing is not None and not existing.removed:
+                return existing
+            codec = codec or default_codec()
+            payload = _compress(text.encode("utf-8"), codec)
+            entry = LibraryEntry(
+                id=entry_id,
+                title=title,
+                text_sha256=digest,
+                chars=len(text),
+                offset=0,
+                length=len(payload),
+                codec=codec,
+                source=str(source) if source else None,
+                source_sha256=source_sha256,
+                model=model,
+                refined=refined,
+            )
+            meta = {k: v for k, v in asdict(entry).items() if k not in {"offset", "length", "removed"}}
+            meta_bytes = json.dumps(meta, ensure_ascii=False).encode("utf-8")
+            with open(self.segment_path, "ab") as fh:
+                fh.seek(0, os.SEEK_END)
+                entry.offset = fh.tell()
+                fh.write(_HEADER.pack(_MAGIC, len(meta_bytes), len(payload)) + meta_bytes + payload)
+                fh.flush()
+                os.fsync(fh.fileno())
+                self._indexed_size = fh.tell()
+            self._entries[entry_id] = entry
+        # Perfil para o roteamento de perguntas entre vários ebooks (ver utils.doc_router)
+        save_profile(self.index_dir(text), DocumentProfile.build(text, title))
+        return entry
+
+    def remove(self, entry_id: str) -> None:
+        with self._writing():
+            self.get(entry_id).removed = True
+
+    def compact(self) -> int:
+        """
+        Reescreve o segmento só com os ebooks ativos. Retorna os bytes liberados.
+        """
+        with self._writing():
+            before = self.segment_path.stat().st_size if self.segment_path.exists() else 0
+            tmp = self.segment_path.with_suffix(".seg.tmp")
+            kept: Dict[str, LibraryEntry] = {}
+            with open(self.segment_path, "rb") as src, open(tmp, "wb") as dst:
+                for entry in sorted(self._entries.values(), key=lambda e: e.offset):
+                    if entry.removed:
+                        continue
+                    src.seek(entry.offset)
+                    _magic, meta_len, payload_len = _HEADER.unpack(src.read(_HEADER.size))
+                    record = src.read(meta_len + payload_len)
+                    entry.offset = dst.tell()
+                    dst.write(_HEADER.pack(_MAGIC, meta_len, payload_len) + record)
+                    kept[entry.id] = entry
+                dst.flush()
+                os.fsync(dst.fileno())
+                self._indexed_size = dst.tell()
+            os.replace(tmp, self.segment_path)
+            self._entries = kept
+            return before - self._indexed_size
+
+    # -------- índices de busca --------
+    def index_dir(self, text: str) -> Path:
+        """
+        Pasta para os índices de busca construídos sobre `text` (ex.: combinação de ebooks selecionados).
+        """
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return self.dir / INDEXES_DIR / digest[:24]
+
+    def profile(self, text: str, title: str) -> DocumentProfile:
+        """
+        Perfil de roteamento de `text` (gravado na ingestão; calculado agora se faltar).
+        """
+        return open_or_build_profile(self.index_dir(text.strip()), text, title)
+
+
+def get_library() -> EbookLibrary:
+    """
+    Biblioteca do processo (compartilhada por CLI, Flet e Streamlit).
+    """
+    global _LIBRARY
+    with _LIBRARY_LOCK:
+        if _LIBRARY is None:
+            _LIBRARY = EbookLibrary()
+        return _LIBRARY
+
+
+def parse_selection(raw: str, total: int) -> List[int]:
+    """
+    Converte "1,3-5" / "todos" em índices 0-based (ordem e sem repetição); ValueError se inválido.
+    """
+    raw = raw.strip().lower()
+    if raw in {"todos", "t", "all", "*"}:
+        return list(range(total))
+    picked: List[int] = []
+    for part in raw.replace(" ", "").split(","):
+        if not part:
+            continue
+        lo, _, hi = part.partition("-")
+        start, end = int(lo), int(hi or lo)
+        if not (1 <= start <= end <= total):
+            raise ValueError(f"Seleção fora do intervalo 1-{total}: {part}")
+        picked.extend(i - 1 for i in range(start, end + 1) if i - 1 not in picked)
+    return picked
@@ -0,0 +1,427 @@
+from __future__ import annotations
+import concurrent.futures as cf
+import hashlib
+import io
+import json
+import mmap
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import zlib
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+from utils.disk_cache import DiskCache, default_cache_dir
+
+# Bytes, caminho ou arquivo binário aberto (ex.: UploadedFile do Streamlit)
+PdfSource = Union[bytes, str, Path, BinaryIO]
+
+# Suba ao mudar a forma de extrair/remontar o texto: invalida o cache de extrações
+EXTRACTOR_VERSION = "3"
+
+# Padrões do extrator paralelo
+DEFAULT_PAGES_PER_TASK = 8
+DEFAULT_PAGE_TIMEOUT = 30.0  # segundos por página
+DEFAULT_MAX_TASKS_PER_CHILD = 50  # recicla o worker para limitar o crescimento de memória do pypdf
+MIN_PAGES_FOR_POOL = 16  # abaixo disso, o custo de subir processos não compensa
+MAX_PAGE_RETRIES = 2  # execuções seguintes que ainda tentam as páginas puladas de uma extração em cache
+_WATCHDOG_GRACE = 15.0  # folga do prazo de cada tarefa (subida do processo, abertura do PDF)
+
+
+@dataclass
+class PdfExtraction:
+    pages: List[str]  # texto de cada página, na ordem do documento
+    skipped: Dict[int, str] = field(default_factory=dict)  # página (1-based) -> motivo
+    parallel: bool = False
+    cached: bool = False
+
+    @property
+    def page_count(self) -> int:
+        return len(self.pages)
+
+    @property
+    def text(self) -> str:
+        return "\n".join(self.pages).strip()
+
+    def skipped_summary(self) -> str:
+        return ", ".join(f"p.{n} ({why})" for n, why in sorted(self.skipped.items()))
+
+
+class _PageTimeout(Exception):
+    pass
+
+
+def default_workers() -> int:
+    """
+    Número de processos do extrator: EBOOKQA_PDF_WORKERS (1 desliga o paralelismo)
+    ou o número de CPUs, limitado a 8.
+    """
+    raw = os.environ.get("EBOOKQA_PDF_WORKERS", "").strip()
+    if raw.isdigit() and int(raw) > 0:
+        return int(raw)
+    return max(1, min(8, os.cpu_count() or 1))
+
+
+def _alarm_available() -> bool:
+    # SIGALRM só existe em POSIX e só pode ser armado na thread principal (caso dos workers)
+    return hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread()
+
+
+@contextmanager
+def _page_deadline(seconds: float) -> Iterator[None]:
+    if seconds <= 0 or not _alarm_available():
+        yield
+        return
+
+    def _raise(_signum, _frame):
+        raise _PageTimeout()
+
+    previous = signal.signal(signal.SIGALRM, _raise)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def _open_reader(source: PdfSource):
+    """
+    Abre o PDF sem copiar o arquivo inteiro para a memória: caminhos são mapeados (mmap)
+    e arquivos abertos são lidos sob demanda (o PdfReader copiaria tudo num BytesIO).
+    """
+    from pypdf import PdfReader  # pip install pypdf
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return PdfReader(io.BytesIO(source))
+    if isinstance(source, (str, Path)):
+        fh = open(source, "rb")
+        try:
+            stream = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            stream = fh  # arquivo vazio ou sem suporte a mmap
+        reader = PdfReader(stream)
+        reader._ebookqa_handles = (fh, stream)  # mantém o arquivo aberto enquanto o reader existir
+        return reader
+    source.seek(0)
+    return PdfReader(source)
+
+
+def _spool_to_tempfile(source: PdfSource) -> str:
+    # Os workers recebem um caminho (cada um faz mmap) em vez de uma cópia dos bytes por processo
+    fd, path = tempfile.mkstemp(prefix="ebookqa_", suffix=".pdf")
+    with os.fdopen(fd, "wb") as out:
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            out.write(source)
+        else:
+            source.seek(0)
+            shutil.copyfileobj(source, out, 1024 * 1024)
+    return path
+
+
+def _extract_pages(reader, start: int, end: int, page_timeout: float) -> List[Tuple[int, str, Optional[str]]]:
+    out: List[Tuple[int, str, Optional[str]]] = []
+    for i in range(start, end):
+        try:
+            with _page_deadline(page_timeout):
+                text = reader.pages[i].extract_text() or ""
+            out.append((i, text, None))
+        except _PageTimeout:
+            out.append((i, "", f"excedeu {page_timeout:g}s"))
+        except Exception as e:
+            out.append((i, "", f"{type(e).__name__}: {e}"))
+    return out
+
+
+# ---- Estado do worker (cada processo abre o PDF uma única vez) ----
+_WORKER_SOURCE: Optional[PdfSource] = None
+_WORKER_READER = None
+
+
+def _init_worker(source: PdfSource) -> None:
+    global _WORKER_SOURCE, _WORKER_READER
+    _WORKER_SOURCE = source
+    _WORKER_READER = None
+
+
+def _extract_range(start: int, end: int, page_timeout: float) -> List[Tuple[int, str, Optional[str]]]:
+    global _WORKER_READER
+    if _WORKER_READER is None:
+        _WORKER_READER = _open_reader(_WORKER_SOURCE)
+    return _extract_pages(_WORKER_READER, start, end, page_timeout)
+
+
+def _make_pool(workers: int, source: PdfSource) -> cf.ProcessPoolExecutor:
+    return cf.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(source,))
+
+
+def _kill_pool(pool: cf.ProcessPoolExecutor) -> None:
+    # Um worker travado não é interrompido por shutdown(); encerramos os processos
+    pool.shutdown(wait=False, cancel_futures=True)
+    for proc in list((getattr(pool, "_processes", None) or {}).values()):
+        try:
+            proc.terminate()
+        except Exception:
+            pass
+
+
+def extract_pdf_text(
+    source: PdfSource,
+    workers: Optional[int] = None,
+    pages_per_task: int = DEFAULT_PAGES_PER_TASK,
+    page_timeout: float = DEFAULT_PAGE_TIMEOUT,
+    max_tasks_per_child: Optional[int] = DEFAULT_MAX_TASKS_PER_CHILD,
+    pages: Optional[Sequence[int]] = None,
+) -> PdfExtraction:
+    """
+    Extrai o texto de um PDF (bytes, caminho ou arquivo aberto) página a página.
+    `pages` (índices 0-based) restringe a extração a essas páginas; as demais voltam vazias.
+    PDFs grandes têm faixas de `pages_per_task` páginas distribuídas num ProcessPoolExecutor;
+    cada página tem `page_timeout` segundos: páginas que travam ou falham são puladas e
+    informadas em `skipped`, sem derrubar o restante. As páginas são remontadas na ordem original.
+    PDFs pequenos (ou workers=1) são extraídos no próprio processo quando o timeout pode ser armado
+    ali (SIGALRM, só na thread principal em POSIX); nos demais casos (Windows, threads da interface)
+    vão para um único worker, com o prazo controlado pelo processo principal.
+    """
+    reader = _open_reader(source)
+    page_count = len(reader.pages)
+    workers = workers or default_workers()
+    pages_per_task = max(1, pages_per_task)
+    indices = list(range(page_count)) if pages is None else sorted({i for i in pages if 0 <= i < page_count})
+
+    small = workers <= 1 or len(indices) < MIN_PAGES_FOR_POOL
+    if not indices or (small and (page_timeout <= 0 or _alarm_available())):
+        results = [r for s, e in _page_ranges(indices, len(indices) or 1) for r in _extract_pages(reader, s, e, page_timeout)]
+        return _assemble(results, page_count, parallel=False)
+    del reader  # cada worker abre sua própria cópia
+
+    spooled = None if isinstance(source, (str, Path)) else _spool_to_tempfile(source)
+    try:
+        return _extract_parallel(
+            str(spooled or source), page_count, indices, 1 if small else workers, pages_per_task, page_timeout,
+            max_tasks_per_child,
+        )
+    finally:
+        if spooled:
+            try:
+                os.unlink(spooled)
+            except OSError:
+                pass
+
+
+def _page_ranges(indices: Sequence[int], per_task: int) -> List[Tuple[int, int]]:
+    """
+    Faixas [início, fim) de páginas consecutivas de `indices` (ordenados), com até `per_task` páginas cada.
+    """
+    ranges: List[Tuple[int, int]] = []
+    for i in indices:
+        if ranges and ranges[-1][1] == i and i - ranges[-1][0] < per_task:
+            ranges[-1] = (ranges[-1][0], i + 1)
+        else:
+            ranges.append((i, i + 1))
+    return ranges
+
+
+def _extract_parallel(
+    source: str,
+    page_count: int,
+    indices: Sequence[int],
+    workers: int,
+    pages_per_task: int,
+    page_timeout: float,
+    max_tasks_per_child: Optional[int],
+) -> PdfExtraction:
+    if not _alarm_available():
+        # Sem SIGALRM (Windows) o worker não interrompe a própria página: uma página por tarefa,
+        # com o prazo controlado aqui
+        pages_per_task = 1
+    ranges = _page_ranges(indices, pages_per_task)
+    results, broken = _run_ranges(source, ranges, min(workers, len(ranges)), page_timeout, max_tasks_per_child)
+    if broken:
+        # Pool quebrado (página que derruba o worker): refaz página a página, uma por vez e em pool novo,
+        # para isolar a culpada sem arriscar o processo principal
+        singles = [(i, i + 1) for s, e in broken for i in range(s, e)]
+        retried, failed = _run_ranges(source, singles, 1, page_timeout, max_tasks_per_child, give_up_after=3)
+        results.extend(retried)
+        results.extend((s, "", "derrubou o processo de extração") for s, _e in failed)
+    return _assemble(results, page_count, parallel=True)
+
+
+def _run_ranges(
+    source: str,
+    ranges: List[Tuple[int, int]],
+    workers: int,
+    page_timeout: float,
+    max_tasks_per_child: Optional[int],
+    give_up_after: Optional[int] = None,
+) -> Tuple[List[Tuple[int, str, Optional[str]]], List[Tuple[int, int]]]:
+    """
+    Executa as faixas com no máximo `workers` em andamento, cada uma com prazo de `page_timeout` por página
+    (+ folga) contado do envio. Prazo vencido: páginas da faixa puladas, processos encerrados e pool recriado
+    (as demais faixas em andamento voltam para a fila). Retorna os resultados e as faixas que quebraram o pool;
+    com `give_up_after`, após tantas quebras sem nenhuma faixa concluída (processos que nem sobem),
+    as faixas restantes também são dadas como quebradas.
+    O pool também é recriado a cada `workers * max_tasks_per_child` faixas (limita a memória do pypdf;
+    o max_tasks_per_child do próprio ProcessPoolExecutor pode travar no Python 3.11).
+    """
+    queue = deque(ranges)
+    results: List[Tuple[int, str, Optional[str]]] = []
+    broken: List[Tuple[int, int]] = []
+    inflight: Dict[cf.Future, Tuple[int, int, float]] = {}
+    recycle_after = workers * max_tasks_per_child if max_tasks_per_child else None
+    pool: Optional[cf.ProcessPoolExecutor] = None
+    submitted = 0
+    completed = 0
+
+    def _deadline(s: int, e: int, t0: float) -> float:
+        return t0 + page_timeout * (e - s) + _WATCHDOG_GRACE
+
+    try:
+        while queue or inflight:
+            if pool is None:
+                pool, submitted = _make_pool(workers, source), 0
+            while queue and len(inflight) < workers and (recycle_after is None or submitted < recycle_after):
+                s, e = queue.popleft()
+                inflight[pool.submit(_extract_range, s, e, page_timeout)] = (s, e, time.monotonic())
+                submitted += 1
+            if not inflight:
+                pool.shutdown(wait=True)  # reciclagem: próximo lote em processos novos
+                pool = None
+                continue
+            timeout = None
+            if page_timeout > 0:
+                timeout = max(0.0, min(_deadline(*v) for v in inflight.values()) - time.monotonic())
+            done, _ = cf.wait(inflight, timeout=timeout, return_when=cf.FIRST_COMPLETED)
+            restart = False
+            for fut in done:
+                s, e, _t0 = inflight.pop(fut)
+                try:
+                    results.extend(fut.result())
+                    completed += 1
+                except cf.process.BrokenProcessPool:
+                    broken.append((s, e))
+                    restart = True
+                except Exception as ex:
+                    results.extend((i, "", f"{type(ex).__name__}: {ex}") for i in range(s, e))
+            if page_timeout > 0:
+                now = time.monotonic()
+                for fut in [f for f, v in inflight.items() if now >= _deadline(*v)]:
+                    s, e, _t0 = inflight.pop(fut)
+                    reason = f"excedeu {page_timeout:g}s" if e - s == 1 else "worker travado"
+                    results.extend((i, "", reason) for i in range(s, e))
+                    restart = True
+            if restart:
+                # Worker travado ou morto: encerra os processos; o que estava em andamento volta para a fila
+                queue.extendleft((s, e) for s, e, _t0 in inflight.values())
+                inflight.clear()
+                _kill_pool(pool)
+                pool = None
+                if give_up_after is not None and not completed and len(broken) >= give_up_after:
+                    broken.extend(queue)
+                    queue.clear()
+    finally:
+        if pool is not None:
+            if inflight:
+                _kill_pool(pool)
+            else:
+                pool.shutdown(wait=True)
+    return results, broken
+
+
+def _assemble(results: List[Tuple[int, str, Optional[str]]], page_count: int, parallel: bool) -> PdfExtraction:
+    texts = [""] * page_count
+    skipped: Dict[int, str] = {}
+    for i, text, err in results:
+        texts[i] = text
+        if err is not None:
+            skipped[i + 1] = err
+    return PdfExtraction(pages=texts, skipped=skipped, parallel=parallel)
+
+
+# ---- Cache persistente de extrações (endereçado pelo conteúdo do arquivo) ----
+_CACHE: Optional[DiskCache] = None
+_CACHE_LOCK = threading.Lock()
+
+
+def file_sha256(source: PdfSource, chunk_size: int = 1024 * 1024) -> str:
+    """
+    SHA-256 dos bytes do arquivo (caminhos e arquivos abertos são lidos em blocos,
+    sem carregar tudo na memória).
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(source).hexdigest()
+    h = hashlib.sha256()
+    if isinstance(source, (str, Path)):
+        with open(source, "rb") as fh:
+            for block in iter(lambda: fh.read(chunk_size), b""):
+                h.update(block)
+        return h.hexdigest()
+    source.seek(0)
+    for block in iter(lambda: source.read(chunk_size), b""):
+        h.update(block)
+    source.seek(0)
+    return h.hexdigest()
+
+
+def extractor_version() -> str:
+    try:
+        from pypdf import __version__ as pypdf_version
+    except Exception:
+        pypdf_version = "?"
+    return f"{EXTRACTOR_VERSION}/pypdf-{pypdf_version}"
+
+
+def get_extraction_cache() -> DiskCache:
+    """
+    Cache de textos extraídos do processo: LRU limitado a 512 MB, sem expiração
+    (a extração é determinística para o mesmo arquivo e versão do extrator).
+    """
+    global _CACHE
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = DiskCache(default_cache_dir() / "extractions.sqlite", max_bytes=512 * 1024 * 1024, ttl_seconds=None)
+        return _CACHE
+
+
+def extract_pdf_text_cached(source: PdfSource, digest: Optional[str] = None, **kwargs) -> PdfExtraction:
+    """
+    `extract_pdf_text` com cache persistente por SHA-256 do arquivo + versão do extrator.
+    Extrações com páginas puladas (ex.: timeout) também são guardadas, com a lista das puladas:
+    nas próximas `MAX_PAGE_RETRIES` execuções só essas páginas são tentadas de novo; depois disso,
+    o resultado guardado vale como definitivo (o extrator é determinístico para o mesmo arquivo).
+    """
+    key = f"pdf:{digest or file_sha256(source)}:{extractor_version()}"
+    cache = get_extraction_cache()
+    blob = cache.get(key)
+    if blob is None:
+        result = extract_pdf_text(source, **kwargs)
+        _store_extraction(cache, key, result, retries=0)
+        return result
+
+    data = json.loads(zlib.decompress(blob).decode("utf-8"))
+    skipped = {int(n): why for n, why in (data.get("skipped") or {}).items()}
+    cached = PdfExtraction(pages=data["pages"], skipped=skipped, cached=True)
+    retries = int(data.get("retries", 0))
+    if not skipped or retries >= MAX_PAGE_RETRIES:
+        return cached
+
+    retry = extract_pdf_text(source, pages=[n - 1 for n in skipped], **kwargs)
+    for n in skipped:
+        cached.pages[n - 1] = retry.pages[n - 1]
+    cached.skipped = dict(retry.skipped)
+    cached.parallel = retry.parallel
+    _store_extraction(cache, key, cached, retries=retries + 1)
+    return cached
+
+
+def _store_extraction(cache: DiskCache, key: str, result: PdfExtraction, retries: int) -> None:
+    payload = {"pages": result.pages}
+    if result.skipped:
+        payload.update(skipped={str(n): why for n, why in result.skipped.items()}, retries=retries)
+    cache.set(key, zlib.compress(json.dumps(payload, ensure_ascii=False).encode("utf-8"), 6))
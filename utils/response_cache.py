@@ -0,0 +1,45 @@
+from __future__ import annotations
+import hashlib
+import json
+import threading
+from typing import Any, Dict, Optional
+
+from utils.disk_cache import DiskCache, default_cache_dir
+
+_CACHE: Optional[DiskCache] = None
+_CACHE_LOCK = threading.Lock()
+
+
+def response_cache_key(
+    kind: str,
+    model: str,
+    system_prompt: str,
+    user_prompt: str,
+    settings: Optional[Dict[str, Any]] = None,
+) -> str:
+    """
+    Chave endereçada por conteúdo: SHA-256 de (tipo, modelo, prompts completos, configurações).
+    """
+    payload = json.dumps(
+        {
+            "kind": kind,
+            "model": model,
+            "system": system_prompt,
+            "user": user_prompt,
+            "settings": settings or {},
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def get_response_cache() -> DiskCache:
+    """
+    Cache de respostas do processo (compartilhado por CLI, Flet e Streamlit).
+    """
+    global _CACHE
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = DiskCache(default_cache_dir() / "responses.sqlite")
+        return _CACHE
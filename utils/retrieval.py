@@ -0,0 +1,143 @@
+from __future__ import annotations
+import hashlib
+import math
+import pickle
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional, Protocol, Sequence, Tuple
+
+from utils.text_utils import TextChunk, chunk_text, estimate_tokens, tokenize
+
+DEFAULT_TOP_K = 8
+DEFAULT_TOKEN_BUDGET = 3000
+
+_CHUNK_SEP = "\n\n[...]\n\n"
+_BM25_FILE = "bm25.pkl"
+_BM25_STAMP = "bm25.sha256"
+
+
+class ContextSelector(Protocol):
+    """
+    Qualquer índice capaz de escolher o conteúdo-base relevante para uma pergunta.
+    """
+
+    def select_context(
+        self, question: str, top_k: int = DEFAULT_TOP_K, token_budget: int = DEFAULT_TOKEN_BUDGET
+    ) -> Optional[str]: ...
+
+
+class BM25Index:
+    """
+    Índice invertido em memória com ranqueamento BM25 sobre blocos do ebook.
+    Construído uma vez por sessão (build) e reutilizado em todas as perguntas.
+    """
+
+    def __init__(self, chunks: Sequence[TextChunk], k1: float = 1.5, b: float = 0.75) -> None:
+        self.chunks: List[TextChunk] = list(chunks)
+        self.k1 = k1
+        self.b = b
+        self._postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)  # termo -> [(chunk, tf)]
+        self._doc_len: List[int] = []
+
+        for i, ch in enumerate(self.chunks):
+            terms = tokenize(ch.text)
+            self._doc_len.append(len(terms))
+            for term, tf in Counter(terms).items():
+                self._postings[term].append((i, tf))
+
+        n = len(self.chunks)
+        self._avgdl = (sum(self._doc_len) / n) if n else 0.0
+        # IDF do BM25 (variante sempre positiva)
+        self._idf: Dict[str, float] = {
+            t: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for t, p in self._postings.items()
+        }
+
+    @classmethod
+    def build(cls, text: str, max_tokens: int = 350, overlap_tokens: int = 60) -> "BM25Index":
+        return cls(chunk_text(text, max_tokens=max_tokens, overlap_tokens=overlap_tokens))
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def save(self, directory: str | Path) -> Path:
+        """
+        Grava o índice pronto (blocos, postings e IDF): reabrir não re-tokeniza o ebook.
+        """
+        d = Path(directory).expanduser().resolve()
+        d.mkdir(parents=True, exist_ok=True)
+        with open(d / _BM25_FILE, "wb") as fh:
+            pickle.dump(self, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        return d
+
+    @classmethod
+    def load(cls, directory: str | Path) -> "BM25Index":
+        with open(Path(directory).expanduser().resolve() / _BM25_FILE, "rb") as fh:
+            index = pickle.load(fh)
+        if not isinstance(index, cls):
+            raise ValueError("Arquivo não contém um BM25Index.")
+        return index
+
+    def search(self, query: str, top_k: int = DEFAULT_TOP_K) -> List[Tuple[TextChunk, float]]:
+        """
+        Retorna os top_k blocos mais relevantes (bloco, score), em ordem decrescente de score.
+        """
+        scores: Dict[int, float] = defaultdict(float)
+        for term in set(tokenize(query)):
+            idf = self._idf.get(term)
+            if idf is None:
+                continue
+            for i, tf in self._postings[term]:
+                norm = self.k1 * (1 - self.b + self.b * self._doc_len[i] / (self._avgdl or 1.0))
+                scores[i] += idf * tf * (self.k1 + 1) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)[:top_k]
+        return [(self.chunks[i], s) for i, s in ranked]
+
+    def select_context(
+        self,
+        question: str,
+        top_k: int = DEFAULT_TOP_K,
+        token_budget: int = DEFAULT_TOKEN_BUDGET,
+    ) -> Optional[str]:
+        """
+        Monta o conteúdo-base para a pergunta: blocos mais relevantes até o orçamento de tokens,
+        reordenados pela posição no ebook. Retorna None se nenhum bloco casar com a pergunta.
+        """
+        return pack_chunks([ch for ch, _ in self.search(question, top_k=top_k)], token_budget)
+
+
+def pack_chunks(ranked: Sequence[TextChunk], token_budget: int) -> Optional[str]:
+    """
+    Seleciona blocos (já em ordem de relevância) até o orçamento de tokens
+    e os devolve concatenados na ordem original do texto.
+    """
+    picked: List[TextChunk] = []
+    used = 0
+    for ch in ranked:
+        t = estimate_tokens(ch.text)
+        if picked and used + t > token_budget:
+            continue
+        picked.append(ch)
+        used += t
+    if not picked:
+        return None
+    picked.sort(key=lambda c: c.start)
+    return _CHUNK_SEP.join(c.text for c in picked)
+
+
+def open_or_build_bm25_index(directory: str | Path, text: str) -> BM25Index:
+    """
+    Reabre o BM25 salvo em `directory` se ele corresponder ao mesmo texto; caso contrário,
+    constrói, salva e retorna um novo índice (ver `open_or_build_dense_index`).
+    """
+    d = Path(directory).expanduser().resolve()
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    stamp = d / _BM25_STAMP
+    try:
+        if stamp.read_text(encoding="utf-8").strip() == digest:
+            return BM25Index.load(d)
+    except (OSError, ValueError, pickle.UnpicklingError, EOFError, AttributeError):
+        pass
+    index = BM25Index.build(text)
+    index.save(d)
+    stamp.write_text(digest, encoding="utf-8")
+    return index
@@ -0,0 +1,306 @@
+from __future__ import annotations
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from utils.disk_cache import DiskCache, default_cache_dir
+from utils.text_utils import PT_STOPWORDS, tokenize
+from utils.vector_store import EmbeddingProvider
+
+# Similaridade mínima para reaproveitar uma resposta: Jaccard estimado (MinHash) ou cosseno (embeddings).
+# Perguntas opostas ficam na faixa 0.65-0.75 ("vantagens" x "desvantagens", "fase clara" x "fase escura")
+DEFAULT_THRESHOLD = 0.9
+DEFAULT_EMBEDDING_THRESHOLD = 0.92
+DEFAULT_MIN_TERMS = 2  # perguntas com menos termos ("e depois?") dependem da conversa: não entram
+DEFAULT_MAX_ENTRIES = 1000  # perguntas guardadas por ebook (as mais antigas saem primeiro)
+
+SHINGLE_SIZE = 4
+NUM_PERM = 64
+LSH_BANDS = 16  # 16 faixas x 4 linhas: candidatos com Jaccard ~0.5+ quase sempre colidem em alguma faixa
+_PRIME = 4294967311  # primo > 2^32
+_rng = np.random.default_rng(20240601)
+_PERM_A = _rng.integers(1, 2**31 - 1, size=NUM_PERM, dtype=np.uint64)
+_PERM_B = _rng.integers(0, 2**31 - 1, size=NUM_PERM, dtype=np.uint64)
+
+# Palavras que mudam o que se pergunta: ficam na forma normalizada (mesmo sendo stopwords) e precisam coincidir
+QUESTION_MARKERS = frozenset(
+    """
+    que quando onde quem como qual quais quanto quanta quantos quantas porque
+    nao nem nunca jamais nenhum nenhuma nada sem
+    """.split()
+)
+_KEY_VERSION = 3  # v1 ordenava os termos e descartava interrogativos/negação; v2 descartava termos de 1 caractere
+
+_CACHE: Optional[DiskCache] = None
+_CACHE_LOCK = threading.Lock()
+
+
+def normalize_question(question: str) -> str:
+    """
+    Forma canônica da pergunta: termos sem acentos, pontuação e stopwords, na ordem original.
+    Interrogativos e negações (QUESTION_MARKERS) são mantidos: "quando ocorreu..." != "onde ocorreu...".
+    Termos curtos também: "capítulo 3" != "capítulo 4", "vitamina c" != "vitamina d".
+    """
+    words = tokenize(question, drop_stopwords=False)
+    return " ".join(w for w in words if w in QUESTION_MARKERS or w not in PT_STOPWORDS)
+
+
+def question_markers(normalized: str) -> Tuple[str, ...]:
+    """
+    Interrogativos e negações da pergunta normalizada, em ordem: perguntas só são equivalentes se coincidirem.
+    """
+    return tuple(w for w in normalized.split() if w in QUESTION_MARKERS)
+
+
+def content_terms(normalized: str) -> frozenset:
+    """
+    Termos de conteúdo (sem interrogativos/negações) da pergunta normalizada.
+    """
+    return frozenset(w for w in normalized.split() if w not in QUESTION_MARKERS)
+
+
+def question_shingles(normalized: str) -> List[str]:
+    """
+    N-gramas de caracteres (com bordas de palavra) da pergunta normalizada:
+    tolera flexões e pequenas variações ("defina" x "definição").
+    """
+    padded = f" {normalized} "
+    if len(padded) <= SHINGLE_SIZE:
+        return [padded]
+    return sorted({padded[i:i + SHINGLE_SIZE] for i in range(len(padded) - SHINGLE_SIZE + 1)})
+
+
+def minhash_signature(shingles: Sequence[str]) -> np.ndarray:
+    hashes = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "little") for s in shingles),
+        dtype=np.uint64,
+        count=len(shingles),
+    )
+    return ((np.outer(_PERM_A, hashes) + _PERM_B[:, None]) % _PRIME).min(axis=1)
+
+
+def _bands(signature: np.ndarray) -> List[Tuple[int, bytes]]:
+    rows = NUM_PERM // LSH_BANDS
+    return [(b, signature[b * rows:(b + 1) * rows].tobytes()) for b in range(LSH_BANDS)]
+
+
+def default_threshold() -> Optional[float]:
+    """
+    Limiar configurado em $EBOOKQA_SEMANTIC_THRESHOLD (0-1); "off" desativa o cache de perguntas.
+    """
+    raw = os.environ.get("EBOOKQA_SEMANTIC_THRESHOLD", "").strip().lower()
+    if not raw:
+        return DEFAULT_THRESHOLD
+    if raw in {"off", "0", "no", "false"}:
+        return None
+    try:
+        return min(1.0, max(0.0, float(raw)))
+    except ValueError:
+        return DEFAULT_THRESHOLD
+
+
+def text_sha256(text: str) -> str:
+    # Espaços nas bordas não mudam o material (QARequest já os remove)
+    return hashlib.sha256(text.strip().encode("utf-8")).hexdigest()
+
+
+def get_semantic_store() -> DiskCache:
+    """
+    Perguntas e respostas já dadas, por ebook (compartilhado por CLI, Flet e Streamlit).
+    """
+    global _CACHE
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = DiskCache(default_cache_dir() / "answers.sqlite", max_bytes=128 * 1024 * 1024)
+        return _CACHE
+
+
+@dataclass
+class SemanticHit:
+    question: str  # pergunta original que gerou a resposta
+    payload: str  # resposta serializada (QAOutput em JSON)
+    similarity: float
+
+
+class SemanticAnswerCache:
+    """
+    Cache de respostas por pergunta, escopado ao conteúdo do ebook (SHA-256 do texto) e ao modelo.
+    Uma pergunta nova reaproveita a resposta de uma anterior quando:
+    - a forma normalizada (ordem das palavras, interrogativos e negações incluídos) é idêntica; ou
+    - tem os mesmos interrogativos/negações e a similaridade passa de `threshold`: com `embedder`, cosseno
+      entre embeddings; sem ele, os mesmos termos de conteúdo (em qualquer ordem) e Jaccard estimado por
+      MinHash de n-gramas de caracteres (candidatos via LSH).
+    Trocar o ebook muda o hash: as respostas antigas deixam de valer automaticamente.
+    """
+
+    def __init__(
+        self,
+        ebook_text: str,
+        model: str,
+        threshold: Optional[float] = None,
+        embedder: Optional[EmbeddingProvider] = None,
+        min_terms: int = DEFAULT_MIN_TERMS,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        store: Optional[DiskCache] = None,
+    ) -> None:
+        self.ebook_hash = text_sha256(ebook_text)
+        self.model = model
+        self.embedder = embedder
+        self.threshold = threshold if threshold is not None else (
+            DEFAULT_EMBEDDING_THRESHOLD if embedder is not None else DEFAULT_THRESHOLD
+        )
+        self.min_terms = min_terms
+        self.max_entries = max_entries
+        self.store = store if store is not None else get_semantic_store()
+        method = f"emb:{embedder.name}" if embedder is not None else f"minhash:{NUM_PERM}:{SHINGLE_SIZE}"
+        self.key = f"semantic:v{_KEY_VERSION}:{self.ebook_hash}:{model}:{method}"
+        self.hits = 0
+        self.misses = 0
+        self._ebook_ref = ebook_text
+        self._lock = threading.Lock()
+        self._entries: List[Dict[str, Any]] = []
+        self._exact: Dict[str, int] = {}
+        self._markers: List[Tuple[str, ...]] = []
+        self._terms: List[frozenset] = []
+        self._buckets: Dict[Tuple[int, bytes], List[int]] = {}
+        self._vectors: Optional[np.ndarray] = None
+        self._load()
+
+    def covers(self, ebook_text: str) -> bool:
+        """
+        True se o cache pertence a este conteúdo (o mesmo objeto é reconhecido sem recalcular o hash).
+        """
+        return ebook_text is self._ebook_ref or text_sha256(ebook_text) == self.ebook_hash
+
+    # -------- persistência --------
+    def _load(self) -> None:
+        raw = self.store.get(self.key)
+        entries: List[Dict[str, Any]] = []
+        if raw is not None:
+            try:
+                entries = json.loads(zlib.decompress(raw).decode("utf-8"))
+            except (zlib.error, ValueError):
+                entries = []
+        self._rebuild(entries)
+
+    def _save(self) -> None:
+        blob = zlib.compress(json.dumps(self._entries, ensure_ascii=False).encode("utf-8"))
+        self.store.set(self.key, blob)
+
+    def _rebuild(self, entries: List[Dict[str, Any]]) -> None:
+        self._entries = entries[-self.max_entries:]
+        self._exact = {e["norm"]: i for i, e in enumerate(self._entries)}
+        self._markers = [question_markers(e["norm"]) for e in self._entries]
+        self._terms = [content_terms(e["norm"]) for e in self._entries]
+        self._buckets = {}
+        vectors = []
+        for i, e in enumerate(self._entries):
+            if self.embedder is not None:
+                vectors.append(e["vec"])
+            else:
+                for band in _bands(np.asarray(e["sig"], dtype=np.uint64)):
+                    self._buckets.setdefault(band, []).append(i)
+        self._vectors = np.asarray(vectors, dtype=np.float32) if vectors else None
+
+    # -------- similaridade --------
+    def _features(self, question: str, normalized: str) -> Dict[str, Any]:
+        if self.embedder is not None:
+            vec = np.asarray(self.embedder.embed([question])[0], dtype=np.float32)
+            norm = float(np.linalg.norm(vec))
+            return {"vec": (vec / norm if norm else vec).tolist()}
+        return {"sig": minhash_signature(question_shingles(normalized)).tolist()}
+
+    def _best_match(
+        self, features: Dict[str, Any], markers: Tuple[str, ...], terms: frozenset
+    ) -> Tuple[Optional[int], float]:
+        # Só concorrem perguntas com os mesmos interrogativos/negações (a similaridade de texto não os distingue).
+        # Sem embeddings, o MinHash só encontra candidatos: a resposta exige os mesmos termos de conteúdo
+        # ("desvantagens" fica a um prefixo de "vantagens")
+        if self.embedder is not None:
+            if self._vectors is None:
+                return None, 0.0
+            scores = self._vectors @ np.asarray(features["vec"], dtype=np.float32)
+            best, best_sim = None, 0.0
+            for i in np.argsort(-scores):
+                if self._markers[int(i)] == markers:
+                    best, best_sim = int(i), float(scores[i])
+                    break
+            return best, best_sim
+        sig = np.asarray(features["sig"], dtype=np.uint64)
+        candidates = {
+            i for band in _bands(sig) for i in self._buckets.get(band, ())
+            if self._markers[i] == markers and self._terms[i] == terms
+        }
+        best, best_sim = None, 0.0
+        for i in candidates:
+            sim = float(np.mean(np.asarray(self._entries[i]["sig"], dtype=np.uint64) == sig))
+            if sim > best_sim:
+                best, best_sim = i, sim
+        return best, best_sim
+
+    # -------- API --------
+    def lookup(self, question: str) -> Optional[SemanticHit]:
+        normalized = normalize_question(question)
+        if len(content_terms(normalized)) < self.min_terms:
+            return None
+        with self._lock:
+            idx = self._exact.get(normalized)
+        sim = 1.0
+        # Features (embedding pode ir à rede) calculadas fora do lock
+        features = self._features(question, normalized) if idx is None else None
+        with self._lock:
+            if features is not None:
+                idx, sim = self._best_match(features, question_markers(normalized), content_terms(normalized))
+                if idx is not None and sim < self.threshold:
+                    idx = None
+            if idx is None or idx >= len(self._entries):
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry = self._entries[idx]
+        return SemanticHit(question=entry["question"], payload=entry["payload"], similarity=sim)
+
+    def add(self, question: str, payload: str) -> None:
+        """
+        Guarda a resposta serializada da pergunta (substitui a de uma pergunta com a mesma forma normalizada).
+        """
+        normalized = normalize_question(question)
+        if len(content_terms(normalized)) < self.min_terms:
+            return
+        entry = {"question": question, "norm": normalized, "payload": payload, "ts": time.time()}
+        entry.update(self._features(question, normalized))
+        with self._lock:
+            # Relê antes de gravar: outro processo (CLI x app) pode ter acrescentado perguntas
+            self._load()
+            entries = [e for e in self._entries if e["norm"] != normalized]
+            entries.append(entry)
+            self._rebuild(entries)
+            self._save()
+
+    def clear(self) -> None:
+        with self._lock:
+            self.store.delete(self.key)
+            self._rebuild([])
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def summary(self) -> str:
+        return f"Cache de perguntas: {len(self._entries)} resposta(s) guardada(s) | {self.hits} acerto(s), {self.misses} falta(s)"
+
+
+def semantic_cache_for(ebook_text: str, model: str) -> Optional[SemanticAnswerCache]:
+    """
+    Cache de perguntas (MinHash) para o ebook com o limiar de `default_threshold()`; None se desativado.
+    """
+    threshold = default_threshold()
+    if threshold is None:
+        return None
+    return SemanticAnswerCache(ebook_text, model, threshold=threshold)
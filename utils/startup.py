@@ -0,0 +1,199 @@
+from __future__ import annotations
+import builtins
+import importlib
+import importlib.util
+import os
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, List, Optional, Sequence, TextIO
+
+PROFILE_FLAG = "--profile-startup"
+DEFAULT_TOP = 20
+
+
+@dataclass
+class ImportRecord:
+    module: str
+    self_s: float  # tempo do próprio módulo (sem os imports que ele disparou)
+    cumulative_s: float
+    depth: int
+    background: bool  # importado fora da thread principal (pré-aquecimento)
+
+
+def process_age(pid: Optional[int] = None) -> Optional[float]:
+    """
+    Segundos desde a criação do processo `pid` (padrão: o atual); None se o sistema não informar.
+    """
+    pid = os.getpid() if pid is None else pid
+    try:
+        if sys.platform == "win32":
+            return _process_age_windows(pid)
+        if os.path.exists(f"/proc/{pid}/stat"):
+            return _process_age_linux(pid)
+    except (OSError, ValueError, AttributeError, IndexError):
+        return None
+    return None
+
+
+def _process_age_linux(pid: int) -> float:
+    with open(f"/proc/{pid}/stat", "rb") as fh:
+        stat = fh.read().decode("utf-8", errors="replace")
+    # Campo 22 (starttime, em ticks desde o boot); o nome (campo 2) pode ter espaços e parênteses
+    start_ticks = int(stat.rsplit(")", 1)[1].split()[19])
+    with open("/proc/uptime", encoding="ascii") as fh:
+        uptime = float(fh.read().split()[0])
+    return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+
+
+def _process_age_windows(pid: int) -> Optional[float]:
+    import ctypes
+    from ctypes import wintypes
+
+    kernel32 = ctypes.windll.kernel32
+    kernel32.OpenProcess.restype = wintypes.HANDLE
+    handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+    if not handle:
+        return None
+    try:
+        creation, exited, kernel, user, now = (wintypes.FILETIME() for _ in range(5))
+        if not kernel32.GetProcessTimes(
+            handle, ctypes.byref(creation), ctypes.byref(exited), ctypes.byref(kernel), ctypes.byref(user)
+        ):
+            return None
+        kernel32.GetSystemTimeAsFileTime(ctypes.byref(now))
+    finally:
+        kernel32.CloseHandle(handle)
+
+    def _ticks(ft: Any) -> int:  # unidades de 100 ns
+        return (ft.dwHighDateTime << 32) | ft.dwLowDateTime
+
+    return (_ticks(now) - _ticks(creation)) / 1e7
+
+
+def is_onefile() -> bool:
+    """
+    True no executável PyInstaller --onefile: o bootloader (processo pai) extrai tudo para
+    uma pasta temporária `_MEIxxxx` antes de iniciar o Python.
+    """
+    meipass = getattr(sys, "_MEIPASS", None)
+    return bool(getattr(sys, "frozen", False) and meipass) and os.path.basename(os.path.normpath(meipass)).startswith("_MEI")
+
+
+class StartupProfiler:
+    """
+    Perfil de inicialização que funciona também no executável congelado (onde não há `-X importtime`):
+    envolve `builtins.__import__` e registra o tempo próprio/cumulativo de cada módulo importado pela
+    primeira vez. `report()` imprime o tempo até aquele ponto (ex.: primeiro prompt) e os imports mais caros
+    desde o relatório anterior. Desligado, não instala nada.
+    """
+
+    def __init__(self, enabled: bool = False) -> None:
+        self.enabled = enabled
+        self.t0 = time.perf_counter()
+        self.records: List[ImportRecord] = []
+        self._reported = 0
+        self._local = threading.local()
+        self._original: Optional[Any] = None
+        if enabled:
+            self.install()
+
+    @classmethod
+    def from_argv(cls, argv: Sequence[str]) -> "StartupProfiler":
+        return cls(enabled=PROFILE_FLAG in argv)
+
+    def install(self) -> None:
+        if self._original is None:
+            self._original = builtins.__import__
+            builtins.__import__ = self._import
+
+    def uninstall(self) -> None:
+        if self._original is not None and builtins.__import__ is self._import:
+            builtins.__import__ = self._original
+        self._original = None
+
+    def _import(self, name: str, globals: Any = None, locals: Any = None, fromlist: Any = (), level: int = 0) -> Any:
+        original = self._original
+        full = name
+        if level:
+            package = (globals or {}).get("__package__") or ""
+            try:
+                full = importlib.util.resolve_name("." * level + name, package) if package else name
+            except (ImportError, ValueError):
+                full = name
+        if full in sys.modules:
+            return original(name, globals, locals, fromlist, level)
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(0.0)
+        t = time.perf_counter()
+        try:
+            return original(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - t
+            children = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            background = threading.current_thread() is not threading.main_thread()
+            self.records.append(ImportRecord(full, elapsed - children, elapsed, len(stack), background))
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.t0
+
+    def report(self, label: str, top: int = DEFAULT_TOP, file: Optional[TextIO] = None) -> None:
+        """
+        Tempo desde o início (do script, do processo e, no onefile, do bootloader) e os `top`
+        imports mais caros no formato de `python -X importtime`.
+        """
+        if not self.enabled:
+            return
+        out = file or sys.stderr
+        end = len(self.records)
+        records = self.records[self._reported:end]
+        self._reported = end
+        lines = [f"[STARTUP] {label}: {self.elapsed() * 1000:.0f} ms desde o início do script"]
+        age = process_age()
+        if age is not None:
+            lines.append(f"  {age * 1000:.0f} ms desde a criação do processo (inclui o interpretador)")
+            if is_onefile():
+                parent_age = process_age(os.getppid())
+                if parent_age is not None:
+                    lines.append(
+                        f"  {parent_age * 1000:.0f} ms desde o início do executável "
+                        f"({(parent_age - age) * 1000:.0f} ms do bootloader extraindo o pacote onefile)"
+                    )
+        if records:
+            total = sum(r.cumulative_s for r in records if r.depth == 0 and not r.background)
+            n_bg = sum(1 for r in records if r.background)
+            lines.append(
+                f"  {len(records)} módulo(s) importado(s); {total * 1000:.0f} ms na thread principal"
+                + (f", {n_bg} em segundo plano" if n_bg else "")
+            )
+            lines.append("  import time: self [us] | cumulative | imported package")
+            for r in sorted(records, key=lambda r: r.cumulative_s, reverse=True)[:top]:
+                where = " (2º plano)" if r.background else ""
+                lines.append(
+                    f"  import time: {r.self_s * 1e6:9.0f} | {r.cumulative_s * 1e6:10.0f} | {'  ' * r.depth}{r.module}{where}"
+                )
+        print("\n".join(lines), file=out, flush=True)
+
+
+def prewarm_imports(modules: Sequence[str]) -> threading.Thread:
+    """
+    Importa `modules` em uma thread de fundo enquanto o usuário ainda está no primeiro prompt.
+    Faça `join()` antes de importar os mesmos módulos na thread principal. Erros são ignorados
+    aqui: reaparecem no import normal, no ponto de uso.
+    """
+
+    def _run() -> None:
+        for name in modules:
+            try:
+                importlib.import_module(name)
+            except Exception:
+                pass
+
+    thread = threading.Thread(target=_run, name="ebookqa-prewarm", daemon=True)
+    thread.start()
+    return thread
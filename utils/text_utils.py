@@ -0,0 +1,143 @@
+from __future__ import annotations
+import re
+import unicodedata
+from dataclasses import dataclass
+from typing import List
+
+# Aproximação usada em todo o projeto: ~4 caracteres por token (texto em português).
+CHARS_PER_TOKEN = 4
+
+_SENTENCE_RE = re.compile(r"[^.!?…\n]+(?:[.!?…]+[\"')\]]*|\n+|$)")
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_PARAGRAPH_RE = re.compile(r".+?(?:\n[ \t]*\n\s*|\Z)", re.S)
+
+# Stopwords do português (sem acento, pois os termos são normalizados antes da comparação).
+PT_STOPWORDS = frozenset(
+    """
+    a o as os um uma uns umas de do da dos das no na nos nas ao aos à às pelo pela pelos pelas
+    em por para com sem sob sobre entre ate apos desde contra e ou mas nem que se como quando
+    onde porque pois entao ja nao sim mais menos muito muita muitos muitas pouco pouca
+    este esta estes estas esse essa esses essas aquele aquela aqueles aquelas isto isso aquilo
+    eu tu ele ela nos vos eles elas me te lhe lhes meu minha meus minhas seu sua seus suas
+    nosso nossa nossos nossas dele dela deles delas ser e foi era sao sera estar esta estao
+    ter tem tinha ha havia fazer faz qual quais quem cujo cuja tambem so ainda ja todo toda
+    todos todas outro outra outros outras mesmo mesma cada seja sejam pode podem deve devem
+    la aqui ali assim bem num numa dum duma lo la los las
+    """.split()
+)
+
+
+@dataclass
+class TextChunk:
+    index: int
+    text: str
+    start: int  # offset (em caracteres) no texto original
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimativa barata de tokens (sem tokenizer): ~4 caracteres por token.
+    """
+    if not text:
+        return 0
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def strip_accents(text: str) -> str:
+    nfkd = unicodedata.normalize("NFKD", text)
+    return "".join(ch for ch in nfkd if not unicodedata.combining(ch))
+
+
+def tokenize(text: str, drop_stopwords: bool = True) -> List[str]:
+    """
+    Normaliza (minúsculas, sem acentos) e separa em termos.
+    Remove stopwords do português e termos de 1 caractere.
+    """
+    words = _WORD_RE.findall(strip_accents((text or "").lower()))
+    if not drop_stopwords:
+        return words
+    return [w for w in words if len(w) > 1 and w not in PT_STOPWORDS]
+
+
+def split_sentences(text: str) -> List[tuple[int, str]]:
+    """
+    Divide o texto em sentenças, preservando o offset de cada uma.
+    """
+    out: List[tuple[int, str]] = []
+    for m in _SENTENCE_RE.finditer(text or ""):
+        s = m.group(0)
+        if s.strip():
+            out.append((m.start(), s))
+    return out
+
+
+def _split_long(start: int, text: str, max_tokens: int) -> List[tuple[int, str]]:
+    # Sentenças gigantes (ex.: PDF sem pontuação) são fatiadas por tamanho
+    limit = max_tokens * CHARS_PER_TOKEN
+    return [(start + off, text[off:off + limit]) for off in range(0, len(text), limit)]
+
+
+def _pack_units(units: List[tuple[int, str]], max_tokens: int, overlap_tokens: int) -> List[TextChunk]:
+    """
+    Agrupa unidades consecutivas (sentenças/parágrafos) em blocos de até ~max_tokens,
+    repetindo no início de cada bloco a cauda (~overlap_tokens) do bloco anterior.
+    """
+    chunks: List[TextChunk] = []
+    current: List[tuple[int, str]] = []
+    current_tokens = 0
+
+    def flush() -> None:
+        body = "".join(s for _, s in current).strip()
+        if body:
+            chunks.append(TextChunk(index=len(chunks), text=body, start=current[0][0]))
+
+    for start, unit in units:
+        n = estimate_tokens(unit)
+        if current and current_tokens + n > max_tokens:
+            flush()
+            # Mantém a cauda do bloco anterior como sobreposição
+            tail: List[tuple[int, str]] = []
+            tail_tokens = 0
+            for item in reversed(current):
+                t = estimate_tokens(item[1])
+                if tail_tokens + t > overlap_tokens:
+                    break
+                tail.insert(0, item)
+                tail_tokens += t
+            current, current_tokens = tail, tail_tokens
+        current.append((start, unit))
+        current_tokens += n
+
+    flush()
+    return chunks
+
+
+def chunk_text(text: str, max_tokens: int = 350, overlap_tokens: int = 60) -> List[TextChunk]:
+    """
+    Divide o texto em blocos com sobreposição, respeitando limites de sentença.
+    Cada bloco tem até ~max_tokens; os últimos ~overlap_tokens do bloco anterior
+    são repetidos no início do próximo para não perder contexto nas bordas.
+    """
+    units: List[tuple[int, str]] = []
+    for start, sent in split_sentences(text):
+        units.extend(_split_long(start, sent, max_tokens))
+    return _pack_units(units, max_tokens, overlap_tokens)
+
+
+def split_segments(text: str, max_tokens: int = 4000, overlap_tokens: int = 150) -> List[TextChunk]:
+    """
+    Divide textos longos (ex.: transcrições de horas) em segmentos de até ~max_tokens,
+    cortando preferencialmente entre parágrafos. Parágrafos maiores que o limite
+    são quebrados por sentença. A sobreposição é pequena (~overlap_tokens).
+    """
+    units: List[tuple[int, str]] = []
+    for m in _PARAGRAPH_RE.finditer(text or ""):
+        para = m.group(0)
+        if not para.strip():
+            continue
+        if estimate_tokens(para) <= max_tokens:
+            units.append((m.start(), para))
+            continue
+        for start, sent in split_sentences(para):
+            units.extend(_split_long(m.start() + start, sent, max_tokens))
+    return _pack_units(units, max_tokens, overlap_tokens)
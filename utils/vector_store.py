@@ -0,0 +1,283 @@
+from __future__ import annotations
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, List, Optional, Protocol, Sequence, Tuple
+
+import numpy as np  # pip install numpy
+
+from api.openai_client import with_operation_timeout
+from api.scheduler import CallStats, get_scheduler
+from api.usage import UsageRecord, get_ledger, usage_from_response
+from utils.retrieval import DEFAULT_TOKEN_BUDGET, DEFAULT_TOP_K, ContextSelector, open_or_build_bm25_index, pack_chunks
+from utils.text_utils import TextChunk, chunk_text, estimate_tokens, tokenize
+
+_META_FILE = "meta.json"
+_CHUNKS_FILE = "chunks.json"
+_VECTORS_FILE = {"float32": "vectors.f32", "int8": "vectors.i8"}
+_SCALES_FILE = "scales.f32"
+_SEARCH_BLOCK_ROWS = 4096  # int8: linhas convertidas para float32 por vez na busca
+_DENSE_DIR = "dense"  # subpasta do índice denso dentro da pasta de índices do texto
+
+# Busca usada quando o ebook não cabe inteiro na pergunta: BM25 (padrão, local) ou embeddings da OpenAI
+RETRIEVERS = ("bm25", "dense", "dense-int8")
+DEFAULT_RETRIEVER = "bm25"
+
+
+class EmbeddingProvider(Protocol):
+    """
+    Fonte de embeddings plugável. `name` identifica o modelo (gravado junto ao índice).
+    """
+
+    name: str
+
+    def embed(self, texts: Sequence[str]) -> List[List[float]]: ...
+
+
+class OpenAIEmbeddingProvider:
+    def __init__(self, client: Any, model: str = "text-embedding-3-small") -> None:
+        self.client = client
+        self.model = model
+        self.name = f"openai:{model}"
+
+    def embed(self, texts: Sequence[str]) -> List[List[float]]:
+        api = with_operation_timeout(self.client, "embed")
+        stats = CallStats()
+        t0 = time.perf_counter()
+        resp = get_scheduler().call(
+            lambda: api.embeddings.create(model=self.model, input=list(texts)),
+            estimated_tokens=sum(estimate_tokens(t) for t in texts),
+            stats=stats,
+        )
+        get_ledger().record(
+            UsageRecord(
+                operation="embed",
+                model=self.model,
+                latency_s=round(time.perf_counter() - t0, 3),
+                retries=stats.attempts - 1,
+                **usage_from_response(resp),
+            )
+        )
+        return [d.embedding for d in sorted(resp.data, key=lambda d: d.index)]
+
+
+class HashEmbeddingProvider:
+    """
+    Embedding local e determinístico (feature hashing de termos e bigramas).
+    Não precisa de rede: útil para testes e como alternativa offline.
+    """
+
+    def __init__(self, dim: int = 384) -> None:
+        self.dim = dim
+        self.name = f"hash:{dim}"
+
+    def _bucket(self, feature: str) -> Tuple[int, float]:
+        h = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+        return h % self.dim, (1.0 if (h >> 63) & 1 else -1.0)
+
+    def embed(self, texts: Sequence[str]) -> List[List[float]]:
+        out: List[List[float]] = []
+        for text in texts:
+            vec = [0.0] * self.dim
+            terms = tokenize(text)
+            for feat in terms + [f"{a} {b}" for a, b in zip(terms, terms[1:])]:
+                i, sign = self._bucket(feat)
+                vec[i] += sign
+            out.append(vec)
+        return out
+
+
+def _normalize_rows(mat: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(mat, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return mat / norms
+
+
+class DenseIndex:
+    """
+    Índice semântico: matriz contígua (n_blocos x dim) de embeddings normalizados.
+    Salva em disco como binário cru e reaberta com np.memmap (sem re-embedding e sem cópia em RAM).
+    Opcionalmente quantizada em int8 com uma escala float32 por linha.
+    """
+
+    def __init__(
+        self,
+        chunks: Sequence[TextChunk],
+        matrix: np.ndarray,
+        provider: EmbeddingProvider,
+        scales: Optional[np.ndarray] = None,
+    ) -> None:
+        self.chunks: List[TextChunk] = list(chunks)
+        self.matrix = matrix
+        self.scales = scales  # apenas para int8
+        self.provider = provider
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    @property
+    def dtype(self) -> str:
+        return "int8" if self.scales is not None else "float32"
+
+    @classmethod
+    def build(
+        cls,
+        text: str,
+        provider: EmbeddingProvider,
+        batch_size: int = 64,
+        quantize: bool = False,
+        max_tokens: int = 350,
+        overlap_tokens: int = 60,
+    ) -> "DenseIndex":
+        chunks = chunk_text(text, max_tokens=max_tokens, overlap_tokens=overlap_tokens)
+        matrix: Optional[np.ndarray] = None
+        for start in range(0, len(chunks), batch_size):
+            batch = chunks[start:start + batch_size]
+            vecs = np.asarray(provider.embed([c.text for c in batch]), dtype=np.float32)
+            if matrix is None:
+                matrix = np.empty((len(chunks), vecs.shape[1]), dtype=np.float32)
+            matrix[start:start + len(batch)] = vecs
+        if matrix is None:
+            matrix = np.empty((0, 0), dtype=np.float32)
+        matrix = _normalize_rows(matrix)
+
+        if not quantize:
+            return cls(chunks, np.ascontiguousarray(matrix), provider)
+
+        scales = (np.abs(matrix).max(axis=1, initial=0.0) / 127.0).astype(np.float32)
+        scales[scales == 0] = 1.0
+        q = np.round(matrix / scales[:, None]).astype(np.int8)
+        return cls(chunks, np.ascontiguousarray(q), provider, scales=scales)
+
+    def save(self, directory: str | Path) -> Path:
+        d = Path(directory).expanduser().resolve()
+        d.mkdir(parents=True, exist_ok=True)
+        self.matrix.tofile(d / _VECTORS_FILE[self.dtype])
+        if self.scales is not None:
+            self.scales.tofile(d / _SCALES_FILE)
+        (d / _CHUNKS_FILE).write_text(
+            json.dumps([[c.start, c.text] for c in self.chunks], ensure_ascii=False), encoding="utf-8"
+        )
+        meta = {
+            "rows": int(self.matrix.shape[0]),
+            "dim": int(self.matrix.shape[1]) if self.matrix.ndim == 2 else 0,
+            "dtype": self.dtype,
+            "provider": self.provider.name,
+        }
+        (d / _META_FILE).write_text(json.dumps(meta), encoding="utf-8")
+        return d
+
+    @classmethod
+    def load(cls, directory: str | Path, provider: EmbeddingProvider) -> "DenseIndex":
+        d = Path(directory).expanduser().resolve()
+        meta = json.loads((d / _META_FILE).read_text(encoding="utf-8"))
+        if meta["provider"] != provider.name:
+            raise ValueError(
+                f"Índice criado com '{meta['provider']}', mas o provedor atual é '{provider.name}'."
+            )
+        raw = json.loads((d / _CHUNKS_FILE).read_text(encoding="utf-8"))
+        chunks = [TextChunk(index=i, text=t, start=s) for i, (s, t) in enumerate(raw)]
+        shape = (meta["rows"], meta["dim"])
+        if shape[0] == 0 or shape[1] == 0:
+            # Texto vazio: np.memmap não mapeia arquivo de 0 bytes
+            dtype = np.int8 if meta["dtype"] == "int8" else np.float32
+            scales = np.empty(0, dtype=np.float32) if meta["dtype"] == "int8" else None
+            return cls(chunks, np.empty(shape, dtype=dtype), provider, scales=scales)
+        if meta["dtype"] == "int8":
+            matrix = np.memmap(d / _VECTORS_FILE["int8"], dtype=np.int8, mode="r", shape=shape)
+            scales = np.fromfile(d / _SCALES_FILE, dtype=np.float32)
+            return cls(chunks, matrix, provider, scales=scales)
+        matrix = np.memmap(d / _VECTORS_FILE["float32"], dtype=np.float32, mode="r", shape=shape)
+        return cls(chunks, matrix, provider)
+
+    def search(self, query: str, top_k: int = DEFAULT_TOP_K) -> List[Tuple[TextChunk, float]]:
+        """
+        Similaridade de cosseno: produto matriz-vetor + argpartition. No índice int8 o produto é feito
+        em blocos de `_SEARCH_BLOCK_ROWS` linhas, para não converter a matriz (memmap) inteira para float.
+        """
+        n = len(self.chunks)
+        if n == 0:
+            return []
+        q = _normalize_rows(np.asarray(self.provider.embed([query]), dtype=np.float32))[0]
+        if self.scales is None:
+            scores = self.matrix @ q
+        else:
+            scores = np.empty(n, dtype=np.float32)
+            for start in range(0, n, _SEARCH_BLOCK_ROWS):
+                block = self.matrix[start:start + _SEARCH_BLOCK_ROWS]
+                scores[start:start + len(block)] = block.astype(np.float32) @ q
+            scores *= self.scales
+        k = min(top_k, n)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.chunks[int(i)], float(scores[i])) for i in top]
+
+    def select_context(
+        self,
+        question: str,
+        top_k: int = DEFAULT_TOP_K,
+        token_budget: int = DEFAULT_TOKEN_BUDGET,
+    ) -> Optional[str]:
+        """
+        Mesmo contrato do BM25Index: blocos mais similares até o orçamento, na ordem do ebook.
+        """
+        return pack_chunks([ch for ch, s in self.search(question, top_k=top_k) if s > 0], token_budget)
+
+
+def open_or_build_dense_index(
+    directory: str | Path,
+    text: str,
+    provider: EmbeddingProvider,
+    quantize: bool = False,
+) -> DenseIndex:
+    """
+    Reabre o índice salvo em `directory` se ele corresponder ao mesmo texto, provedor e quantização;
+    caso contrário, embeda, salva e retorna um novo índice.
+    """
+    d = Path(directory).expanduser().resolve()
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    stamp = d / "source.sha256"
+    try:
+        if stamp.read_text(encoding="utf-8").strip() == digest:
+            index = DenseIndex.load(d, provider)
+            if index.dtype == ("int8" if quantize else "float32"):
+                return index
+    except (OSError, ValueError, KeyError):
+        pass
+    index = DenseIndex.build(text, provider, quantize=quantize)
+    index.save(d)
+    stamp.write_text(digest, encoding="utf-8")
+    return index
+
+
+def default_retriever() -> str:
+    """
+    Busca configurada em $EBOOKQA_RETRIEVER ("bm25", "dense" ou "dense-int8"); valor desconhecido cai no BM25.
+    """
+    raw = os.environ.get("EBOOKQA_RETRIEVER", "").strip().lower()
+    return raw if raw in RETRIEVERS else DEFAULT_RETRIEVER
+
+
+def open_retriever(
+    directory: str | Path,
+    text: str,
+    kind: Optional[str] = None,
+    client: Any = None,
+) -> ContextSelector:
+    """
+    Índice de busca de `text` guardado em `directory` (reaberto se já existir):
+    "bm25" local; "dense"/"dense-int8" com embeddings da OpenAI (precisa de `client`), float32 ou int8.
+    `kind` None usa `default_retriever()`.
+    """
+    kind = kind or default_retriever()
+    if kind not in RETRIEVERS:
+        raise ValueError(f"Busca desconhecida: {kind!r} (use {', '.join(RETRIEVERS)}).")
+    if kind == "bm25":
+        return open_or_build_bm25_index(directory, text)
+    if client is None:
+        raise ValueError("A busca por embeddings precisa de um cliente OpenAI.")
+    return open_or_build_dense_index(
+        Path(directory) / _DENSE_DIR, text, OpenAIEmbeddingProvider(client), quantize=kind == "dense-int8"
+    )